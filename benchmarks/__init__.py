@@ -0,0 +1,5 @@
+"""Benchmarks for ipp-server.
+
+These are not run as part of the test suite. Run them with, eg:
+    python -m benchmarks.parse
+"""
@@ -0,0 +1,239 @@
+"""IPP requests like those sent by CUPS, macOS and Windows clients.
+
+These are synthesized from the attributes each client is known to send
+(from RFC 8011, PWG 5100.x and the clients' documented behaviour), not
+captured from the wire. They are encoded attribute by attribute, exactly
+as a client would, including collections and multi-valued attributes.
+"""
+from __future__ import division
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import struct
+
+from ippserver.constants import OperationEnum, SectionEnum, TagEnum
+from ippserver.parsers import Integer, Enum, Boolean
+
+
+OP = SectionEnum.operation
+JOB = SectionEnum.job
+
+BEGIN_COLLECTION = 0x34
+END_COLLECTION = 0x37
+MEMBER_NAME = 0x4a
+
+
+def encode(version, opid, request_id, groups):
+    """Encode a request from [(section, [(tag, name, value), ...]), ...].
+
+    A name of b'' adds another value to the previous attribute.
+    """
+    parts = [struct.pack(b'>bbhi', version[0], version[1], opid, request_id)]
+    for section, attributes in groups:
+        parts.append(struct.pack(b'>B', section))
+        for tag, name, value in attributes:
+            parts.append(struct.pack(b'>Bh', tag, len(name)))
+            parts.append(name)
+            parts.append(struct.pack(b'>h', len(value)))
+            parts.append(value)
+    parts.append(struct.pack(b'>B', SectionEnum.END))
+    return b''.join(parts)
+
+
+def values(tag, name, *values):
+    """A multi-valued attribute"""
+    return [(tag, name if i == 0 else b'', value) for i, value in enumerate(values)]
+
+
+def collection(name, members):
+    """A collection attribute, from [(tag, member name, value), ...]"""
+    attributes = [(BEGIN_COLLECTION, name, b'')]
+    for tag, member, value in members:
+        attributes.append((MEMBER_NAME, b'', member))
+        if tag == BEGIN_COLLECTION:
+            attributes.extend(collection(b'', value)[:-1])
+            attributes.append((END_COLLECTION, b'', b''))
+        else:
+            attributes.append((tag, b'', value))
+    attributes.append((END_COLLECTION, b'', b''))
+    return attributes
+
+
+def operation_attributes(printer_uri, user, language=b'en-us'):
+    return [
+        (TagEnum.charset, b'attributes-charset', b'utf-8'),
+        (TagEnum.natural_language, b'attributes-natural-language', language),
+        (TagEnum.uri, b'printer-uri', printer_uri),
+        (TagEnum.name_without_language, b'requesting-user-name', user),
+    ]
+
+
+def media_col(size_name, x, y):
+    return collection(b'media-col', [
+        (BEGIN_COLLECTION, b'media-size', [
+            (TagEnum.integer, b'x-dimension', Integer(x).bytes()),
+            (TagEnum.integer, b'y-dimension', Integer(y).bytes()),
+        ]),
+        (TagEnum.keyword, b'media-size-name', size_name),
+        (TagEnum.integer, b'media-bottom-margin', Integer(0).bytes()),
+        (TagEnum.integer, b'media-left-margin', Integer(0).bytes()),
+        (TagEnum.integer, b'media-right-margin', Integer(0).bytes()),
+        (TagEnum.integer, b'media-top-margin', Integer(0).bytes()),
+        (TagEnum.keyword, b'media-source', b'auto'),
+        (TagEnum.keyword, b'media-type', b'stationery'),
+    ])
+
+
+def cups_get_printer_attributes():
+    """CUPS 2.x polling the printer state while a queue is active"""
+    return encode((2, 0), OperationEnum.get_printer_attributes, 7, [
+        (OP, operation_attributes(
+            b'ipp://localhost:1234/printer', b'lp', b'en-gb') + values(
+            TagEnum.keyword, b'requested-attributes',
+            b'copies-supported', b'cups-version', b'document-format-supported',
+            b'job-password-encryption-supported', b'marker-colors',
+            b'marker-high-levels', b'marker-levels', b'marker-low-levels',
+            b'marker-message', b'marker-names', b'marker-types',
+            b'media-col-supported', b'multiple-document-handling-supported',
+            b'operations-supported', b'print-color-mode-supported',
+            b'printer-alert', b'printer-alert-description',
+            b'printer-is-accepting-jobs', b'printer-mandatory-job-attributes',
+            b'printer-state', b'printer-state-message', b'printer-state-reasons')),
+    ])
+
+
+def cups_print_job():
+    """A CUPS 2.x Print-Job header, with media-col sent as a collection"""
+    return encode((2, 0), OperationEnum.print_job, 8, [
+        (OP, operation_attributes(
+            b'ipp://localhost:1234/printer', b'user', b'en-gb') + [
+            (TagEnum.name_without_language, b'job-name', b'Untitled Document 1'),
+            (TagEnum.mime_media_type, b'document-format', b'application/postscript'),
+            (TagEnum.keyword, b'compression', b'none'),
+        ]),
+        (JOB, [
+            (TagEnum.integer, b'copies', Integer(1).bytes()),
+            (TagEnum.enum, b'finishings', Enum(3).bytes()),
+            (TagEnum.integer, b'job-cancel-after', Integer(10800).bytes()),
+            (TagEnum.keyword, b'job-hold-until', b'no-hold'),
+            (TagEnum.integer, b'job-priority', Integer(50).bytes()),
+        ] + values(TagEnum.name_without_language, b'job-sheets', b'none', b'none') + [
+            (TagEnum.integer, b'number-up', Integer(1).bytes()),
+            (TagEnum.enum, b'orientation-requested', Enum(3).bytes()),
+            (TagEnum.keyword, b'output-bin', b'face-down'),
+            (TagEnum.keyword, b'print-color-mode', b'color'),
+            (TagEnum.enum, b'print-quality', Enum(4).bytes()),
+            (TagEnum.keyword, b'sides', b'one-sided'),
+            (TagEnum.uri, b'job-uuid', b'urn:uuid:0f9a3ea4-6f0c-3d0e-5d4c-2f8e0b1d4a7c'),
+            (TagEnum.name_without_language, b'job-originating-host-name', b'localhost'),
+        ] + media_col(b'iso_a4_210x297mm', 21000, 29700)),
+    ])
+
+
+def cups_get_jobs():
+    """lpstat -o"""
+    return encode((2, 0), OperationEnum.get_jobs, 9, [
+        (OP, operation_attributes(b'ipp://localhost:1234/printer', b'user') + [
+            (TagEnum.keyword, b'which-jobs', b'not-completed'),
+            (TagEnum.boolean, b'my-jobs', Boolean(False).bytes()),
+        ] + values(
+            TagEnum.keyword, b'requested-attributes',
+            b'job-id', b'job-k-octets', b'job-name', b'job-originating-user-name',
+            b'job-printer-uri', b'job-state', b'time-at-creation')),
+    ])
+
+
+def macos_get_printer_attributes():
+    """macOS adding an AirPrint printer: it asks for everything"""
+    return encode((2, 0), OperationEnum.get_printer_attributes, 1, [
+        (OP, operation_attributes(
+            b'ipp://printer.local.:1234/ipp/print', b'jappleseed') + values(
+            TagEnum.keyword, b'requested-attributes',
+            b'all', b'media-col-database')),
+    ])
+
+
+def macos_validate_job():
+    return encode((2, 0), OperationEnum.validate_job, 2, [
+        (OP, operation_attributes(
+            b'ipp://printer.local.:1234/ipp/print', b'jappleseed') + [
+            (TagEnum.name_without_language, b'job-name', b'Keynote - Quarterly.key'),
+            (TagEnum.mime_media_type, b'document-format', b'image/urf'),
+        ]),
+        (JOB, media_col(b'na_letter_8.5x11in', 21590, 27940) + [
+            (TagEnum.keyword, b'print-color-mode', b'color'),
+            (TagEnum.keyword, b'sides', b'two-sided-long-edge'),
+        ]),
+    ])
+
+
+def macos_print_job():
+    return encode((2, 0), OperationEnum.print_job, 3, [
+        (OP, operation_attributes(
+            b'ipp://printer.local.:1234/ipp/print', b'jappleseed') + [
+            (TagEnum.name_without_language, b'job-name', b'Keynote - Quarterly.key'),
+            (TagEnum.mime_media_type, b'document-format', b'image/urf'),
+            (TagEnum.keyword, b'compression', b'gzip'),
+            (TagEnum.name_without_language, b'document-name', b'Quarterly.key'),
+        ]),
+        (JOB, media_col(b'na_letter_8.5x11in', 21590, 27940) + [
+            (TagEnum.integer, b'copies', Integer(2).bytes()),
+            (TagEnum.keyword, b'output-bin', b'face-down'),
+            (TagEnum.keyword, b'print-color-mode', b'color'),
+            (TagEnum.enum, b'print-quality', Enum(5).bytes()),
+            (TagEnum.resolution, b'printer-resolution', struct.pack(b'>iib', 600, 600, 3)),
+            (TagEnum.keyword, b'sides', b'two-sided-long-edge'),
+            (TagEnum.keyword, b'print-scaling', b'auto'),
+        ]),
+    ])
+
+
+def windows_get_printer_attributes():
+    """The Windows IPP class driver (Mopria), discovering a printer"""
+    return encode((2, 0), OperationEnum.get_printer_attributes, 1, [
+        (OP, operation_attributes(
+            b'ipp://192.168.1.20:1234/ipp/print', b'DESKTOP-1A2B3C\\Jo',
+            b'en-us') + values(
+            TagEnum.keyword, b'requested-attributes',
+            b'printer-description', b'job-template', b'media-col-database',
+            b'printer-icons', b'printer-uuid', b'pwg-raster-document-resolution-supported',
+            b'pwg-raster-document-sheet-back', b'pwg-raster-document-type-supported',
+            b'urf-supported', b'printer-kind', b'printer-device-id')),
+    ])
+
+
+def windows_print_job():
+    return encode((2, 0), OperationEnum.print_job, 12, [
+        (OP, operation_attributes(
+            b'ipp://192.168.1.20:1234/ipp/print', b'DESKTOP-1A2B3C\\Jo') + [
+            (TagEnum.name_without_language, b'job-name', b'Microsoft Word - Report.docx'),
+            (TagEnum.mime_media_type, b'document-format', b'image/pwg-raster'),
+            (TagEnum.keyword, b'compression', b'none'),
+            (TagEnum.uri, b'job-uuid', b'urn:uuid:6d3a8f6e-2c41-4b6a-9d2e-6c3d2b1a0f9e'),
+        ]),
+        (JOB, media_col(b'iso_a4_210x297mm', 21000, 29700) + [
+            (TagEnum.integer, b'copies', Integer(1).bytes()),
+            (TagEnum.keyword, b'multiple-document-handling',
+             b'separate-documents-collated-copies'),
+            (TagEnum.enum, b'orientation-requested', Enum(3).bytes()),
+            (TagEnum.keyword, b'print-color-mode', b'monochrome'),
+            (TagEnum.enum, b'print-quality', Enum(4).bytes()),
+            (TagEnum.resolution, b'printer-resolution', struct.pack(b'>iib', 300, 300, 3)),
+            (TagEnum.keyword, b'sides', b'one-sided'),
+        ]),
+    ])
+
+
+def corpus():
+    """[(name, encoded request)] for every request in the corpus"""
+    return [
+        ('cups-get-printer-attributes', cups_get_printer_attributes()),
+        ('cups-print-job', cups_print_job()),
+        ('cups-get-jobs', cups_get_jobs()),
+        ('macos-get-printer-attributes', macos_get_printer_attributes()),
+        ('macos-validate-job', macos_validate_job()),
+        ('macos-print-job', macos_print_job()),
+        ('windows-get-printer-attributes', windows_get_printer_attributes()),
+        ('windows-print-job', windows_print_job()),
+    ]
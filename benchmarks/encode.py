@@ -0,0 +1,77 @@
+"""Compare the cost of encoding a Get-Printer-Attributes response.
+
+    python -m benchmarks.encode [--number N]
+"""
+from __future__ import division
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+from io import BytesIO
+import itertools
+import operator
+import timeit
+
+from ippserver.behaviour import StatelessPrinter
+from ippserver.constants import OperationEnum, SectionEnum, StatusCodeEnum
+from ippserver.parsers import write_struct
+from ippserver.request import IppRequest
+
+
+def sorted_groupby_to_string(ipp_request):
+    """How IppRequest.to_string used to work, for comparison"""
+    f = BytesIO()
+    write_struct(f, b'>bb', 1, 1)
+    write_struct(f, b'>hi', ipp_request.opid_or_status, ipp_request.request_id)
+    for section, attrs_in_section in itertools.groupby(
+        sorted(ipp_request._attributes.keys()), operator.itemgetter(0)
+    ):
+        write_struct(f, b'>B', section)
+        for key in attrs_in_section:
+            _section, name, tag = key
+            for i, value in enumerate(ipp_request._attributes[key]):
+                write_struct(f, b'>B', tag)
+                if i == 0:
+                    write_struct(f, b'>h', len(name))
+                    f.write(name)
+                else:
+                    write_struct(f, b'>h', 0)
+                write_struct(f, b'>h', len(value))
+                f.write(value)
+    write_struct(f, b'>B', SectionEnum.END)
+    return f.getvalue()
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--number', type=int, default=20000)
+    parsed_args = parser.parse_args(args)
+
+    behaviour = StatelessPrinter()
+    response = IppRequest(
+        behaviour.version, StatusCodeEnum.ok, 1,
+        behaviour.printer_list_attributes())
+    req = IppRequest(behaviour.version, OperationEnum.get_printer_attributes, 1, {})
+    cases = [
+        ('sort+groupby', lambda: sorted_groupby_to_string(response)),
+        ('to_string', response.to_string),
+        # building the response as well as encoding it
+        ('build+encode', lambda: IppRequest(
+            behaviour.version, StatusCodeEnum.ok, 1,
+            behaviour.printer_list_attributes()).to_string()),
+        ('template', lambda: behaviour.operation_printer_list_response(
+            req, None).to_string()),
+    ]
+    print('Encoding a %d byte Get-Printer-Attributes response, %d times' % (
+        len(response.to_string()), parsed_args.number))
+    baseline = None
+    for name, function in cases:
+        seconds = min(timeit.repeat(function, number=parsed_args.number, repeat=3))
+        per_call = seconds / parsed_args.number * 1e6
+        baseline = baseline or per_call
+        print('%-14s %8.2f us/encode  (%.2fx)' % (name, per_call, baseline / per_call))
+
+
+if __name__ == '__main__':
+    main()
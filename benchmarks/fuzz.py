@@ -0,0 +1,175 @@
+"""Check that IppRequest parsing scales linearly, and survives bad input.
+
+    python -m benchmarks.fuzz [--iterations N] [--seed SEED] [--sizes N,N,...]
+
+The scaling check parses messages built to stress the parser (many
+attributes, many values of one attribute, deeply nested collections,
+long values) at each size, and fails if the time per byte at the largest
+size is more than --max-slowdown times that at the smallest.
+
+The fuzzer mutates each message of the corpus. The parsers may reject a
+mutated message, but only with IppParseError. A message from_buffer
+accepts must parse the same with from_file, and survive to_string and
+back unchanged.
+"""
+from __future__ import division
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+from io import BytesIO
+import random
+import struct
+import sys
+import timeit
+
+from ippserver.constants import OperationEnum, SectionEnum, TagEnum
+from ippserver.request import IppParseError, IppRequest
+
+from .corpus import corpus, encode, values, BEGIN_COLLECTION, END_COLLECTION, MEMBER_NAME
+
+
+OP = SectionEnum.operation
+
+
+def header(attributes):
+    return encode((2, 0), OperationEnum.get_printer_attributes, 1, [
+        (OP, [(TagEnum.charset, b'attributes-charset', b'utf-8')] + attributes)])
+
+
+def many_attributes(n):
+    return header([
+        (TagEnum.keyword, ('attribute-%d' % (i,)).encode('ascii'), b'value')
+        for i in range(n)])
+
+
+def many_values(n):
+    return header(values(
+        TagEnum.keyword, b'requested-attributes',
+        *[('attribute-%d' % (i,)).encode('ascii') for i in range(n)]))
+
+
+def nested_collections(n):
+    opening = [(BEGIN_COLLECTION, b'media-col', b'')]
+    for _ in range(n):
+        opening += [(MEMBER_NAME, b'', b'member'), (BEGIN_COLLECTION, b'', b'')]
+    return header(opening + [(END_COLLECTION, b'', b'')] * (n + 1))
+
+
+def long_values(n):
+    # Values are at most 32767 bytes, so long documents need several
+    return header(values(
+        TagEnum.octet_str, b'job-password',
+        *[b'x' * 256 for _ in range(n)]))
+
+
+MESSAGES = [
+    ('many attributes', many_attributes),
+    ('many values', many_values),
+    ('nested collections', nested_collections),
+    ('long values', long_values),
+]
+
+
+def parse_seconds_per_byte(data, number):
+    seconds = min(timeit.repeat(lambda: IppRequest.from_buffer(data), number=number, repeat=3))
+    return seconds / number / len(data)
+
+
+def check_scaling(build, sizes, number, max_slowdown):
+    """Returns (seconds per byte at each size, whether the slowdown is
+    within max_slowdown)"""
+    timings = [parse_seconds_per_byte(build(size), number) for size in sizes]
+    return timings, timings[-1] <= timings[0] * max_slowdown
+
+
+def mutate(data, rng):
+    """data with one random change"""
+    data = bytearray(data)
+    position = rng.randrange(len(data))
+    kind = rng.randrange(7)
+    if kind == 0:
+        data[position] ^= 1 << rng.randrange(8)
+    elif kind == 1:
+        data[position] = rng.randrange(256)
+    elif kind == 2:
+        del data[position:]
+    elif kind == 3:
+        del data[position:position + rng.randrange(1, 16)]
+    elif kind == 4:
+        data[position:position] = bytearray(rng.randrange(256) for _ in range(rng.randrange(1, 16)))
+    elif kind == 5:
+        data[position:position] = data[position:position + rng.randrange(1, 64)]
+    else:
+        # A length field which is very long, negative or zero
+        data[position:position + 2] = struct.pack(b'>h', rng.choice((0x7fff, -1, -0x8000, 0)))
+    return bytes(data)
+
+
+def check(data):
+    """Raises AssertionError if the parsers mishandle data"""
+    try:
+        request = IppRequest.from_buffer(data)
+    except Exception as e:
+        if not isinstance(e, IppParseError):
+            raise AssertionError('from_buffer raised %r' % (e,))
+        return
+    try:
+        from_file = IppRequest.from_file(BytesIO(data))
+    except Exception as e:
+        raise AssertionError('from_file raised %r where from_buffer did not' % (e,))
+    if (from_file.version, from_file.opid_or_status, from_file.request_id, from_file._attributes) != \
+            (request.version, request.opid_or_status, request.request_id, request._attributes):
+        raise AssertionError('from_file and from_buffer disagree')
+    round_trip = IppRequest.from_buffer(request.to_string())
+    if (round_trip.opid_or_status, round_trip.request_id, round_trip._attributes) != \
+            (request.opid_or_status, request.request_id, request._attributes):
+        raise AssertionError('to_string and back changed the request')
+
+
+def fuzz(iterations, seed, messages=None):
+    """Check iterations mutations of each message, returning
+    [(name, data, AssertionError), ...] for those mishandled"""
+    rng = random.Random(seed)
+    failures = []
+    for name, data in messages or corpus():
+        for _ in range(iterations):
+            mutated = mutate(data, rng)
+            try:
+                check(mutated)
+            except AssertionError as e:
+                failures.append((name, mutated, e))
+    return failures
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--iterations', type=int, default=2000, help='Mutations of each corpus message')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--sizes', default='100,1000,10000', help='Comma-separated sizes for the scaling check')
+    parser.add_argument('--number', type=int, default=5, help='Parses of each message in the scaling check')
+    parser.add_argument('--max-slowdown', type=float, default=3.0)
+    parsed_args = parser.parse_args(args)
+
+    ok = True
+    sizes = [int(size) for size in parsed_args.sizes.split(',')]
+    print('%-20s %s' % ('ns/byte', ' '.join('%10d' % (size,) for size in sizes)))
+    for name, build in MESSAGES:
+        timings, linear = check_scaling(build, sizes, parsed_args.number, parsed_args.max_slowdown)
+        ok = ok and linear
+        print('%-20s %s%s' % (
+            name, ' '.join('%10.2f' % (t * 1e9,) for t in timings),
+            '' if linear else '  NOT LINEAR'))
+
+    failures = fuzz(parsed_args.iterations, parsed_args.seed)
+    print('%d mutations of %d messages, %d mishandled' % (
+        parsed_args.iterations, len(corpus()), len(failures)))
+    for name, data, error in failures[:10]:
+        print('%s: %s: %r' % (name, error, data))
+    if failures or not ok:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,344 @@
+"""Drive CUPS-like traffic at an ipp-server, and report throughput and latency.
+
+    python -m benchmarks.loadgen [--concurrency N] [--duration SECONDS]
+        [--print-fraction F] [--sizes 10K,1M,500M] [--chunked]
+        [--subprocess] [--engine threads|asyncio] [-- SERVER ARGS...]
+
+The server is started in this process (so its CPU time and memory include
+the load generator's), or with --subprocess as `python -m ippserver`,
+which is measured on its own. Server arguments after -- replace the
+default `save DIRECTORY` behaviour with a temporary directory.
+"""
+from __future__ import division
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import http.client
+import itertools
+import os
+import random
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from ippserver.behaviour import SaveFilePrinter
+from ippserver.constants import OperationEnum, SectionEnum, TagEnum
+from ippserver.request import IppRequest
+from ippserver.server import IPPRequestHandler, IPPServer
+
+from .parse import cups_print_job
+
+
+BLOCK = bytes(bytearray(range(256))) * 256
+SIZE_SUFFIXES = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+
+def parse_size(text):
+    text = text.strip().upper()
+    if text[-1:] in SIZE_SUFFIXES:
+        return int(float(text[:-1]) * SIZE_SUFFIXES[text[-1]])
+    return int(text)
+
+
+def get_printer_attributes():
+    """The Get-Printer-Attributes request CUPS polls printers with"""
+    op = SectionEnum.operation
+    return IppRequest((2, 0), OperationEnum.get_printer_attributes, 1, {
+        (op, b'attributes-charset', TagEnum.charset): [b'utf-8'],
+        (op, b'attributes-natural-language', TagEnum.natural_language): [b'en-gb'],
+        (op, b'printer-uri', TagEnum.uri): [b'ipp://localhost:1234/printer'],
+        (op, b'requested-attributes', TagEnum.keyword): [
+            b'copies-supported', b'document-format-supported',
+            b'marker-levels', b'printer-state', b'printer-state-reasons',
+            b'printer-up-time'],
+    }).to_string()
+
+
+class Document(object):
+    """size bytes of a made-up document, without holding it in memory"""
+
+    def __init__(self, header, size):
+        self.header = header
+        self.remaining = size
+
+    def __len__(self):
+        return len(self.header) + self.remaining
+
+    def read(self, size=-1):
+        if self.header:
+            block, self.header = self.header, b''
+            return block
+        if size is None or size < 0 or size > len(BLOCK):
+            size = len(BLOCK)
+        size = min(size, self.remaining)
+        self.remaining -= size
+        return BLOCK[:size]
+
+    def blocks(self):
+        return iter(lambda: self.read(len(BLOCK)), b'')
+
+
+class Results(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+
+    def add(self, kind, seconds):
+        with self.lock:
+            self.latencies.setdefault(kind, []).append(seconds)
+
+    def error(self, kind, exception):
+        with self.lock:
+            self.errors.setdefault(kind, []).append(exception)
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return float('nan')
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+class Client(object):
+    def __init__(self, port, results, print_fraction, sizes, chunked):
+        self.port = port
+        self.results = results
+        self.print_fraction = print_fraction
+        self.sizes = sizes
+        self.chunked = chunked
+        self.connection = None
+        self.poll = get_printer_attributes()
+        self.print_job_header = cups_print_job()
+
+    def request(self, body, **kwargs):
+        if self.connection is None:
+            self.connection = http.client.HTTPConnection('127.0.0.1', self.port)
+        headers = {'Content-Type': 'application/ipp'}
+        if not kwargs.get('encode_chunked'):
+            headers['Content-Length'] = '%d' % (len(body),)
+        try:
+            self.connection.request('POST', '/printer', body, headers, **kwargs)
+            response = self.connection.getresponse()
+            response.read()
+        except Exception:
+            self.connection.close()
+            self.connection = None
+            raise
+        if response.status != 200:
+            raise RuntimeError('HTTP status %d' % (response.status,))
+        if response.getheader('Connection', '').lower() == 'close':
+            self.connection.close()
+            self.connection = None
+
+    def run_one(self):
+        if random.random() < self.print_fraction:
+            size = random.choice(self.sizes)
+            kind = 'print-job %s%s' % (size, ' chunked' if self.chunked else '')
+            document = Document(self.print_job_header, size)
+            if self.chunked:
+                send = lambda: self.request(document.blocks(), encode_chunked=True)
+            else:
+                send = lambda: self.request(document)
+        else:
+            kind = 'get-printer-attributes'
+            send = lambda: self.request(self.poll)
+        started = time.perf_counter()
+        try:
+            send()
+        except Exception as e:
+            self.results.error(kind, e)
+        else:
+            self.results.add(kind, time.perf_counter() - started)
+
+    def run_until(self, deadline, counter):
+        while time.time() < deadline and next(counter, None) is not None:
+            self.run_one()
+
+
+class ProcessUsage(object):
+    """CPU seconds and peak RSS of a process and its child processes (such
+    as --workers), from /proc (so Linux only)"""
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.ticks = os.sysconf(os.sysconf_names['SC_CLK_TCK'])
+
+    def _stat(self, pid):
+        with open('/proc/%s/stat' % (pid,)) as f:
+            return f.read().rsplit(')', 1)[1].split()
+
+    def pids(self):
+        pids = [self.pid]
+        for entry in os.listdir('/proc'):
+            if entry.isdigit():
+                try:
+                    if int(self._stat(entry)[1]) == self.pid:
+                        pids.append(int(entry))
+                except (IOError, OSError):
+                    # exited
+                    pass
+        return pids
+
+    def cpu_seconds(self):
+        total = 0
+        for pid in self.pids():
+            try:
+                fields = self._stat(pid)
+            except (IOError, OSError):
+                continue
+            total += int(fields[11]) + int(fields[12])
+        return total / self.ticks
+
+    def peak_rss_bytes(self):
+        total = 0
+        for pid in self.pids():
+            try:
+                with open('/proc/%d/status' % (pid,)) as f:
+                    for line in f:
+                        if line.startswith('VmHWM:'):
+                            total += int(line.split()[1]) * 1024
+            except (IOError, OSError):
+                continue
+        return total
+
+
+class SelfUsage(object):
+    def cpu_seconds(self):
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        return usage.ru_utime + usage.ru_stime
+
+    def peak_rss_bytes(self):
+        # kilobytes on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def wait_for_port(port, timeout=10):
+    deadline = time.time() + timeout
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port), 0.5).close()
+            return
+        except socket.error:
+            if time.time() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+def start_subprocess_server(engine, server_args):
+    port = free_port()
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'ippserver', '--port', '%d' % (port,),
+         '--engine', engine] + server_args)
+    wait_for_port(port)
+    return port, process
+
+
+def start_in_process_server(directory):
+    server = IPPServer(
+        ('127.0.0.1', 0), IPPRequestHandler, SaveFilePrinter(directory, 'ps'))
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def report(results, elapsed, usage, cpu_before):
+    total = 0
+    print('%-30s %8s %7s %9s %9s %9s' % (
+        'request', 'count', 'errors', 'req/s', 'p50 ms', 'p99 ms'))
+    for kind in sorted(set(results.latencies) | set(results.errors)):
+        latencies = sorted(results.latencies.get(kind, []))
+        total += len(latencies)
+        print('%-30s %8d %7d %9.1f %9.2f %9.2f' % (
+            kind, len(latencies), len(results.errors.get(kind, [])),
+            len(latencies) / elapsed,
+            percentile(latencies, 0.5) * 1000,
+            percentile(latencies, 0.99) * 1000))
+    print('%-30s %8d %7s %9.1f' % ('total', total, '', total / elapsed))
+
+    cpu = usage.cpu_seconds() - cpu_before
+    print_jobs = sum(
+        len(latencies) for kind, latencies in results.latencies.items()
+        if kind.startswith('print-job'))
+    print('server CPU: %.2fs' % (cpu,), end='')
+    if print_jobs:
+        print(', %.2f ms per print job' % (cpu / print_jobs * 1000,), end='')
+    print(', peak RSS: %.1f MiB' % (usage.peak_rss_bytes() / 1024 ** 2,))
+    for kind, errors in sorted(results.errors.items()):
+        print('%s: first error: %r' % (kind, errors[0]))
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--concurrency', type=int, default=8, help='Clients sending requests at once')
+    parser.add_argument('--duration', type=float, default=10, help='Seconds to send requests for')
+    parser.add_argument('--requests', type=int, help='Stop after this many requests')
+    parser.add_argument('--print-fraction', type=float, default=0.1, help='Fraction of requests which are Print-Job (the rest are Get-Printer-Attributes)')
+    parser.add_argument('--sizes', default='10K,1M', help='Comma-separated document sizes for Print-Job, eg: 10K,1M,500M')
+    parser.add_argument('--chunked', action='store_true', default=False, help='Send Print-Job bodies with chunked transfer encoding, like CUPS')
+    parser.add_argument('--subprocess', action='store_true', default=False, help='Run the server as a separate process, so its CPU and memory are measured alone')
+    parser.add_argument('--engine', choices=('threads', 'asyncio'), default='threads', help='Server engine (with --subprocess)')
+    parser.add_argument('server_args', nargs=argparse.REMAINDER, help='Arguments for python -m ippserver, after --port (with --subprocess)')
+    parsed_args = parser.parse_args(args)
+
+    directory = tempfile.mkdtemp(prefix='ipp-server-loadgen-')
+    server = process = None
+    try:
+        if parsed_args.subprocess:
+            server_args = [arg for arg in parsed_args.server_args if arg != '--']
+            port, process = start_subprocess_server(
+                parsed_args.engine, server_args or ['save', directory])
+            usage = ProcessUsage(process.pid)
+        else:
+            server = start_in_process_server(directory)
+            port = server.server_address[1]
+            usage = SelfUsage()
+
+        results = Results()
+        sizes = [parse_size(size) for size in parsed_args.sizes.split(',')]
+        counter = (
+            itertools.count() if parsed_args.requests is None
+            else iter(range(parsed_args.requests)))
+        deadline = time.time() + parsed_args.duration
+        clients = [
+            Client(port, results, parsed_args.print_fraction, sizes, parsed_args.chunked)
+            for _ in range(parsed_args.concurrency)]
+        threads = [
+            threading.Thread(target=client.run_until, args=(deadline, counter))
+            for client in clients]
+
+        cpu_before = usage.cpu_seconds()
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        report(results, elapsed, usage, cpu_before)
+    finally:
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+        if process is not None:
+            process.terminate()
+            process.wait()
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
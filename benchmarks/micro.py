@@ -0,0 +1,62 @@
+"""Time parsing and encoding each request in the corpus.
+
+    python -m benchmarks.micro [--number N] [--filter SUBSTRING]
+
+For each message: from_file and from_buffer parse it, to_string encodes
+the parsed request, round-trip does both, and multilevel is
+attributes_to_multilevel on the parsed request.
+"""
+from __future__ import division
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+from io import BytesIO
+import timeit
+
+from ippserver.request import IppRequest
+
+from .corpus import corpus
+
+
+def cases(data):
+    request = IppRequest.from_buffer(data)
+    return [
+        ('from_file', lambda: IppRequest.from_file(BytesIO(data))),
+        ('from_buffer', lambda: IppRequest.from_buffer(data)),
+        ('to_string', request.to_string),
+        ('round-trip', lambda: IppRequest.from_buffer(data).to_string()),
+        ('multilevel', request.attributes_to_multilevel),
+    ]
+
+
+def time_per_call(function, number):
+    """Microseconds per call, the best of 3 runs"""
+    return min(timeit.repeat(function, number=number, repeat=3)) / number * 1e6
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--number', type=int, default=5000)
+    parser.add_argument('--filter', default='', help='Only time messages whose name contains this')
+    parsed_args = parser.parse_args(args)
+
+    messages = [
+        (message, data) for message, data in corpus()
+        if parsed_args.filter in message]
+    if not messages:
+        parser.error('no message names contain %r' % (parsed_args.filter,))
+    names = [name for name, _ in cases(messages[0][1])]
+    print('%-32s %6s %s' % ('message', 'bytes', ' '.join('%11s' % (name,) for name in names)))
+    print('%-32s %6s %s' % ('', '', ' '.join('%11s' % ('us/call',) for _ in names)))
+    for message, data in messages:
+        timings = [
+            time_per_call(function, parsed_args.number)
+            for _, function in cases(data)]
+        print('%-32s %6d %s' % (
+            message, len(data), ' '.join('%11.2f' % (t,) for t in timings)))
+
+
+if __name__ == '__main__':
+    main()
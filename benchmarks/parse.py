@@ -0,0 +1,69 @@
+"""Compare the cost of parsing a typical CUPS Print-Job header.
+
+    python -m benchmarks.parse [--number N]
+"""
+from __future__ import division
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+from io import BytesIO
+import timeit
+
+from ippserver.constants import OperationEnum, SectionEnum, TagEnum
+from ippserver.parsers import Integer, Enum
+from ippserver.request import IppRequest
+
+
+def cups_print_job():
+    """The IPP header CUPS 2.x sends before the document of a Print-Job"""
+    op = SectionEnum.operation
+    job = SectionEnum.job
+    return IppRequest((2, 0), OperationEnum.print_job, 4, {
+        (op, b'attributes-charset', TagEnum.charset): [b'utf-8'],
+        (op, b'attributes-natural-language', TagEnum.natural_language): [b'en-gb'],
+        (op, b'printer-uri', TagEnum.uri): [b'ipp://localhost:1234/printers/ipp-printer.py'],
+        (op, b'requesting-user-name', TagEnum.name_without_language): [b'user'],
+        (op, b'job-name', TagEnum.name_without_language): [b'Untitled Document 1'],
+        (op, b'document-format', TagEnum.mime_media_type): [b'application/postscript'],
+        (op, b'compression', TagEnum.keyword): [b'none'],
+        (job, b'copies', TagEnum.integer): [Integer(1).bytes()],
+        (job, b'finishings', TagEnum.enum): [Enum(3).bytes()],
+        (job, b'job-cancel-after', TagEnum.integer): [Integer(10800).bytes()],
+        (job, b'job-hold-until', TagEnum.keyword): [b'no-hold'],
+        (job, b'job-priority', TagEnum.integer): [Integer(50).bytes()],
+        (job, b'job-sheets', TagEnum.name_without_language): [b'none', b'none'],
+        (job, b'media-col', TagEnum.keyword): [b'iso_a4_210x297mm'],
+        (job, b'number-up', TagEnum.integer): [Integer(1).bytes()],
+        (job, b'orientation-requested', TagEnum.enum): [Enum(3).bytes()],
+        (job, b'output-bin', TagEnum.keyword): [b'face-down'],
+        (job, b'print-color-mode', TagEnum.keyword): [b'color'],
+        (job, b'print-quality', TagEnum.enum): [Enum(4).bytes()],
+        (job, b'sides', TagEnum.keyword): [b'one-sided'],
+        (job, b'job-uuid', TagEnum.uri): [b'urn:uuid:0f9a3ea4-6f0c-3d0e-5d4c-2f8e0b1d4a7c'],
+        (job, b'job-originating-host-name', TagEnum.name_without_language): [b'localhost'],
+    }).to_string()
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--number', type=int, default=20000)
+    parsed_args = parser.parse_args(args)
+
+    data = cups_print_job()
+    cases = [
+        ('from_file', lambda: IppRequest.from_file(BytesIO(data))),
+        ('from_buffer', lambda: IppRequest.from_buffer(data)),
+    ]
+    print('Parsing a %d byte Print-Job header, %d times' % (len(data), parsed_args.number))
+    baseline = None
+    for name, function in cases:
+        seconds = min(timeit.repeat(function, number=parsed_args.number, repeat=3))
+        per_call = seconds / parsed_args.number * 1e6
+        baseline = baseline or per_call
+        print('%-12s %8.2f us/parse  (%.2fx)' % (name, per_call, baseline / per_call))
+
+
+if __name__ == '__main__':
+    main()
@@ -3,8 +3,12 @@ from __future__ import absolute_import
 from __future__ import print_function
 
 import argparse
+from collections import OrderedDict
+import json
 import logging
 import importlib
+import shutil
+import tempfile
 import sys, os.path
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
@@ -12,33 +16,61 @@ __package__ = "ippserver"
 
 
 from . import behaviour
+from . import prefork
+from . import tracing
+from .durability import DURABILITY_MODES, durability_from_name
+from .executor import CommandExecutor, WorkerProcessExecutor
+from .jobs import SqliteJobStore
+from .layout import LAYOUTS, layout_from_name
+from .spool import JobSpooler
 from .pc2paper import Pc2Paper
+from .queues import PrinterQueues, check_queue_name
 from .server import run_server, IPPServer, IPPRequestHandler
 
 
-def parse_args(args=None):
-    pdf_help = 'Request that CUPs sends the document as a PDF file, instead of a PS file. CUPs detects this setting when ADDING a printer: you may need to re-add the printer on a different port'
+def add_saving_args(parser):
+    parser.add_argument('--durability', choices=DURABILITY_MODES, default='none', help='Whether to fsync each saved file before replying (fsync), to fsync files from concurrent jobs together (group), or neither (none)')
+    parser.add_argument('--group-commit-window', type=float, metavar='SECONDS', help='How long --durability group waits to collect files to fsync together')
+    parser.add_argument('--layout', choices=LAYOUTS, default='flat', help='Save files directly in the directory (flat), or in subdirectories by date (YYYY/MM/DD), by a hash of the filename, or both. Sharded layouts keep an index of where each job was saved in index.sqlite')
+    parser.add_argument('--keep-compressed', action='store_true', default=False, help='Save gzip and deflate documents as they were sent, instead of decompressing them')
+    parser.add_argument('--deduplicate', action='store_true', default=False, help='Store each distinct document once, named by its SHA-256, with a JSON record of each job pointing at it')
 
-    parser = argparse.ArgumentParser(description='An IPP server')
-    parser.add_argument('-v', '--verbose', action='count', help='Add debugging')
-    parser.add_argument('-H', '--host', type=str, default='localhost', metavar='HOST', help='Address to listen on')
-    parser.add_argument('-p', '--port', type=int, required=True, metavar='PORT', help='Port to listen on')
+
+def add_executor_args(parser):
+    parser.add_argument('--max-processes', type=int, metavar='N', help='Run the command for at most N jobs at once (default: the number of CPUs)')
+    parser.add_argument('--max-queued', type=int, metavar='N', help='Fail jobs when N more are already waiting to run the command')
+    parser.add_argument('--command-timeout', type=float, metavar='SECONDS', help='Kill commands which run for longer than this')
+    parser.add_argument('--worker-process', action='store_true', default=False, help='The command is a long-lived worker, which is sent one job after another on its stdin (see ippserver.executor.WorkerProcessExecutor)')
+
+
+def add_job_args(parser):
+    parser.add_argument('--job-store', metavar='FILE', help='Keep track of print jobs in this SQLite database, instead of in memory')
+    parser.add_argument('--background-jobs', type=int, metavar='N', help='Reply to print jobs once the document is saved to a spool directory, and process them with N background threads')
+    parser.add_argument('--spool-directory', metavar='DIRECTORY', help='Directory for --background-jobs to save documents in (default: the temporary directory)')
+
+
+def add_actions(parser):
+    pdf_help = 'Request that CUPs sends the document as a PDF file, instead of a PS file. CUPs detects this setting when ADDING a printer: you may need to re-add the printer on a different port'
 
     parser_action = parser.add_subparsers(help='Actions', dest='action')
 
     parser_save = parser_action.add_parser('save', help='Write any print jobs to disk')
     parser_save.add_argument('--pdf', action='store_true', default=False, help=pdf_help)
     parser_save.add_argument('directory', metavar='DIRECTORY', help='Directory to save files into')
+    add_saving_args(parser_save)
 
     parser_command = parser_action.add_parser('run', help='Run a command when recieving a print job')
     parser_command.add_argument('command', nargs=argparse.REMAINDER, metavar='COMMAND', help='Command to run')
     parser_command.add_argument('--pdf', action='store_true', default=False, help=pdf_help)
     parser_command.add_argument('--env', action='store_true', default=False, help="Store Job attributes in environment (IPP_JOB_ATTRIBUTES)")
+    add_executor_args(parser_command)
 
     parser_saverun = parser_action.add_parser('saveandrun', help='Write any print jobs to disk and the run a command on them')
     parser_saverun.add_argument('--pdf', action='store_true', default=False, help=pdf_help)
     parser_saverun.add_argument('--env', action='store_true', default=False, help="Store Job attributes in environment (IPP_JOB_ATTRIBUTES)")
     parser_saverun.add_argument('directory', metavar='DIRECTORY', help='Directory to save files into')
+    add_saving_args(parser_saverun)
+    add_executor_args(parser_saverun)
     parser_saverun.add_argument('command', nargs=argparse.REMAINDER, metavar='COMMAND', help='Command to run (the filename will be added at the end)')
 
     parser_command = parser_action.add_parser('reject', help='Respond to all print jobs with job-canceled-at-device')
@@ -50,47 +82,257 @@ def parse_args(args=None):
     parser_loader.add_argument('path', nargs=1, metavar=['PATH'], help='Module implementing behaviour')
     parser_loader.add_argument('command', nargs=argparse.REMAINDER, metavar='COMMAND', help='Arguments for the module')
 
-    return parser.parse_args(args)
+
+def parse_queue_args(name, args):
+    parser = argparse.ArgumentParser(prog='queue %s' % (name,), description='A printer queue')
+    add_job_args(parser)
+    add_actions(parser)
+    parsed_args = parser.parse_args(args)
+    if parsed_args.action is None:
+        parser.error('an action is required')
+    return parsed_args
+
+
+def queue_config(filename):
+    """[(name, parsed args), ...] from a JSON object mapping each queue's
+    name to its arguments, eg: {"office": ["save", "/tmp/office"]}"""
+    try:
+        with open(filename) as f:
+            config = json.load(f, object_pairs_hook=OrderedDict)
+        if not isinstance(config, dict) or not config or not all(
+                isinstance(args, list) for args in config.values()):
+            raise ValueError('expected a JSON object of queue names and lists of arguments')
+        for name in config:
+            check_queue_name(name)
+    except (IOError, ValueError) as e:
+        raise argparse.ArgumentTypeError('%s: %s' % (filename, e))
+    return [(name, parse_queue_args(name, args)) for name, args in config.items()]
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description='An IPP server')
+    parser.add_argument('-v', '--verbose', action='count', help='Add debugging')
+    parser.add_argument('-H', '--host', type=str, default='localhost', metavar='HOST', help='Address to listen on')
+    parser.add_argument('-p', '--port', type=int, required=True, metavar='PORT', help='Port to listen on')
+    add_job_args(parser)
+    parser.add_argument('--engine', choices=('threads', 'asyncio'), default='threads', help='Serve each connection from its own thread, or from an asyncio event loop')
+    parser.add_argument('--keepalive-timeout', type=float, metavar='SECONDS', help='Close persistent connections which are idle for this long')
+    parser.add_argument('--max-keepalive-requests', type=int, metavar='N', help='Close persistent connections after this many requests')
+    parser.add_argument('--threads', type=int, metavar='N', help='Handle connections with a fixed pool of N threads, instead of a thread per connection')
+    parser.add_argument('--threads-per-queue', type=int, metavar='N', help='With --threads and --queues, let requests for one queue use at most N threads at once, answering the rest with server-error-busy (default: an equal share)')
+    parser.add_argument('--accept-queue', type=int, metavar='N', help='With --threads, stop accepting connections while N are waiting for a thread')
+    parser.add_argument('--listen-backlog', type=int, metavar='N', help='Connections the operating system queues before they are accepted')
+    parser.add_argument('--workers', type=int, metavar='N', help='Serve from N processes, to use more than one CPU core, restarting any which exit. They share --job-store, or a job store in a temporary directory')
+    parser.add_argument('--shared-socket', action='store_true', default=False, help='With --workers, have every process accept connections from one listening socket, instead of each listening on its own with SO_REUSEPORT')
+    parser.add_argument('--queues', type=queue_config, metavar='FILE', help='Serve several printers, at /printers/NAME, instead of one for the action. FILE is a JSON object of queue names and their arguments: --job-store, --background-jobs, --spool-directory, then the action and its arguments. Each queue gets its own job store (named after --job-store, if given) and background threads')
+    parser.add_argument('--trace-file', metavar='FILE', help='Append the timings of each phase of each request to FILE, as lines of JSON')
+    parser.add_argument('--trace-sample-rate', type=float, default=1.0, metavar='FRACTION', help='Trace only this fraction of requests')
+    parser.add_argument('--profile-slowest', type=int, default=0, metavar='N', help='Profile traced requests with cProfile, keeping the profiles of the N slowest')
+    parser.add_argument('--profile-directory', metavar='DIRECTORY', help='Where --profile-slowest keeps profiles (default: the current directory)')
+    parser.add_argument('--trace-memory', action='store_true', default=False, help='With --profile-slowest, also record where the slowest requests allocated memory, using tracemalloc')
+    add_actions(parser)
+
+    parsed_args = parser.parse_args(args)
+    if parsed_args.queues and parsed_args.action is not None:
+        parser.error('--queues replaces the action')
+    return parsed_args
+
+
+def job_store_from_parsed_args(args):
+    if args.job_store:
+        return SqliteJobStore(args.job_store)
+    return None
+
+
+def executor_from_parsed_args(args):
+    if args.worker_process:
+        cls = WorkerProcessExecutor
+    else:
+        cls = CommandExecutor
+    return cls(
+        args.command,
+        max_concurrency=args.max_processes,
+        max_queued=args.max_queued,
+        timeout=args.command_timeout)
 
 
 def behaviour_from_parsed_args(args):
+    job_store = job_store_from_parsed_args(args)
     if args.action == 'save':
         return behaviour.SaveFilePrinter(
             directory=args.directory,
-            filename_ext='pdf' if args.pdf else 'ps')
+            filename_ext='pdf' if args.pdf else 'ps',
+            job_store=job_store,
+            durability=durability_from_name(args.durability, args.group_commit_window),
+            deduplicate=args.deduplicate,
+            layout=layout_from_name(args.layout),
+            keep_compressed=args.keep_compressed)
     if args.action == 'run':
         return behaviour.RunCommandPrinter(
             command=args.command,
             use_env=args.env,
-            filename_ext='pdf' if args.pdf else 'ps')
+            filename_ext='pdf' if args.pdf else 'ps',
+            job_store=job_store,
+            executor=executor_from_parsed_args(args))
     if args.action == 'saveandrun':
         return behaviour.SaveAndRunPrinter(
             command=args.command,
             use_env=args.env,
             directory=args.directory,
-            filename_ext='pdf' if args.pdf else 'ps')
+            filename_ext='pdf' if args.pdf else 'ps',
+            job_store=job_store,
+            durability=durability_from_name(args.durability, args.group_commit_window),
+            executor=executor_from_parsed_args(args),
+            deduplicate=args.deduplicate,
+            layout=layout_from_name(args.layout),
+            keep_compressed=args.keep_compressed)
     if args.action == 'pc2paper':
         pc2paper_config = Pc2Paper.from_config_file(args.config)
         return behaviour.PostageServicePrinter(
             service_api=pc2paper_config,
-            filename_ext='pdf' if args.pdf else 'ps')
+            filename_ext='pdf' if args.pdf else 'ps',
+            job_store=job_store)
     if args.action == 'load':
         module, name = args.path[0].rsplit(".", 1)
-        return getattr(importlib.import_module(module), name)(*args.command)
+        loaded = getattr(importlib.import_module(module), name)(*args.command)
+        if job_store is not None:
+            loaded.job_store = job_store
+        return loaded
     if args.action == 'reject':
-        return behaviour.RejectAllPrinter()
+        return behaviour.RejectAllPrinter(job_store=job_store)
     raise RuntimeError(args)
 
 
-def main(args=None):
-    parsed_args = parse_args(args)
-    logging.basicConfig(level=logging.DEBUG if parsed_args.verbose else logging.INFO)
+def queue_job_store(job_store, name):
+    """The job store for a queue: jobs.sqlite becomes jobs-NAME.sqlite"""
+    root, ext = os.path.splitext(job_store)
+    return '%s-%s%s' % (root, name, ext)
+
+
+def assign_queue_job_stores(parsed_args):
+    """Give each queue without its own --job-store one named after the
+    server's --job-store, if there is one"""
+    for name, queue_args in parsed_args.queues:
+        if queue_args.job_store is None and parsed_args.job_store:
+            queue_args.job_store = queue_job_store(parsed_args.job_store, name)
+
+
+def configured_queues(parsed_args):
+    assign_queue_job_stores(parsed_args)
+    queues = PrinterQueues(
+        base_uri=('ipp://%s:%d/' % (parsed_args.host, parsed_args.port)).encode('ascii'))
+    for name, queue_args in parsed_args.queues:
+        queues.add(name, configured_printer(queue_args))
+    return queues
+
+
+def configured_behaviour(parsed_args):
+    if parsed_args.queues:
+        return configured_queues(parsed_args)
+    return configured_printer(parsed_args)
+
+
+def configured_printer(parsed_args):
+    configured = behaviour_from_parsed_args(parsed_args)
+    if parsed_args.background_jobs:
+        configured.job_spooler = JobSpooler(
+            directory=parsed_args.spool_directory,
+            workers=parsed_args.background_jobs,
+            # Spooled documents are synced like saved ones, if they are saved
+            durability=getattr(configured, 'durability', None))
+        if hasattr(configured, 'recover_spooled_jobs'):
+            configured.recover_spooled_jobs()
+    return configured
+
+
+def tracer_from_parsed_args(parsed_args):
+    if parsed_args.trace_file or parsed_args.profile_slowest:
+        return tracing.Tracer(
+            sample_rate=parsed_args.trace_sample_rate,
+            output=parsed_args.trace_file,
+            profile_slowest=parsed_args.profile_slowest,
+            profile_directory=parsed_args.profile_directory,
+            trace_memory=parsed_args.trace_memory)
+    return None
+
+
+def serve(parsed_args, address, listen_socket=None, reuse_port=None):
+    tracing.set_tracer(tracer_from_parsed_args(parsed_args))
+
+    if parsed_args.engine == 'asyncio':
+        from .aioserver import AsyncIPPServer, run_asyncio_server
+        server = AsyncIPPServer(
+            address,
+            configured_behaviour(parsed_args),
+            keepalive_timeout=parsed_args.keepalive_timeout,
+            max_keepalive_requests=parsed_args.max_keepalive_requests,
+            listen_socket=listen_socket,
+            reuse_port=reuse_port)
+        run_asyncio_server(server)
+        return
 
     server = IPPServer(
-        (parsed_args.host, parsed_args.port),
+        address,
         IPPRequestHandler,
-        behaviour_from_parsed_args(parsed_args))
+        configured_behaviour(parsed_args),
+        keepalive_timeout=parsed_args.keepalive_timeout,
+        max_keepalive_requests=parsed_args.max_keepalive_requests,
+        workers=parsed_args.threads,
+        threads_per_queue=parsed_args.threads_per_queue,
+        accept_queue_size=parsed_args.accept_queue,
+        listen_backlog=parsed_args.listen_backlog,
+        listen_socket=listen_socket,
+        reuse_port=reuse_port)
     run_server(server)
 
+
+def serve_with_workers(parsed_args):
+    """Pre-fork parsed_args.workers processes, serving the same port"""
+    directory = None
+    if not parsed_args.job_store:
+        # The workers must share a job store, so job ids are never reused
+        directory = tempfile.mkdtemp(prefix='ipp-server-jobs-')
+        parsed_args.job_store = os.path.join(directory, 'jobs.sqlite')
+    if parsed_args.queues:
+        assign_queue_job_stores(parsed_args)
+        job_stores = [queue_args.job_store for _name, queue_args in parsed_args.queues]
+    else:
+        job_stores = [parsed_args.job_store]
+    # Create the databases before the workers all try to
+    for job_store in job_stores:
+        SqliteJobStore(job_store).close()
+
+    reuse_port = not parsed_args.shared_socket and prefork.reuse_port_supported()
+    sock = prefork.bind_socket(
+        (parsed_args.host, parsed_args.port), reuse_port=reuse_port,
+        backlog=parsed_args.listen_backlog or IPPServer.request_queue_size)
+    address = sock.getsockname()
+    logging.info(
+        'Serving %r from %d processes%s', address, parsed_args.workers,
+        ' (SO_REUSEPORT)' if reuse_port else '')
+
+    def serve_worker(_index):
+        if reuse_port:
+            serve(parsed_args, address, reuse_port=True)
+        else:
+            serve(parsed_args, address, listen_socket=sock)
+
+    try:
+        prefork.run_supervisor(prefork.Supervisor(serve_worker, parsed_args.workers))
+    finally:
+        sock.close()
+        if directory is not None:
+            shutil.rmtree(directory)
+
+
+def main(args=None):
+    parsed_args = parse_args(args)
+    logging.basicConfig(level=logging.DEBUG if parsed_args.verbose else logging.INFO)
+
+    if parsed_args.workers:
+        serve_with_workers(parsed_args)
+    else:
+        serve(parsed_args, (parsed_args.host, parsed_args.port))
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,371 @@
+from __future__ import division
+from __future__ import absolute_import
+from __future__ import print_function
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import formatdate
+from http.client import parse_headers, responses
+from io import BytesIO
+import logging
+import struct
+
+from . import metrics
+from . import request
+from .constants import StatusCodeEnum
+from .server import (
+    CHUNK_READ_SIZE, ChunkedEncodingError, not_found_response, parse_chunk_size,
+    parse_content_length, www_response)
+
+
+class AsyncLengthLimitedBody(object):
+    def __init__(self, reader, length):
+        self.reader = reader
+        self.remaining = length
+
+    async def read(self, size=-1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        if size == 0:
+            return b''
+        block = await self.reader.read(size)
+        if not block:
+            raise RuntimeError(
+                'Socket closed with %d bytes of the request body unread' % (
+                    self.remaining,))
+        self.remaining -= len(block)
+        return block
+
+
+class AsyncChunkedBody(object):
+    def __init__(self, reader):
+        self.reader = reader
+        self._chunk_remaining = 0
+        self._eof = False
+
+    async def _next_chunk(self):
+        while True:
+            chunk_size_s = await self.reader.readline()
+            if not chunk_size_s:
+                raise RuntimeError(
+                    'Socket closed in the middle of a chunked request'
+                )
+            if chunk_size_s.strip() != b'':
+                break
+        self._chunk_remaining = parse_chunk_size(chunk_size_s)
+        if self._chunk_remaining == 0:
+            self._eof = True
+            while (await self.reader.readline()).strip() != b'':
+                pass
+
+    async def read(self, size=-1):
+        if size is None or size < 0:
+            size = CHUNK_READ_SIZE
+        while self._chunk_remaining == 0 and not self._eof:
+            await self._next_chunk()
+        if self._eof:
+            return b''
+        block = await self.reader.read(min(size, self._chunk_remaining))
+        if not block:
+            raise RuntimeError(
+                'Socket closed in the middle of a chunked request'
+            )
+        self._chunk_remaining -= len(block)
+        return block
+
+
+class AsyncUntilCloseBody(object):
+    def __init__(self, reader):
+        self.reader = reader
+
+    async def read(self, size=-1):
+        return await self.reader.read(size if size and size > 0 else CHUNK_READ_SIZE)
+
+
+class AsyncPrefixedBody(object):
+    """Returns data we have already read before reading more from body"""
+
+    def __init__(self, prefix, body):
+        self.prefix = prefix
+        self.body = body
+
+    async def read(self, size=-1):
+        if self.prefix:
+            if size is None or size < 0:
+                size = len(self.prefix)
+            block, self.prefix = self.prefix[:size], self.prefix[size:]
+            return block
+        return await self.body.read(size)
+
+
+class AsyncCountingBody(object):
+    def __init__(self, body):
+        self.body = body
+        self.bytes_read = 0
+
+    async def read(self, size=-1):
+        block = await self.body.read(size)
+        self.bytes_read += len(block)
+        return block
+
+
+class BlockingBodyReader(object):
+    """A file-like object for behaviours running in an executor thread.
+
+    Each read is passed back to the event loop, so the document is never
+    held in memory any more than with the threaded server.
+    """
+
+    def __init__(self, body, loop):
+        self.body = body
+        self.loop = loop
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            return b''.join(iter(lambda: self.read(CHUNK_READ_SIZE), b''))
+
+        blocks = []
+        while size > 0:
+            block = asyncio.run_coroutine_threadsafe(
+                self.body.read(size), self.loop).result()
+            if not block:
+                break
+            size -= len(block)
+            blocks.append(block)
+        return b''.join(blocks)
+
+    def close(self):
+        pass
+
+
+async def drain(body):
+    while await body.read(CHUNK_READ_SIZE):
+        pass
+
+
+async def read_ipp_request(body, max_size):
+    """Read an IPP message header from body.
+
+    Returns the IppRequest and a body for the document data which follows
+    it. Raises request.IppParseError if the header is malformed.
+    """
+    data = bytearray()
+    while True:
+        block = await body.read(CHUNK_READ_SIZE)
+        data += block
+        try:
+            ipp_request, end = request.IppRequest.from_buffer_at(data, 0)
+        except struct.error:
+            # we have not recieved all of the ipp message yet
+            if not block:
+                raise request.IppParseError('Request body ended in the IPP header')
+            if len(data) > max_size:
+                raise request.IppParseError('IPP header is larger than %d bytes' % (max_size,))
+        else:
+            return ipp_request, AsyncPrefixedBody(bytes(data[end:]), body)
+
+
+class AsyncIPPServer(object):
+    """An asyncio alternative to IPPServer.
+
+    Idle and polling connections cost a coroutine each, rather than a thread.
+    If behaviour.handle_ipp is a coroutine function it is awaited, and any
+    document is passed to it as an object with a coroutine read() method.
+    Otherwise handle_ipp is called in a thread pool with a blocking file-like
+    object, exactly as IPPServer would call it.
+    """
+    # Seconds to wait for the next request on a persistent connection
+    keepalive_timeout = 30
+    # Requests served on one connection before it is closed
+    max_keepalive_requests = 100
+    max_ipp_header_size = 1024 * 1024
+    # Set SO_REUSEPORT, so several processes can listen on the same port
+    reuse_port = False
+
+    def __init__(self, address, behaviour, keepalive_timeout=None,
+                 max_keepalive_requests=None, executor=None,
+                 listen_socket=None, reuse_port=None):
+        self.address = address
+        # A listening socket to serve instead of binding address
+        self.listen_socket = listen_socket
+        if reuse_port is not None:
+            self.reuse_port = reuse_port
+        self.behaviour = behaviour
+        if keepalive_timeout is not None:
+            self.keepalive_timeout = keepalive_timeout
+        if max_keepalive_requests is not None:
+            self.max_keepalive_requests = max_keepalive_requests
+        self.executor = executor or ThreadPoolExecutor()
+        # {behaviour: ThreadPoolExecutor} for the rest of PrinterQueues
+        self._executors = {}
+        self.server_address = None
+        self._server = None
+
+    async def start(self):
+        if self.listen_socket is not None:
+            self._server = await asyncio.start_server(
+                self.handle_connection, sock=self.listen_socket)
+        else:
+            host, port = self.address
+            self._server = await asyncio.start_server(
+                self.handle_connection, host, port, reuse_port=self.reuse_port)
+        self.server_address = self._server.sockets[0].getsockname()
+
+    async def serve_forever(self):
+        await self.start()
+        logging.info('Listening on %r', self.server_address)
+        async with self._server:
+            await self._server.serve_forever()
+
+    async def close(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def handle_connection(self, reader, writer):
+        metrics.ACTIVE_CONNECTIONS.inc()
+        try:
+            requests_handled = 0
+            keep_alive = True
+            while keep_alive:
+                try:
+                    head = await asyncio.wait_for(
+                        reader.readuntil(b'\r\n\r\n'), self.keepalive_timeout)
+                except (asyncio.IncompleteReadError, asyncio.TimeoutError):
+                    break
+                requests_handled += 1
+                keep_alive = await self.handle_request(
+                    head, reader, writer,
+                    requests_handled < self.max_keepalive_requests)
+        except Exception:
+            logging.exception('Error handling connection')
+        finally:
+            metrics.ACTIVE_CONNECTIONS.dec()
+            writer.close()
+
+    async def handle_request(self, head, reader, writer, keep_alive):
+        request_line, _, header_lines = head.partition(b'\r\n')
+        method, path, version = request_line.decode('latin-1').split(None, 2)
+        headers = parse_headers(BytesIO(header_lines))
+        logging.debug('%s %s %s', method, path, version)
+
+        connection = headers.get('connection', '').lower()
+        if connection == 'close':
+            keep_alive = False
+        elif version == 'HTTP/1.0' and connection != 'keep-alive':
+            keep_alive = False
+
+        content_length = headers.get('content-length')
+        if 'chunked' in headers.get('transfer-encoding', ''):
+            body = AsyncChunkedBody(reader)
+        elif content_length is not None:
+            try:
+                length = parse_content_length(content_length)
+            except ValueError as e:
+                # Where this request ends is unknown, so close the connection
+                await self.send_response(
+                    writer, 400, 'text/plain', str(e).encode('latin-1'), False)
+                return False
+            body = AsyncLengthLimitedBody(reader, length)
+        elif method == 'POST':
+            body = AsyncUntilCloseBody(reader)
+            keep_alive = False
+        else:
+            body = AsyncLengthLimitedBody(reader, 0)
+        body = AsyncCountingBody(body)
+
+        response_headers = ()
+        if method == 'POST':
+            try:
+                status, content_type, response, drain_body = await self.handle_ipp(
+                    path, body, writer)
+            except ChunkedEncodingError as e:
+                # Where this request ends is unknown, so close the connection
+                status, content_type, response = 400, 'text/plain', str(e).encode('latin-1')
+                drain_body = False
+            keep_alive = keep_alive and drain_body
+        elif method == 'GET':
+            status, content_type, response, response_headers = www_response(
+                self.behaviour, path, headers)
+        else:
+            status, content_type, response = 501, 'text/plain', b''
+            keep_alive = False
+
+        if keep_alive:
+            try:
+                await drain(body)
+            except ChunkedEncodingError:
+                keep_alive = False
+        metrics.BYTES_RECEIVED.inc(body.bytes_read)
+        await self.send_response(
+            writer, status, content_type, response, keep_alive, response_headers)
+        return keep_alive
+
+    def executor_for(self, behaviour):
+        """The thread pool for behaviour: each of several PrinterQueues
+        gets its own, so a queue with slow jobs does not hold up the others"""
+        if behaviour is self.behaviour:
+            return self.executor
+        executor = self._executors.get(behaviour)
+        if executor is None:
+            executor = self._executors[behaviour] = ThreadPoolExecutor()
+        return executor
+
+    async def handle_ipp(self, path, body, writer):
+        """Returns (status, content_type, body, whether to read the rest
+        of the request body to keep the connection)"""
+        loop = asyncio.get_running_loop()
+        behaviour = self.behaviour.behaviour_for_path(path)
+        if behaviour is None:
+            return not_found_response() + (True,)
+        try:
+            ipp_request, document = await read_ipp_request(
+                body, self.max_ipp_header_size)
+        except request.IppParseError as e:
+            return 400, 'text/plain', str(e).encode('utf-8'), True
+
+        if behaviour.expect_page_data_follows(ipp_request):
+            await self.send_headers(writer, 100, 'application/ipp')
+        else:
+            document = None
+
+        if asyncio.iscoroutinefunction(behaviour.handle_ipp):
+            ipp_response = await behaviour.handle_ipp(ipp_request, document)
+        else:
+            ipp_response = await loop.run_in_executor(
+                self.executor_for(behaviour), behaviour.handle_ipp, ipp_request,
+                None if document is None else BlockingBodyReader(document, loop))
+        # Close the connection rather than read a document which will not
+        # be processed
+        busy = ipp_response.opid_or_status == StatusCodeEnum.server_error_busy
+        return 200, 'application/ipp', ipp_response.to_string(), not busy
+
+    async def send_headers(self, writer, status, content_type, extra_headers=()):
+        lines = [
+            'HTTP/1.1 %d %s' % (status, responses.get(status, '')),
+            'Server: ipp-server',
+            'Date: %s' % (formatdate(usegmt=True),),
+            'Content-Type: %s' % (content_type,),
+        ]
+        lines.extend(extra_headers)
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+        await writer.drain()
+
+    async def send_response(self, writer, status, content_type, body, keep_alive,
+                            headers=()):
+        logging.debug('Response %d (%d bytes)', status, len(body))
+        extra_headers = ['%s: %s' % header for header in headers]
+        if status != 304:
+            # Not Modified has no body, so no Content-Length either
+            extra_headers.append('Content-Length: %u' % (len(body),))
+        extra_headers.append(
+            'Connection: %s' % ('keep-alive' if keep_alive else 'close',))
+        await self.send_headers(writer, status, content_type, extra_headers)
+        writer.write(body)
+        await writer.drain()
+
+
+def run_asyncio_server(server):
+    try:
+        asyncio.run(server.serve_forever())
+    except KeyboardInterrupt:
+        logging.info('Ready to shut down')
@@ -0,0 +1,163 @@
+from __future__ import division
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from collections import namedtuple
+import hashlib
+import json
+import logging
+import os
+import os.path
+import tempfile
+import uuid
+
+from .durability import NoSync
+from .layout import FlatLayout, make_directories, make_path
+from .streams import hash_to_fd, preallocate, remaining_length
+
+
+class ArchivedDocument(namedtuple('ArchivedDocument', (
+        'job_id', 'digest', 'size', 'path', 'duplicate'))):
+    """Where a job's document was archived.
+
+    path is the blob holding the document, which is shared with every
+    other job which printed the same document. duplicate is True if the
+    document had already been archived.
+    """
+
+
+class DocumentArchive(object):
+    """Stores each distinct document once, named by its digest.
+
+    The layout of directory is:
+        blobs/ab/abcdef....ps   one file per distinct document
+        jobs/<job key>.json     a record of each job, pointing at its blob
+        incoming/               documents which are being received
+
+    A document is hashed as it is written to incoming/, then renamed to
+    its blob, unless that blob already exists. Duplicates are never
+    synced to disk, so cost no more than a write to the page cache.
+
+    With a sharded layout (see ippserver.layout) the job records are split
+    into subdirectories of jobs/, and found through an index.
+    """
+    algorithm = 'sha256'
+
+    def __init__(self, directory, filename_ext, durability=None, layout=None,
+                 index=None):
+        self.directory = directory
+        self.filename_ext = filename_ext
+        self.durability = NoSync() if durability is None else durability
+        self.layout = FlatLayout() if layout is None else layout
+        # A JobPathIndex of job records, needed by sharded layouts
+        self.index = index
+        for subdirectory in ('blobs', 'jobs', 'incoming'):
+            make_directories(os.path.join(directory, subdirectory))
+
+    def blob_path(self, digest, suffix=''):
+        return os.path.join(
+            self.directory, 'blobs', digest[:2],
+            '%s.%s%s' % (digest, self.filename_ext, suffix))
+
+    def record_path(self, key):
+        """Where the record of a job is, or raise KeyError"""
+        if self.index is not None:
+            return self.index.lookup(key)
+        return os.path.join(self.directory, 'jobs', '%s.json' % (key,))
+
+    def has_document(self, digest):
+        return os.path.exists(self.blob_path(digest))
+
+    def store(self, job_id, document, job=None, suffix='', key=None):
+        """Archive the rest of document for job_id.
+
+        job is the Job from the job store, if there is one, and is
+        recorded along with the document. suffix is added to the blob's
+        filename, eg: '.gz' for a document which was kept compressed.
+        key names the job's record (default job_id): it must not be used
+        by any earlier job, even from before the server restarted (see
+        JobStore.job_key). Returns an ArchivedDocument.
+        """
+        if job_id is None:
+            job_id = uuid.uuid1().hex
+        if key is None:
+            key = job_id
+        digest = hashlib.new(self.algorithm)
+        fd, incoming = tempfile.mkstemp(
+            dir=os.path.join(self.directory, 'incoming'))
+        try:
+            try:
+                preallocate(fd, remaining_length(document))
+                size = hash_to_fd(document, fd, digest)
+                digest = digest.hexdigest()
+                path = self.blob_path(digest, suffix)
+                duplicate = os.path.exists(path)
+                if not duplicate:
+                    self.durability.sync(fd, incoming)
+            finally:
+                os.close(fd)
+            if duplicate:
+                os.unlink(incoming)
+            else:
+                self._add_blob(incoming, path)
+        except Exception:
+            if os.path.exists(incoming):
+                os.unlink(incoming)
+            raise
+
+        if duplicate:
+            logging.info('Job %s is a duplicate of %s', job_id, digest)
+        archived = ArchivedDocument(job_id, digest, size, path, duplicate)
+        self._write_record(key, archived, job)
+        return archived
+
+    def _add_blob(self, incoming, path):
+        make_directories(os.path.dirname(path), self.durability)
+        # If another job stored the same document meanwhile, this replaces
+        # it with an identical file
+        os.rename(incoming, path)
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            self.durability.sync(fd, path)
+        finally:
+            os.close(fd)
+
+    def _write_record(self, key, archived, job):
+        record = {
+            'job_id': archived.job_id,
+            'algorithm': self.algorithm,
+            'digest': archived.digest,
+            'size': archived.size,
+            'document': os.path.relpath(archived.path, self.directory),
+            'duplicate': archived.duplicate,
+        }
+        if job is not None:
+            record.update({
+                'user': None if job.user is None else job.user.decode('utf-8', 'replace'),
+                'name': None if job.name is None else job.name.decode('utf-8', 'replace'),
+                'time_created': job.time_created,
+            })
+        path = make_path(
+            os.path.join(self.directory, 'jobs'), self.layout,
+            '%s.json' % (key,), durability=self.durability)
+        # Never replace the record of an earlier job: O_EXCL fails instead
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(json.dumps(record, sort_keys=True).encode('utf-8'))
+            f.flush()
+            self.durability.sync(f.fileno(), path)
+        if self.index is not None:
+            self.index.add(key, path)
+
+    def lookup(self, key):
+        """Return the ArchivedDocument for the job with key, or raise KeyError"""
+        try:
+            with open(self.record_path(key), 'rb') as f:
+                record = json.loads(f.read().decode('utf-8'))
+        except IOError:
+            raise KeyError(key)
+        return ArchivedDocument(
+            record['job_id'], record['digest'], record['size'],
+            os.path.join(self.directory, record['document']),
+            record['duplicate'])
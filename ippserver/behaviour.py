@@ -7,18 +7,31 @@ from __future__ import unicode_literals
 import logging
 import os
 import os.path
-import random
 import json
-import subprocess
 import time
 import uuid
-
+import zlib
+
+from .archive import DocumentArchive
+from .compression import (
+    COMPRESSION_SUPPORTED, FILENAME_SUFFIXES, DecompressingReader)
+from .durability import NoSync
+from .executor import CommandExecutor, ExecutorBusy
+from .jobs import MemoryJobStore, WHICH_JOBS
+from .layout import FlatLayout, JobPathIndex, make_path
+from . import metrics
+from . import tracing
 from .parsers import Integer, Enum, Boolean
 from .constants import (
-    JobStateEnum, OperationEnum, StatusCodeEnum, SectionEnum, TagEnum
+    JobStateEnum, OperationEnum, PrinterStateEnum, StatusCodeEnum,
+    SectionEnum, TagEnum
 )
 from .ppd import BasicPostscriptPPD, BasicPdfPPD
-from .request import IppRequest
+from .request import IppRequest, encode_attributes
+from .static import StaticPage
+from .streams import (
+    CountingReader, copy_to_fd, preallocate, remaining_length
+)
 
 
 def get_job_id(req):
@@ -31,6 +44,124 @@ def get_job_id(req):
         ).integer
 
 
+def get_optional(req, section, name, tag, default=None):
+    """The first value of an attribute which the client may leave out"""
+    try:
+        return req.lookup(section, name, tag)[0]
+    except (KeyError, IndexError):
+        return default
+
+
+def document_compression(req):
+    """The compression keyword for a document, eg: b'gzip'"""
+    if req is None:
+        # process_job() was called without a request
+        return b'none'
+    return get_optional(
+        req, SectionEnum.operation, b'compression', TagEnum.keyword, b'none')
+
+
+# rfc2911 section 4.3.8
+JOB_STATE_REASONS = {
+    JobStateEnum.pending: [b'none'],
+    JobStateEnum.pending_held: [b'job-hold-until-specified'],
+    JobStateEnum.processing: [b'job-printing'],
+    JobStateEnum.processing_stopped: [b'printer-stopped'],
+    JobStateEnum.canceled: [b'job-canceled-by-user'],
+    JobStateEnum.aborted: [b'aborted-by-system'],
+    JobStateEnum.completed: [b'job-completed-successfully'],
+}
+
+
+def requested_attributes(req):
+    """The names in the requested-attributes operation attribute.
+
+    Returns None if the client wants all the attributes.
+    """
+    try:
+        names = frozenset(req.lookup(
+            SectionEnum.operation, b'requested-attributes', TagEnum.keyword))
+    except KeyError:
+        return None
+    if b'all' in names:
+        return None
+    return names
+
+
+class PrinterAttributesTemplate(object):
+    """The printer attributes group, encoded once and indexed by name.
+
+    Attributes in status_keys are left out of the encoding, because
+    they change while the printer is running: the response adds them
+    afresh.
+    """
+    # how many different requested-attributes lists to remember
+    max_cached_selections = 64
+
+    def __init__(self, attributes, status_keys, job_template_names):
+        self.status_keys = frozenset(status_keys)
+        self.attributes = dict(
+            (key, value) for key, value in attributes.items()
+            if key[0] != SectionEnum.printer)
+
+        self.names = []
+        self.encoded = {}
+        for key in attributes:
+            if key[0] != SectionEnum.printer:
+                continue
+            _section, name, _tag = key
+            if name not in self.encoded:
+                self.names.append(name)
+                self.encoded[name] = b''
+            if key not in self.status_keys:
+                parts = [self.encoded[name]]
+                encode_attributes(parts, attributes, [key])
+                self.encoded[name] = b''.join(parts)
+
+        all_names = frozenset(self.names)
+        self.groups = {
+            b'job-template': all_names & job_template_names,
+            b'printer-description': all_names - job_template_names,
+        }
+        self._selections = {}
+
+    def select(self, requested):
+        """Expand group keywords like printer-description in requested"""
+        if requested is None:
+            return None
+        names = requested
+        for keyword, group in self.groups.items():
+            if keyword in requested:
+                names = names | group
+        return names
+
+    def encoded_group(self, names):
+        """The encoded attributes in names (or all of them for None)"""
+        try:
+            return self._selections[names]
+        except KeyError:
+            pass
+        encoded = b''.join(
+            self.encoded[name] for name in self.names
+            if names is None or name in names)
+        if len(self._selections) >= self.max_cached_selections:
+            self._selections.clear()
+        self._selections[names] = encoded
+        return encoded
+
+
+def filter_attributes(attributes, names):
+    """Keep only the attributes in names, and the ones every response needs"""
+    if names is None:
+        return attributes
+    return dict(
+        (key, value) for key, value in attributes.items()
+        if key[1] in names or key[1] in _ALWAYS_SENT)
+
+
+_ALWAYS_SENT = frozenset([b'attributes-charset', b'attributes-natural-language'])
+
+
 def read_in_blocks(postscript_file):
     while True:
         block = postscript_file.read(1024)
@@ -49,13 +180,51 @@ def prepare_environment(ipp_request):
 
 
 class Behaviour(object):
-    """Do anything in response to IPP requests"""
+    """Do anything in response to IPP requests.
+
+    Things worked out from the configuration (the ppd, printer_uri and
+    so on), like the PPD page and the encoded printer attributes, are
+    made once and cached. Call invalidate_caches() after changing the
+    configuration of a printer which is already serving requests.
+    """
     version = (1, 1)
+    # Set on each instance by PrinterQueues, when serving several printers
     base_uri = b'ipp://localhost:1234/'
     printer_uri = b'ipp://localhost:1234/printer'
+    printer_name = b'ipp-printer.py'
+
+    # The caches, so they are there even if a subclass's __init__ does
+    # not call this one's
+    _commands = None
+    _printer_attributes_template = None
+    _ppd_page = None
 
-    def __init__(self, ppd=BasicPostscriptPPD()):
+    def __init__(self, ppd=BasicPostscriptPPD(), job_store=None):
         self.ppd = ppd
+        self.job_store = MemoryJobStore() if job_store is None else job_store
+        # A JobSpooler, to process print jobs after replying to the client
+        self.job_spooler = None
+
+    def invalidate_caches(self):
+        """Forget everything worked out from the configuration.
+
+        Subclasses which cache more should extend this, and call it when
+        their own configuration changes.
+        """
+        self._commands = None
+        self._printer_attributes_template = None
+        self._ppd_page = None
+
+    def ppd_page(self):
+        """The PPD as a StaticPage, generated once"""
+        if self._ppd_page is None:
+            self._ppd_page = StaticPage(self.ppd.text())
+        return self._ppd_page
+
+    def behaviour_for_path(self, _path):
+        """The Behaviour to handle requests for path: this one printer
+        handles them all (see PrinterQueues)"""
+        return self
 
     def expect_page_data_follows(self, ipp_request):
         return ipp_request.opid_or_status == OperationEnum.print_job
@@ -68,7 +237,18 @@ class Behaviour(object):
             'IPP %r -> %s.%s', ipp_request.opid_or_status, type(self).__name__,
             command_function.__name__
         )
-        return command_function(ipp_request, postscript_file)
+        operation = metrics.enum_label(OperationEnum, ipp_request.opid_or_status)
+        status = 'exception'
+        started = time.time()
+        try:
+            with tracing.span('dispatch'):
+                response = command_function(ipp_request, postscript_file)
+            status = metrics.enum_label(StatusCodeEnum, response.opid_or_status)
+            return response
+        finally:
+            metrics.IPP_REQUEST_DURATION.observe(
+                time.time() - started, (operation,))
+            metrics.IPP_REQUESTS.inc(labels=(operation, status))
 
     def get_handle_command_function(self, opid_or_status):
         raise NotImplementedError()
@@ -97,9 +277,30 @@ class StatelessPrinter(Behaviour):
     The printer calls handle_postscript() for each print job.
     It says all print jobs succeed immediately: there are some stub functions like create_job() which subclasses could use to keep track of jobs, eg: if operation_get_jobs_response wants to return something sensible.
     """
+    # Printer attributes in the job-template group (rfc2911 section 4.2),
+    # eg: b'copies-default'. Everything else is printer-description.
+    job_template_printer_attributes = frozenset()
+    # Encode printer_list_attributes() once, until invalidate_caches(),
+    # taking only printer_status_attributes() afresh for each request.
+    # None means only if printer_list_attributes() is not overridden: a
+    # subclass's may change from one request to the next, or give its own
+    # printer-state. Subclasses whose own is constant may set this True.
+    cache_printer_attributes = None
 
     def get_handle_command_function(self, opid_or_status):
-        commands = {
+        commands = self._commands
+        if commands is None:
+            commands = self._commands = self.handle_command_functions()
+
+        try:
+            command_function = commands[opid_or_status]
+        except KeyError:
+            logging.warn('Operation not supported 0x%04x', opid_or_status)
+            command_function = self.operation_not_implemented_response
+        return command_function
+
+    def handle_command_functions(self):
+        return {
             OperationEnum.get_printer_attributes: self.operation_printer_list_response,
             OperationEnum.cups_list_all_printers: self.operation_printer_list_response,
             OperationEnum.cups_get_default: self.operation_printer_list_response,
@@ -110,13 +311,6 @@ class StatelessPrinter(Behaviour):
             0x0d0a: self.operation_misidentified_as_http,
         }
 
-        try:
-            command_function = commands[opid_or_status]
-        except KeyError:
-            logging.warn('Operation not supported 0x%04x', opid_or_status)
-            command_function = self.operation_not_implemented_response
-        return command_function
-
     def operation_not_implemented_response(self, req, _psfile):
         attributes = self.minimal_attributes()
         return IppRequest(
@@ -127,15 +321,25 @@ class StatelessPrinter(Behaviour):
             attributes)
 
     def operation_printer_list_response(self, req, _psfile):
-        attributes = self.printer_list_attributes()
+        template = self.printer_attributes_template()
+        names = template.select(requested_attributes(req))
+        parts = [template.encoded_group(names)]
+        if template.status_keys:
+            status_attributes = filter_attributes(
+                self.printer_status_attributes(), names)
+            encode_attributes(parts, status_attributes, status_attributes)
         return IppRequest(
             self.version,
             StatusCodeEnum.ok,
             req.request_id,
-            attributes)
+            dict(template.attributes),
+            [(SectionEnum.printer, b''.join(parts))])
 
     def operation_validate_job_response(self, req, _psfile):
-        # TODO this just pretends it's ok!
+        unsupported = self.unsupported_compression_response(req)
+        if unsupported is not None:
+            return unsupported
+        # TODO this just pretends everything else is ok!
         attributes = self.minimal_attributes()
         return IppRequest(
             self.version,
@@ -144,23 +348,83 @@ class StatelessPrinter(Behaviour):
             attributes)
 
     def operation_get_jobs_response(self, req, _psfile):
-        # an empty list of jobs, which probably breaks the rfc
-        # if the client asked for completed jobs
-        # https://tools.ietf.org/html/rfc2911#section-3.2.6.2
-        attributes = self.minimal_attributes()
+        # https://tools.ietf.org/html/rfc2911#section-3.2.6
+        which_jobs = get_optional(
+            req, SectionEnum.operation, b'which-jobs', TagEnum.keyword,
+            b'not-completed').decode('ascii')
+        if which_jobs not in WHICH_JOBS:
+            return IppRequest(
+                self.version,
+                StatusCodeEnum.client_error_attributes_or_values_not_supported,
+                req.request_id,
+                self.minimal_attributes())
+
+        my_jobs = get_optional(
+            req, SectionEnum.operation, b'my-jobs', TagEnum.boolean)
+        if my_jobs is not None and Boolean.from_bytes(my_jobs).boolean:
+            user = get_optional(
+                req, SectionEnum.operation, b'requesting-user-name',
+                TagEnum.name_without_language)
+            if user is None:
+                # Without a user name, my-jobs would list everyone's jobs
+                return self.bad_request_response(req)
+        else:
+            user = None
+
+        limit = get_optional(
+            req, SectionEnum.operation, b'limit', TagEnum.integer)
+        if limit is not None:
+            limit = Integer.from_bytes(limit).integer
+            # https://tools.ietf.org/html/rfc8011#section-4.2.6.1
+            if limit < 1:
+                return self.bad_request_response(req)
+
+        try:
+            req.lookup(SectionEnum.operation, b'requested-attributes', TagEnum.keyword)
+        except KeyError:
+            names = frozenset([b'job-uri', b'job-id'])
+        else:
+            names = self.select_job_attributes(requested_attributes(req))
+
+        groups = []
+        for job in self.job_store.list_jobs(which_jobs, user, limit):
+            attributes = filter_attributes(self.print_job_attributes(
+                job.job_id, job.state, JOB_STATE_REASONS[job.state], job,
+                section=SectionEnum.job), names)
+            parts = []
+            encode_attributes(parts, attributes, [
+                key for key in attributes if key[0] == SectionEnum.job])
+            groups.append((SectionEnum.job, b''.join(parts)))
+
         return IppRequest(
             self.version,
             StatusCodeEnum.ok,
             req.request_id,
-            attributes)
+            self.minimal_attributes(),
+            groups)
 
     def operation_print_job_response(self, req, psfile):
+        unsupported = self.unsupported_compression_response(req)
+        if unsupported is not None:
+            return unsupported
         job_id = self.create_job(req)
+        if self.job_spooler is None:
+            # process_job aborts the job if these are raised
+            try:
+                self.process_job(job_id, req, psfile)
+            except zlib.error as e:
+                logging.warning('Could not decompress job %s: %s', job_id, e)
+                return self.job_failed_response(
+                    req, job_id, StatusCodeEnum.client_error_compression_error)
+            except ExecutorBusy as e:
+                logging.warning('Job %s: %s', job_id, e)
+                return self.job_failed_response(
+                    req, job_id, StatusCodeEnum.server_error_busy)
+        else:
+            self.spool_job(job_id, req, psfile)
+        job = self.job_store.get_job(job_id)
         attributes = self.print_job_attributes(
-            job_id, JobStateEnum.pending,
-            [b'job-incoming', b'job-data-insufficient']
-        )
-        self.handle_postscript(req, psfile)
+            job_id, job.state, JOB_STATE_REASONS[job.state], job)
         return IppRequest(
             self.version,
             StatusCodeEnum.ok,
@@ -172,17 +436,67 @@ class StatelessPrinter(Behaviour):
         # https://tools.ietf.org/html/rfc2911#section-4.3
 
         job_id = get_job_id(req)
+        try:
+            job = self.job_store.get_job(job_id)
+        except KeyError:
+            return IppRequest(
+                self.version,
+                StatusCodeEnum.client_error_not_found,
+                req.request_id,
+                self.minimal_attributes())
         attributes = self.print_job_attributes(
             job_id,
-            JobStateEnum.completed,
-            [b'none']
+            job.state,
+            JOB_STATE_REASONS[job.state],
+            job
         )
+        attributes = filter_attributes(
+            attributes, self.select_job_attributes(requested_attributes(req)))
         return IppRequest(
             self.version,
             StatusCodeEnum.ok,
             req.request_id,
             attributes)
 
+    def job_failed_response(self, req, job_id, status):
+        job = self.job_store.get_job(job_id)
+        return IppRequest(
+            self.version,
+            status,
+            req.request_id,
+            self.print_job_attributes(
+                job_id, job.state, JOB_STATE_REASONS[job.state], job))
+
+    def busy_response(self, req):
+        return IppRequest(
+            self.version,
+            StatusCodeEnum.server_error_busy,
+            req.request_id,
+            self.minimal_attributes())
+
+    def bad_request_response(self, req):
+        return IppRequest(
+            self.version,
+            StatusCodeEnum.client_error_bad_request,
+            req.request_id,
+            self.minimal_attributes())
+
+    def unsupported_compression_response(self, req):
+        """The error response if the document is compressed in a way we
+        can't read, otherwise None"""
+        compression = document_compression(req)
+        if compression in COMPRESSION_SUPPORTED:
+            return None
+        attributes = self.minimal_attributes()
+        attributes[
+            SectionEnum.unsupported, b'compression', TagEnum.keyword
+        ] = [compression]
+        return IppRequest(
+            self.version,
+            StatusCodeEnum.client_error_compression_not_supported,
+            req.request_id,
+            attributes)
+
     def operation_misidentified_as_http(self, _req, _psfile):
         raise Exception("The opid for this operation is \\r\\n, which suggests the request was actually a http request.")
 
@@ -204,7 +518,9 @@ class StatelessPrinter(Behaviour):
         }
 
     def printer_list_attributes(self):
-        attr = {
+        # attributes-charset and attributes-natural-language must come first
+        attr = self.minimal_attributes()
+        attr.update({
             # rfc2911 section 4.4
             (
                 SectionEnum.printer,
@@ -225,7 +541,7 @@ class StatelessPrinter(Behaviour):
                 SectionEnum.printer,
                 b'printer-name',
                 TagEnum.name_without_language
-            ): [b'ipp-printer.py'],
+            ): [self.printer_name],
             (
                 SectionEnum.printer,
                 b'printer-info',
@@ -236,11 +552,6 @@ class StatelessPrinter(Behaviour):
                 b'printer-make-and-model',
                 TagEnum.text_without_language
             ): [b'h2g2bob\'s ipp-printer.py 0.00'],
-            (
-                SectionEnum.printer,
-                b'printer-state',
-                TagEnum.enum
-            ): [Enum(3).bytes()],  # XXX 3 is idle
             (
                 SectionEnum.printer,
                 b'printer-state-reasons',
@@ -304,11 +615,6 @@ class StatelessPrinter(Behaviour):
                 b'printer-is-accepting-jobs',
                 TagEnum.boolean
             ): [Boolean(True).bytes()],
-            (
-                SectionEnum.printer,
-                b'queued-job-count',
-                TagEnum.integer
-            ): [b'\x00\x00\x00\x00'],
             (
                 SectionEnum.printer,
                 b'pdl-override-supported',
@@ -316,40 +622,114 @@ class StatelessPrinter(Behaviour):
             ): [b'not-attempted'],
             (
                 SectionEnum.printer,
-                b'printer-up-time',
+                b'compression-supported',
+                TagEnum.keyword
+            ): list(COMPRESSION_SUPPORTED),
+        })
+        attr.update(self.printer_status_attributes())
+        return attr
+
+    def printer_status_attributes(self):
+        """The printer attributes which change while the printer is running.
+
+        These are left out of a cached printer_attributes_template(), and
+        taken afresh for each request.
+        """
+        return {
+            (
+                SectionEnum.printer,
+                b'printer-state',
+                TagEnum.enum
+            ): [Enum(self.printer_state()).bytes()],
+            (
+                SectionEnum.printer,
+                b'queued-job-count',
                 TagEnum.integer
-            ): [Integer(self.printer_uptime()).bytes()],
+            ): [Integer(self.queued_job_count()).bytes()],
             (
                 SectionEnum.printer,
-                b'compression-supported',
-                TagEnum.keyword
-            ): [b'none'],
+                b'printer-up-time',
+                TagEnum.integer
+            ): [Integer(self.printer_uptime()).bytes()],
         }
-        attr.update(self.minimal_attributes())
-        return attr
 
-    def print_job_attributes(self, job_id, state, state_reasons):
+    def printer_attributes_template(self):
+        """A PrinterAttributesTemplate from printer_list_attributes().
+
+        It is made once and reused until invalidate_caches(), unless
+        caches_printer_attributes() is False: then it is made for each
+        request, status attributes and all.
+        """
+        template = self._printer_attributes_template
+        if template is None:
+            if not self.caches_printer_attributes():
+                return PrinterAttributesTemplate(
+                    self.printer_list_attributes(), (),
+                    self.job_template_printer_attributes)
+            template = self._printer_attributes_template = PrinterAttributesTemplate(
+                self.printer_list_attributes(),
+                self.printer_status_attributes().keys(),
+                self.job_template_printer_attributes)
+        return template
+
+    def caches_printer_attributes(self):
+        if self.cache_printer_attributes is not None:
+            return self.cache_printer_attributes
+        return type(self).printer_list_attributes is StatelessPrinter.printer_list_attributes
+
+    def select_job_attributes(self, requested):
+        """Expand group keywords like job-description in requested"""
+        if requested is None or b'job-description' in requested:
+            # all of the job attributes we have are job description attributes
+            return None
+        return requested
+
+    def printer_state(self):
+        if self.queued_job_count():
+            return PrinterStateEnum.processing
+        return PrinterStateEnum.idle
+
+    def queued_job_count(self):
+        return self.job_store.count_jobs('not-completed')
+
+    def print_job_attributes(self, job_id, state, state_reasons, job=None,
+                             section=SectionEnum.operation):
+        """The attributes of a job.
+
+        Pass the Job from the job store to include its name, user and times.
+        """
         # state reasons come from rfc2911 section 4.3.8
         job_uri = b'%sjob/%d' % (self.base_uri, job_id,)
-        attr = {
+        if job is None:
+            job_name = b'Print job %s' % Integer(job_id).bytes()
+            user_name = b'job-originating-user-name'
+            times = (0, 0, 0)
+        else:
+            job_name = job.name or b'Print job %d' % (job_id,)
+            user_name = job.user or b'job-originating-user-name'
+            times = (job.time_created, job.time_processing, job.time_completed)
+        time_created, time_processing, time_completed = [
+            Integer(t or 0).bytes() for t in times]
+        attr = self.minimal_attributes()
+        attr.update({
             # Required for print-job:
             (
-                SectionEnum.operation,
+                section,
                 b'job-uri',
                 TagEnum.uri
             ): [job_uri],
             (
-                SectionEnum.operation,
+                section,
                 b'job-id',
                 TagEnum.integer
             ): [Integer(job_id).bytes()],
             (
-                SectionEnum.operation,
+                section,
                 b'job-state',
                 TagEnum.enum
             ): [Enum(state).bytes()],
             (
-                SectionEnum.operation,
+                section,
                 b'job-state-reasons',
                 TagEnum.keyword
             ): state_reasons,
@@ -357,54 +737,159 @@ class StatelessPrinter(Behaviour):
             # Required for get-job-attributes:
 
             (
-                SectionEnum.operation,
+                section,
                 b'job-printer-uri',
                 TagEnum.uri
             ): [self.printer_uri],
             (
-                SectionEnum.operation,
+                section,
                 b'job-name',
                 TagEnum.name_without_language
-            ): [b'Print job %s' % Integer(job_id).bytes()],
+            ): [job_name],
             (
-                SectionEnum.operation,
+                section,
                 b'job-originating-user-name',
                 TagEnum.name_without_language
-            ): [b'job-originating-user-name'],
+            ): [user_name],
             (
-                SectionEnum.operation,
+                section,
                 b'time-at-creation',
                 TagEnum.integer
-            ): [b'\x00\x00\x00\x00'],
+            ): [time_created],
             (
-                SectionEnum.operation,
+                section,
                 b'time-at-processing',
                 TagEnum.integer
-            ): [b'\x00\x00\x00\x00'],
+            ): [time_processing],
             (
-                SectionEnum.operation,
+                section,
                 b'time-at-completed',
                 TagEnum.integer
-            ): [b'\x00\x00\x00\x00'],
+            ): [time_completed],
             (
-                SectionEnum.operation,
+                section,
                 b'job-printer-up-time',
                 TagEnum.integer
             ): [Integer(self.printer_uptime()).bytes()]
-        }
-        attr.update(self.minimal_attributes())
+        })
         return attr
 
     def printer_uptime(self):
         return int(time.time())
 
     def create_job(self, req):
-        """Return a job id.
-
-        The StatelessPrinter does not care about the id, but perhaps
-        it can be subclassed into something that keeps track of jobs.
+        """Record a new job in the job store, and return its id"""
+        job = self.job_store.create_job(
+            user=get_optional(
+                req, SectionEnum.operation, b'requesting-user-name',
+                TagEnum.name_without_language),
+            name=get_optional(
+                req, SectionEnum.operation, b'job-name',
+                TagEnum.name_without_language))
+        return job.job_id
+
+    def spool_job(self, job_id, ipp_request, postscript_file):
+        """Save the document, to be processed by the job_spooler later.
+
+        The spool file starts with a line of JSON saying which job it is
+        for, then the IPP request, so recover_spooled_jobs() can process
+        it if this process stops first.
         """
-        return random.randint(1,9999)
+        header = json.dumps({
+            'job_id': job_id,
+            'job_key': self.job_store.job_key(job_id),
+            'printer_uri': self.printer_uri.decode('utf-8'),
+        }).encode('utf-8') + b'\n' + ipp_request.to_string()
+        try:
+            filename = self.job_spooler.spool(postscript_file, header)
+        except Exception:
+            self.job_store.set_state(job_id, JobStateEnum.aborted)
+            raise
+        self.job_spooler.submit(
+            self.process_spooled_job, job_id, ipp_request, filename, len(header))
+
+    def process_spooled_job(self, job_id, ipp_request, filename, offset):
+        try:
+            with open(filename, 'rb') as spoolfile:
+                spoolfile.seek(offset)
+                self.process_job(job_id, ipp_request, spoolfile)
+        finally:
+            self.job_spooler.done(filename)
+
+    def recover_spooled_jobs(self):
+        """Process the jobs which were spooled by an earlier run of the
+        server (or a worker process which died), but never processed.
+
+        Jobs are processed under their own ids if the job store still
+        has them. Otherwise (eg: they were kept in memory, or in the
+        temporary database of an earlier --workers run) they are processed
+        as new jobs: the job with the same id, if any, is another job.
+        """
+        for filename, complete in self.job_spooler.recover():
+            try:
+                with open(filename, 'rb') as spoolfile:
+                    header = json.loads(spoolfile.readline().decode('utf-8'))
+                    if header['printer_uri'].encode('utf-8') != self.printer_uri:
+                        # Spooled by another queue sharing the directory
+                        self.job_spooler.release(filename)
+                        continue
+                    job = self.recovered_job(header)
+                    if not complete or (job is not None and job.is_completed):
+                        # The client was never told it had been received,
+                        # or it was processed but not deleted
+                        if job is not None and not job.is_completed:
+                            self.job_store.set_state(job.job_id, JobStateEnum.aborted)
+                        self.job_spooler.done(filename)
+                        continue
+                    ipp_request = IppRequest.from_file(spoolfile)
+                    offset = spoolfile.tell()
+            except Exception:
+                logging.exception('Could not recover spooled job %r', filename)
+                self.job_spooler.release(filename)
+                continue
+            job_id = self.create_job(ipp_request) if job is None else job.job_id
+            logging.info('Recovered spooled job %s from %r', job_id, filename)
+            self.job_spooler.submit(
+                self.process_spooled_job, job_id, ipp_request, filename, offset)
+
+    def recovered_job(self, header):
+        """The Job in the job store a spool file is for, or None if the
+        job store has forgotten it"""
+        job_id = header['job_id']
+        if self.job_store.job_key(job_id) != header['job_key']:
+            # Spooled with another job store, which gave the id to
+            # another job
+            return None
+        try:
+            return self.job_store.get_job(job_id)
+        except KeyError:
+            return None
+
+    def process_job(self, job_id, ipp_request, postscript_file):
+        """Run handle_postscript(), keeping the job store up to date"""
+        self.job_store.set_state(job_id, JobStateEnum.processing)
+        document = CountingReader(
+            self.decompressed(ipp_request, postscript_file))
+        try:
+            with tracing.span('handle_postscript'):
+                self.handle_job(job_id, ipp_request, document)
+        except Exception:
+            self.job_store.set_state(job_id, JobStateEnum.aborted)
+            raise
+        finally:
+            self.job_store.set_size(job_id, document.bytes_read)
+        self.job_store.set_state(job_id, JobStateEnum.completed)
+
+    def decompressed(self, ipp_request, postscript_file):
+        """The document to pass to handle_job()"""
+        compression = document_compression(ipp_request)
+        if compression == b'none':
+            return postscript_file
+        return DecompressingReader(postscript_file, compression)
+
+    def handle_job(self, job_id, ipp_request, postscript_file):
+        """Process the document for a job: by default, handle_postscript()"""
+        self.handle_postscript(ipp_request, postscript_file)
 
     def handle_postscript(self, ipp_request, postscript_file):
         raise NotImplementedError
@@ -431,6 +916,7 @@ class RejectAllPrinter(StatelessPrinter):
 
     def operation_print_job_response(self, req, _psfile):
         job_id = self.create_job(req)
+        self.job_store.set_state(job_id, JobStateEnum.aborted)
         attributes = self.print_job_attributes(
             job_id, JobStateEnum.aborted, [b'job-canceled-at-device']
         )
@@ -453,31 +939,89 @@ class RejectAllPrinter(StatelessPrinter):
 
 
 class SaveFilePrinter(StatelessPrinter):
-    def __init__(self, directory, filename_ext):
+    # Reserve the disk space for a job before writing it, if we know its size
+    preallocate = True
+
+    def __init__(self, directory, filename_ext, job_store=None,
+                 durability=None, deduplicate=False, layout=None,
+                 keep_compressed=False):
         self.directory = directory
         self.filename_ext = filename_ext
+        # Save gzip or deflate documents as they were sent, eg: as job.ps.gz
+        self.keep_compressed = keep_compressed
+        # When to fsync saved files: see ippserver.durability
+        self.durability = NoSync() if durability is None else durability
+        # Which subdirectory files are saved in: see ippserver.layout
+        self.layout = FlatLayout() if layout is None else layout
+        # Where each job was saved, if the layout makes that hard to guess
+        self.index = JobPathIndex(directory) if self.layout.sharded else None
+        # Store each distinct document once: see ippserver.archive
+        self.archive = None
+        if deduplicate:
+            self.archive = DocumentArchive(
+                directory, filename_ext, durability=self.durability,
+                layout=self.layout, index=self.index)
 
         ppd = {
             'ps': BasicPostscriptPPD(),
             'pdf': BasicPdfPPD(),
         }[filename_ext]
 
-        super(SaveFilePrinter, self).__init__(ppd=ppd)
+        super(SaveFilePrinter, self).__init__(ppd=ppd, job_store=job_store)
+
+    def decompressed(self, ipp_request, postscript_file):
+        if self.keep_compressed:
+            return postscript_file
+        return super(SaveFilePrinter, self).decompressed(
+            ipp_request, postscript_file)
+
+    def compressed_suffix(self, ipp_request):
+        """The filename suffix for a document we did not decompress"""
+        if not self.keep_compressed:
+            return ''
+        return FILENAME_SUFFIXES[document_compression(ipp_request)]
+
+    def handle_job(self, job_id, ipp_request, postscript_file):
+        self.save(job_id, ipp_request, postscript_file)
 
     def handle_postscript(self, ipp_request, postscript_file):
-        filename = self.filename(ipp_request)
-        logging.info('Saving print job as %r', filename)
-        with open(filename, 'wb') as diskfile:
-            for block in read_in_blocks(postscript_file):
-                diskfile.write(block)
+        self.save(None, ipp_request, postscript_file)
+
+    def save(self, job_id, ipp_request, postscript_file):
+        if self.archive is not None:
+            job = None if job_id is None else self.job_store.get_job(job_id)
+            filename = self.archive.store(
+                job_id, postscript_file, job,
+                suffix=self.compressed_suffix(ipp_request),
+                key=None if job_id is None else self.job_store.job_key(job_id)).path
+            logging.info('Archived print job %s as %r', job_id, filename)
+        else:
+            filename = self.filename(ipp_request)
+            logging.info('Saving print job as %r', filename)
+            with open(filename, 'wb') as diskfile:
+                if self.preallocate:
+                    preallocate(diskfile.fileno(), remaining_length(postscript_file))
+                copy_to_fd(postscript_file, diskfile.fileno())
+                self.durability.sync(diskfile.fileno(), filename)
+            if self.index is not None and job_id is not None:
+                self.index.add(self.job_store.job_key(job_id), filename)
         self.run_after_saving(filename, ipp_request)
 
+    def document_path(self, job_id):
+        """Where the document for a job was saved, or raise KeyError"""
+        if self.archive is not None:
+            return self.archive.lookup(self.job_store.job_key(job_id)).path
+        if self.index is None:
+            raise KeyError(job_id)
+        return self.index.lookup(self.job_store.job_key(job_id))
+
     def run_after_saving(self, filename, ipp_request):
         pass
 
     def filename(self, ipp_request):
-        leaf = self.leaf_filename(ipp_request)
-        return os.path.join(self.directory, leaf)
+        leaf = self.leaf_filename(ipp_request) + self.compressed_suffix(ipp_request)
+        return make_path(
+            self.directory, self.layout, leaf, durability=self.durability)
 
     def leaf_filename(self, _ipp_request):
         # Possibly use the job name from the ipp_request?
@@ -485,56 +1029,56 @@ class SaveFilePrinter(StatelessPrinter):
 
 
 class SaveAndRunPrinter(SaveFilePrinter):
-    def __init__(self, directory, use_env, filename_ext, command):
+    def __init__(self, directory, use_env, filename_ext, command,
+                 job_store=None, durability=None, executor=None,
+                 deduplicate=False, layout=None, keep_compressed=False):
         self.command = command
         self.use_env = use_env
+        # Limits how many commands run at once: see ippserver.executor
+        self.executor = CommandExecutor(command) if executor is None else executor
         super(SaveAndRunPrinter, self).__init__(
-            directory=directory, filename_ext=filename_ext
+            directory=directory, filename_ext=filename_ext,
+            job_store=job_store, durability=durability,
+            deduplicate=deduplicate, layout=layout,
+            keep_compressed=keep_compressed
         )
 
+    def save(self, job_id, ipp_request, postscript_file):
+        # Take a turn to run the command first: if there won't be one,
+        # the document is not read, and nothing is left on disk
+        with self.executor.slot():
+            super(SaveAndRunPrinter, self).save(job_id, ipp_request, postscript_file)
+
     def run_after_saving(self, filename, ipp_request):
-        proc = subprocess.Popen(self.command + [filename],
-            env=prepare_environment(ipp_request) if self.use_env else None
-        )
-        proc.communicate()
-        if proc.returncode:
-            raise RuntimeError(
-                'The command %r exited with code %r',
-                self.command,
-                proc.returncode
-            )
+        self.executor.run(
+            [filename],
+            env=prepare_environment(ipp_request) if self.use_env else None)
 
 
 class RunCommandPrinter(StatelessPrinter):
-    def __init__(self, command, use_env, filename_ext):
+    def __init__(self, command, use_env, filename_ext, job_store=None,
+                 executor=None):
         self.command = command
         self.use_env = use_env
+        # Limits how many commands run at once: see ippserver.executor
+        self.executor = CommandExecutor(command) if executor is None else executor
 
         ppd = {
             'ps': BasicPostscriptPPD(),
             'pdf': BasicPdfPPD(),
         }[filename_ext]
 
-        super(RunCommandPrinter, self).__init__(ppd=ppd)
+        super(RunCommandPrinter, self).__init__(ppd=ppd, job_store=job_store)
 
     def handle_postscript(self, ipp_request, postscript_file):
         logging.info('Running command for job')
-        proc = subprocess.Popen(
-            self.command,
+        self.executor.run(
             env=prepare_environment(ipp_request) if self.use_env else None,
-            stdin=subprocess.PIPE)
-        data = b''.join(read_in_blocks(postscript_file))
-        proc.communicate(data)
-        if proc.returncode:
-            raise RuntimeError(
-                'The command %r exited with code %r',
-                self.command,
-                proc.returncode
-            )
+            document=postscript_file)
 
 
 class PostageServicePrinter(StatelessPrinter):
-    def __init__(self, service_api, filename_ext):
+    def __init__(self, service_api, filename_ext, job_store=None):
         self.service_api = service_api
         self.filename_ext = filename_ext
 
@@ -543,10 +1087,10 @@ class PostageServicePrinter(StatelessPrinter):
             'pdf': BasicPdfPPD(),
         }[filename_ext]
 
-        super(PostageServicePrinter, self).__init__(ppd=ppd)
+        super(PostageServicePrinter, self).__init__(ppd=ppd, job_store=job_store)
 
     def handle_postscript(self, _ipp_request, postscript_file):
-        filename = b'ipp-server-{}.{}'.format(
+        filename = 'ipp-server-{}.{}'.format(
             int(time.time()),
             self.filename_ext)
         data = b''.join(read_in_blocks(postscript_file))
@@ -0,0 +1,81 @@
+from __future__ import division
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import zlib
+
+from .streams import COPY_BUFFER_SIZE
+
+
+# https://tools.ietf.org/html/rfc2911#section-4.4.32
+COMPRESSION_SUPPORTED = (b'none', b'gzip', b'deflate')
+
+# zlib wbits for each compression: "deflate" is raw RFC 1951 data
+_WBITS = {
+    b'gzip': 16 + zlib.MAX_WBITS,
+    b'deflate': -zlib.MAX_WBITS,
+}
+
+# The filename extension for documents kept compressed
+FILENAME_SUFFIXES = {
+    b'none': '',
+    b'gzip': '.gz',
+    b'deflate': '.deflate',
+}
+
+
+class DecompressingReader(object):
+    """Decompresses a gzip or deflate document as it is read.
+
+    Raises zlib.error if the document is corrupt, or ends before the end
+    of the compressed data. Like gunzip, several gzip members one after
+    another are read as one document; anything after deflate data is an
+    error.
+
+    Each read() returns at most COPY_BUFFER_SIZE bytes, whatever size is
+    asked for: a few kilobytes can decompress to gigabytes. Read until b''.
+    """
+
+    def __init__(self, f, compression):
+        self.f = f
+        self.compression = compression
+        self._decompressor = zlib.decompressobj(_WBITS[compression])
+        # Compressed data which has been read, but not decompressed yet
+        self._pending = b''
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > COPY_BUFFER_SIZE:
+            size = COPY_BUFFER_SIZE
+        elif size == 0:
+            # decompress() would take a max_length of 0 as no limit
+            return b''
+        while True:
+            if self._decompressor.eof:
+                following = self._decompressor.unused_data or self.f.read(COPY_BUFFER_SIZE)
+                if not following:
+                    return b''
+                if self.compression != b'gzip':
+                    raise zlib.error('Data after the end of the compressed document')
+                self._decompressor = zlib.decompressobj(_WBITS[self.compression])
+                self._pending = following
+            if not self._pending:
+                self._pending = self.f.read(COPY_BUFFER_SIZE)
+                if not self._pending:
+                    raise zlib.error('The compressed document is truncated')
+            block = self._decompressor.decompress(self._pending, size)
+            self._pending = self._decompressor.unconsumed_tail
+            if block:
+                return block
+
+    def readinto(self, b):
+        block = self.read(len(b))
+        b[:len(block)] = block
+        return len(block)
+
+    def remaining_length(self):
+        # Not known until the document has been decompressed
+        return None
+
+    def close(self):
+        pass
@@ -55,8 +55,14 @@ class TagEnum(IntEnum):
 class StatusCodeEnum(IntEnum):
     # https://tools.ietf.org/html/rfc2911#section-13.1
     ok = 0x0000
+    client_error_bad_request = 0x0400
+    client_error_not_found = 0x0406
+    client_error_attributes_or_values_not_supported = 0x040b
+    client_error_compression_not_supported = 0x040f
+    client_error_compression_error = 0x0410
     server_error_internal_error = 0x0500
     server_error_operation_not_supported = 0x0501
+    server_error_busy = 0x0507
     server_error_job_canceled = 0x508
 
 
@@ -76,6 +82,13 @@ class OperationEnum(IntEnum):
     cups_list_all_printers = 0x4002
 
 
+class PrinterStateEnum(IntEnum):
+    # https://tools.ietf.org/html/rfc2911#section-4.4.11
+    idle = 3
+    processing = 4
+    stopped = 5
+
+
 class JobStateEnum(IntEnum):
     # https://tools.ietf.org/html/rfc2911#section-4.3.7
     pending = 3
@@ -0,0 +1,135 @@
+from __future__ import division
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import logging
+import os
+import os.path
+import threading
+import time
+
+
+def fsync_directory(directory):
+    """Make sure the entries in a directory are on disk"""
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class NoSync(object):
+    """Leave it to the operating system to write files to disk eventually"""
+
+    def sync(self, fd, filename):
+        pass
+
+    def sync_directory(self, directory):
+        pass
+
+
+class FsyncEachFile(object):
+    """fsync every saved file, and its directory, before replying"""
+
+    def sync(self, fd, filename):
+        os.fsync(fd)
+        fsync_directory(os.path.dirname(os.path.abspath(filename)))
+
+    def sync_directory(self, directory):
+        fsync_directory(directory)
+
+
+class _Batch(object):
+    def __init__(self):
+        self.files = []
+        self.errors = {}
+        self.done = threading.Event()
+
+
+class GroupCommit(object):
+    """fsync files from concurrent jobs together.
+
+    Each caller of sync() waits until the end of the current window. A
+    background thread then fsyncs every file in the batch, and each of
+    their directories once, and wakes all the callers. Writers carry on
+    in parallel: only the wait for the disk is shared.
+
+    Each file still gets its own fsync, as Python has no syncfs(): what
+    is shared is the wait, and the fsync of each directory.
+    """
+
+    def __init__(self, window=0.01):
+        self.window = window
+        self.batches_committed = 0
+        self._condition = threading.Condition()
+        self._batch = _Batch()
+        self._thread = None
+
+    def sync(self, fd, filename):
+        with self._condition:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._committer)
+                self._thread.daemon = True
+                self._thread.start()
+            batch = self._batch
+            batch.files.append((fd, filename))
+            self._condition.notify()
+        batch.done.wait()
+        error = batch.errors.get(fd)
+        if error is not None:
+            raise error
+
+    def sync_directory(self, directory):
+        # New directories are rare (see ippserver.layout), so not batched
+        fsync_directory(directory)
+
+    def _committer(self):
+        while True:
+            with self._condition:
+                while not self._batch.files:
+                    self._condition.wait()
+            time.sleep(self.window)
+            with self._condition:
+                batch, self._batch = self._batch, _Batch()
+            self._commit(batch)
+
+    def _commit(self, batch):
+        # Whatever happens, the callers waiting on the batch must wake
+        try:
+            directories = {}
+            for fd, filename in batch.files:
+                try:
+                    os.fsync(fd)
+                except OSError as e:
+                    batch.errors[fd] = e
+                directory = os.path.dirname(os.path.abspath(filename))
+                directories.setdefault(directory, []).append(fd)
+            for directory, fds in directories.items():
+                try:
+                    fsync_directory(directory)
+                except OSError as e:
+                    for fd in fds:
+                        batch.errors.setdefault(fd, e)
+            self.batches_committed += 1
+        except Exception as e:
+            logging.exception('Group commit failed')
+            for fd, _filename in batch.files:
+                batch.errors.setdefault(fd, e)
+        finally:
+            batch.done.set()
+
+
+DURABILITY_MODES = ('none', 'fsync', 'group')
+
+
+def durability_from_name(name, window=None):
+    if name == 'none':
+        return NoSync()
+    if name == 'fsync':
+        return FsyncEachFile()
+    if name == 'group':
+        if window is None:
+            return GroupCommit()
+        return GroupCommit(window=window)
+    raise ValueError(name)
@@ -0,0 +1,295 @@
+from __future__ import division
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from contextlib import contextmanager
+import errno
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import subprocess
+import threading
+import time
+
+from . import metrics
+from .streams import COPY_BUFFER_SIZE, copy_to_fd
+
+
+class CommandFailed(RuntimeError):
+    pass
+
+
+class CommandTimedOut(CommandFailed):
+    pass
+
+
+class ExecutorBusy(RuntimeError):
+    """Too many jobs are already waiting to run a command"""
+
+
+class _Slots(object):
+    """Lets at most size callers in at once, with max_waiting in a queue"""
+
+    def __init__(self, size, max_waiting):
+        self.size = size
+        self.max_waiting = max_waiting
+        self.running = 0
+        self.waiting = 0
+        self._condition = threading.Condition()
+
+    @contextmanager
+    def slot(self):
+        with self._condition:
+            if self.running >= self.size:
+                if self.waiting >= self.max_waiting:
+                    raise ExecutorBusy(
+                        '%d commands running and %d waiting' % (
+                            self.running, self.waiting))
+                self.waiting += 1
+                metrics.COMMAND_QUEUE_DEPTH.inc()
+                try:
+                    while self.running >= self.size:
+                        self._condition.wait()
+                finally:
+                    self.waiting -= 1
+                    metrics.COMMAND_QUEUE_DEPTH.dec()
+            self.running += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self.running -= 1
+                self._condition.notify()
+
+
+def kill_process_group(proc):
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except OSError as e:
+        if e.errno != errno.ESRCH:
+            raise
+
+
+class _Deadline(object):
+    """Kills a process (and its children) if it runs for too long"""
+
+    def __init__(self, proc, timeout):
+        self.expired = False
+        self._timer = None
+        if timeout is not None:
+            self._timer = threading.Timer(timeout, self._expire, (proc,))
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _expire(self, proc):
+        self.expired = True
+        kill_process_group(proc)
+
+    def cancel(self):
+        if self._timer is not None:
+            self._timer.cancel()
+
+
+class CommandExecutor(object):
+    """Runs a command for each print job.
+
+    At most max_concurrency commands run at once. Up to max_queued more
+    jobs wait for a turn, and any beyond that get ExecutorBusy. Commands
+    running for longer than timeout seconds are killed, along with any
+    processes they started.
+    """
+    max_concurrency = None  # the number of CPUs
+    max_queued = 100
+    timeout = None
+
+    def __init__(self, command, max_concurrency=None, max_queued=None,
+                 timeout=None):
+        self.command = list(command)
+        if max_concurrency is not None:
+            self.max_concurrency = max_concurrency
+        if max_queued is not None:
+            self.max_queued = max_queued
+        if timeout is not None:
+            self.timeout = timeout
+        self._slots = _Slots(
+            self.max_concurrency or multiprocessing.cpu_count(),
+            self.max_queued)
+        # Whether this thread is in slot()
+        self._holding = threading.local()
+
+    def queue_depth(self):
+        """The number of jobs waiting for a command to finish"""
+        return self._slots.waiting
+
+    def running(self):
+        return self._slots.running
+
+    @contextmanager
+    def slot(self):
+        """Wait for a turn to run the command, or raise ExecutorBusy.
+
+        run() within the with block takes this turn, so a job can find out
+        whether it will get one before it does anything else.
+        """
+        if getattr(self._holding, 'slot', False):
+            yield
+            return
+        with self._slots.slot():
+            self._holding.slot = True
+            try:
+                yield
+            finally:
+                self._holding.slot = False
+
+    def run(self, args=(), env=None, document=None):
+        """Run the command with args added, and document on its stdin.
+
+        The timeout includes the time taken to receive the document.
+        """
+        with self.slot():
+            result = 'failed'
+            started = time.time()
+            try:
+                self._run(args, env, document)
+                result = 'ok'
+            except CommandTimedOut:
+                result = 'timeout'
+                raise
+            finally:
+                metrics.COMMAND_DURATION.observe(
+                    time.time() - started, (result,))
+
+    def _run(self, args, env, document):
+        command = self.command + list(args)
+        proc = subprocess.Popen(
+            command, env=env,
+            stdin=None if document is None else subprocess.PIPE,
+            start_new_session=True)
+        deadline = _Deadline(proc, self.timeout)
+        try:
+            if document is not None:
+                try:
+                    # The command gets the document as it arrives
+                    copy_to_fd(document, proc.stdin.fileno())
+                except (IOError, OSError) as e:
+                    if e.errno != errno.EPIPE:
+                        raise
+                    if not deadline.expired:
+                        logging.warning(
+                            'The command %r did not read all of the document',
+                            command)
+                finally:
+                    proc.stdin.close()
+            proc.wait()
+        finally:
+            deadline.cancel()
+        if deadline.expired:
+            raise CommandTimedOut(
+                'The command %r ran for more than %s seconds' % (
+                    command, self.timeout))
+        if proc.returncode:
+            raise CommandFailed(
+                'The command %r exited with code %r' % (
+                    command, proc.returncode))
+
+    def close(self):
+        pass
+
+
+class _WorkerProcess(object):
+    def __init__(self, command):
+        self.proc = subprocess.Popen(
+            command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            start_new_session=True)
+
+    def send_job(self, args, env, document):
+        stdin = self.proc.stdin
+        stdin.write(json.dumps({'args': list(args), 'env': env}).encode('utf-8'))
+        stdin.write(b'\n')
+        if document is not None:
+            while True:
+                block = document.read(COPY_BUFFER_SIZE)
+                if not block:
+                    break
+                stdin.write(b'%x\n' % (len(block),))
+                stdin.write(block)
+        stdin.write(b'0\n')
+        stdin.flush()
+        reply = self.proc.stdout.readline()
+        if not reply:
+            raise EOFError('The worker process exited')
+        return json.loads(reply.decode('utf-8'))['status']
+
+    def close(self):
+        kill_process_group(self.proc)
+        self.proc.stdin.close()
+        self.proc.stdout.close()
+        self.proc.wait()
+
+
+class WorkerProcessExecutor(CommandExecutor):
+    """Sends jobs to long-lived worker processes, instead of running a
+    command per job.
+
+    Each worker is started as command, and is sent one job at a time on
+    its stdin: a line of JSON {"args": [...], "env": {...}} (env holds
+    only the variables which differ from the server's environment), then
+    the document as chunks of "<length in hex>\\n<bytes>", ending with
+    "0\\n". When it has finished the job it replies with a line of JSON
+    {"status": <exit code>} on its stdout.
+
+    Up to max_concurrency workers are started as they are needed. A
+    worker which times out or breaks the protocol is killed, and replaced
+    by the next job which needs one.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(WorkerProcessExecutor, self).__init__(*args, **kwargs)
+        self._lock = threading.Lock()
+        self._idle = []
+
+    def _run(self, args, env, document):
+        if env is not None:
+            env = dict(
+                (key, value) for key, value in env.items()
+                if os.environ.get(key) != value)
+        with self._lock:
+            worker = self._idle.pop() if self._idle else None
+        if worker is None:
+            worker = _WorkerProcess(self.command)
+
+        deadline = _Deadline(worker.proc, self.timeout)
+        try:
+            status = worker.send_job(args, env, document)
+        except BaseException as e:
+            worker.close()
+            if deadline.expired:
+                raise CommandTimedOut(
+                    'The worker %r took more than %s seconds' % (
+                        self.command, self.timeout))
+            if isinstance(e, (IOError, OSError, EOFError, ValueError, KeyError)):
+                raise CommandFailed(
+                    'The worker %r failed: %s' % (self.command, e))
+            raise
+        finally:
+            deadline.cancel()
+
+        if deadline.expired:
+            # Killed just as it finished, so cannot take another job
+            worker.close()
+        else:
+            with self._lock:
+                self._idle.append(worker)
+        if status:
+            raise CommandFailed(
+                'The worker %r failed a job with code %r' % (
+                    self.command, status))
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for worker in idle:
+            worker.close()
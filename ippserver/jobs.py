@@ -0,0 +1,334 @@
+from __future__ import division
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from collections import namedtuple
+import itertools
+import sqlite3
+import threading
+import time
+import uuid
+
+from .constants import JobStateEnum
+
+
+class Job(namedtuple('Job', (
+        'job_id', 'state', 'user', 'name', 'size',
+        'time_created', 'time_processing', 'time_completed'))):
+    """A print job, as recorded by a job store.
+
+    user and name are bytes, as sent in the Print-Job request. The times
+    are seconds since the epoch (like printer_uptime), or None.
+    """
+
+    @property
+    def is_completed(self):
+        return is_completed_state(self.state)
+
+
+def is_completed_state(state):
+    # https://tools.ietf.org/html/rfc2911#section-3.2.6.1
+    # "completed" jobs are the ones which will not change state again
+    return state >= JobStateEnum.canceled
+
+
+WHICH_JOBS = ('not-completed', 'completed', 'all')
+
+
+def check_limit(limit):
+    # SQLite would take a negative limit as no limit, and islice refuse it
+    if limit is not None and limit < 0:
+        raise ValueError('Negative limit %d' % (limit,))
+
+
+class JobStore(object):
+    """Assigns job ids and keeps track of the state of print jobs.
+
+    Jobs which are not completed are listed oldest first (the order they
+    will be printed), and completed jobs most recently completed first.
+    """
+
+    def create_job(self, user, name):
+        """Record a new pending job, and return it"""
+        raise NotImplementedError()
+
+    def get_job(self, job_id):
+        """Return the Job, or raise KeyError"""
+        raise NotImplementedError()
+
+    def job_key(self, job_id):
+        """A name for job_id which no other job has, even one from an
+        earlier run of the server or another job store, for naming files
+        kept for the job"""
+        raise NotImplementedError()
+
+    def set_state(self, job_id, state):
+        raise NotImplementedError()
+
+    def set_size(self, job_id, size):
+        raise NotImplementedError()
+
+    def list_jobs(self, which='not-completed', user=None, limit=None):
+        """The jobs, at most limit of them (which must not be negative)"""
+        raise NotImplementedError()
+
+    def count_jobs(self, which='not-completed', user=None):
+        raise NotImplementedError()
+
+
+class MemoryJobStore(JobStore):
+    """Keeps jobs in memory, forgetting the oldest completed jobs.
+
+    Jobs are indexed by id and by (user, completed), so every operation
+    is O(1), or O(limit) for list_jobs.
+    """
+    max_completed_jobs = 10000
+
+    def __init__(self, max_completed_jobs=None):
+        if max_completed_jobs is not None:
+            self.max_completed_jobs = max_completed_jobs
+        self._lock = threading.Lock()
+        self._next_job_id = 1
+        # Job ids start again at 1 when the server restarts
+        self._run_id = uuid.uuid4().hex
+        self._jobs = {}
+        # {(user or None, is_completed): {job_id: None}}
+        # The inner dicts are used as insertion-ordered sets
+        self._index = {}
+
+    @staticmethod
+    def _index_users(job):
+        if job.user is None:
+            return (None,)
+        return (None, job.user)
+
+    def _index_add(self, job):
+        for user in self._index_users(job):
+            self._index.setdefault((user, job.is_completed), {})[job.job_id] = None
+
+    def _index_remove(self, job):
+        for user in self._index_users(job):
+            key = (user, job.is_completed)
+            del self._index[key][job.job_id]
+            if not self._index[key]:
+                del self._index[key]
+
+    def create_job(self, user, name):
+        with self._lock:
+            job = Job(
+                job_id=self._next_job_id, state=JobStateEnum.pending,
+                user=user, name=name, size=None,
+                time_created=int(time.time()), time_processing=None,
+                time_completed=None)
+            self._next_job_id += 1
+            self._jobs[job.job_id] = job
+            self._index_add(job)
+            return job
+
+    def get_job(self, job_id):
+        return self._jobs[job_id]
+
+    def job_key(self, job_id):
+        return '%s-%s' % (job_id, self._run_id)
+
+    def set_state(self, job_id, state):
+        with self._lock:
+            job = self._jobs[job_id]
+            self._index_remove(job)
+            now = int(time.time())
+            job = job._replace(state=state)
+            if state == JobStateEnum.processing and job.time_processing is None:
+                job = job._replace(time_processing=now)
+            if is_completed_state(state) and job.time_completed is None:
+                job = job._replace(time_completed=now)
+            self._jobs[job_id] = job
+            self._index_add(job)
+            if job.is_completed:
+                self._forget_old_jobs()
+
+    def _forget_old_jobs(self):
+        completed = self._index[None, True]
+        while len(completed) > self.max_completed_jobs:
+            self._index_remove(self._jobs.pop(next(iter(completed))))
+
+    def set_size(self, job_id, size):
+        with self._lock:
+            self._jobs[job_id] = self._jobs[job_id]._replace(size=size)
+
+    def _job_ids(self, which, user):
+        not_completed = self._index.get((user, False), {})
+        completed = self._index.get((user, True), {})
+        if which == 'not-completed':
+            return iter(not_completed)
+        if which == 'completed':
+            return reversed(completed)
+        return itertools.chain(not_completed, reversed(completed))
+
+    def list_jobs(self, which='not-completed', user=None, limit=None):
+        check_limit(limit)
+        with self._lock:
+            return [
+                self._jobs[job_id]
+                for job_id in itertools.islice(self._job_ids(which, user), limit)]
+
+    def count_jobs(self, which='not-completed', user=None):
+        with self._lock:
+            return sum(
+                len(self._index.get((user, completed), ()))
+                for completed in {
+                    'not-completed': (False,),
+                    'completed': (True,),
+                    'all': (False, True),
+                }[which])
+
+
+class SqliteJobStore(JobStore):
+    """Keeps jobs in an SQLite database (in WAL mode).
+
+    The database may be shared by several processes, which will see the
+    same jobs and never reuse a job id. Indexes on (completed, ...) and
+    (user, completed, ...) mean each query is O(log n), or O(log n + limit)
+    for list_jobs.
+    """
+
+    def __init__(self, path, timeout=30):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(
+            path, timeout=timeout, check_same_thread=False,
+            isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        with self._lock:
+            self._db.executescript('''
+                CREATE TABLE IF NOT EXISTS jobs (
+                    job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    state INTEGER NOT NULL,
+                    completed INTEGER NOT NULL,
+                    user BLOB,
+                    name BLOB,
+                    size INTEGER,
+                    time_created INTEGER,
+                    time_processing INTEGER,
+                    time_completed INTEGER,
+                    completed_order INTEGER
+                );
+                CREATE INDEX IF NOT EXISTS jobs_completed
+                    ON jobs (completed, completed_order, job_id);
+                CREATE INDEX IF NOT EXISTS jobs_user_completed
+                    ON jobs (user, completed, completed_order, job_id);
+                CREATE TABLE IF NOT EXISTS store (store_id TEXT NOT NULL);
+            ''')
+            # Job ids start again at 1 in a new database, such as the
+            # temporary one --workers creates on each run
+            self._db.execute(
+                'INSERT INTO store (store_id) SELECT ? '
+                'WHERE NOT EXISTS (SELECT 1 FROM store)', (uuid.uuid4().hex,))
+            self._store_id, = self._db.execute(
+                'SELECT store_id FROM store').fetchone()
+
+    _columns = 'job_id, state, user, name, size, time_created, time_processing, time_completed'
+
+    @staticmethod
+    def _job(row):
+        job_id, state, user, name, size, created, processing, completed = row
+        return Job(
+            job_id, JobStateEnum(state),
+            None if user is None else bytes(user),
+            None if name is None else bytes(name),
+            size, created, processing, completed)
+
+    def create_job(self, user, name):
+        now = int(time.time())
+        with self._lock:
+            cursor = self._db.execute(
+                'INSERT INTO jobs (state, completed, user, name, time_created) '
+                'VALUES (?, 0, ?, ?, ?)',
+                (int(JobStateEnum.pending), user, name, now))
+            job_id = cursor.lastrowid
+        return Job(job_id, JobStateEnum.pending, user, name, None, now, None, None)
+
+    def get_job(self, job_id):
+        with self._lock:
+            row = self._db.execute(
+                'SELECT %s FROM jobs WHERE job_id = ?' % (self._columns,),
+                (job_id,)).fetchone()
+        if row is None:
+            raise KeyError(job_id)
+        return self._job(row)
+
+    def job_key(self, job_id):
+        return '%s-%s' % (job_id, self._store_id)
+
+    def set_state(self, job_id, state):
+        now = int(time.time())
+        completed = is_completed_state(state)
+        with self._lock:
+            cursor = self._db.execute(
+                'UPDATE jobs SET state = ?, completed = ?, '
+                'time_processing = COALESCE(time_processing, ?), '
+                'time_completed = COALESCE(time_completed, ?), '
+                'completed_order = COALESCE(completed_order, CASE WHEN ? '
+                'THEN (SELECT COALESCE(MAX(completed_order), 0) + 1 FROM jobs WHERE completed = 1) END) '
+                'WHERE job_id = ?',
+                (
+                    int(state), int(completed),
+                    now if state == JobStateEnum.processing else None,
+                    now if completed else None,
+                    int(completed),
+                    job_id))
+        if cursor.rowcount == 0:
+            raise KeyError(job_id)
+
+    def set_size(self, job_id, size):
+        with self._lock:
+            cursor = self._db.execute(
+                'UPDATE jobs SET size = ? WHERE job_id = ?', (size, job_id))
+        if cursor.rowcount == 0:
+            raise KeyError(job_id)
+
+    def _select(self, completed, user, limit):
+        query = 'SELECT %s FROM jobs WHERE completed = ?' % (self._columns,)
+        args = [int(completed)]
+        if user is not None:
+            query += ' AND user = ?'
+            args.append(user)
+        if completed:
+            query += ' ORDER BY completed_order DESC'
+        else:
+            query += ' ORDER BY completed_order, job_id'
+        query += ' LIMIT ?'
+        args.append(-1 if limit is None else limit)
+        return [self._job(row) for row in self._db.execute(query, args)]
+
+    def list_jobs(self, which='not-completed', user=None, limit=None):
+        check_limit(limit)
+        with self._lock:
+            jobs = []
+            if which != 'completed':
+                jobs.extend(self._select(False, user, limit))
+            if which != 'not-completed':
+                if limit is not None:
+                    limit -= len(jobs)
+                jobs.extend(self._select(True, user, limit))
+            return jobs
+
+    def count_jobs(self, which='not-completed', user=None):
+        query = 'SELECT COUNT(*) FROM jobs'
+        conditions = []
+        args = []
+        if which != 'all':
+            conditions.append('completed = ?')
+            args.append(int(which == 'completed'))
+        if user is not None:
+            conditions.append('user = ?')
+            args.append(user)
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        with self._lock:
+            return self._db.execute(query, args).fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,140 @@
+from __future__ import division
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import hashlib
+import os
+import os.path
+import sqlite3
+import threading
+import time
+
+
+def make_directories(directory, durability=None):
+    """Make directory and any missing parents. With durability, each
+    new directory's entry in its parent is synced, so files saved in it
+    are not lost along with the directory after a crash."""
+    directory = os.path.abspath(directory)
+    if os.path.isdir(directory):
+        return
+    parent = os.path.dirname(directory)
+    if parent != directory:
+        make_directories(parent, durability)
+    try:
+        os.mkdir(directory)
+    except OSError:
+        # Another thread may have made it
+        if not os.path.isdir(directory):
+            raise
+    if durability is not None:
+        durability.sync_directory(parent)
+
+
+class FlatLayout(object):
+    """Saves every file directly in the directory"""
+    sharded = False
+
+    def subdirectory(self, leaf, when=None):
+        return ''
+
+
+class ShardedLayout(object):
+    """Saves files in subdirectories, so no directory gets too large.
+
+    by_date puts files in YYYY/MM/DD directories (in UTC). hash_levels
+    adds that many levels of directories named by two hex digits of the
+    MD5 of the filename, each splitting the files 256 ways.
+    """
+    sharded = True
+
+    def __init__(self, by_date=True, hash_levels=1):
+        self.by_date = by_date
+        self.hash_levels = hash_levels
+
+    def subdirectory(self, leaf, when=None):
+        parts = []
+        if self.by_date:
+            parts.append(time.strftime(
+                '%Y/%m/%d', time.gmtime(time.time() if when is None else when)))
+        if self.hash_levels:
+            digest = hashlib.md5(leaf.encode('utf-8')).hexdigest()
+            parts.extend(
+                digest[2 * level:2 * level + 2]
+                for level in range(self.hash_levels))
+        return '/'.join(parts)
+
+
+LAYOUTS = ('flat', 'date', 'hash', 'date+hash')
+
+
+def layout_from_name(name):
+    if name == 'flat':
+        return FlatLayout()
+    if name == 'date':
+        return ShardedLayout(by_date=True, hash_levels=0)
+    if name == 'hash':
+        return ShardedLayout(by_date=False, hash_levels=1)
+    if name == 'date+hash':
+        return ShardedLayout(by_date=True, hash_levels=1)
+    raise ValueError(name)
+
+
+def make_path(directory, layout, leaf, when=None, durability=None):
+    """The path for a new file called leaf, creating its directory (see
+    make_directories for durability)"""
+    subdirectory = layout.subdirectory(leaf, when)
+    if subdirectory:
+        directory = os.path.join(directory, *subdirectory.split('/'))
+        make_directories(directory, durability)
+    return os.path.join(directory, leaf)
+
+
+class JobPathIndex(object):
+    """Remembers where each job was saved, in an SQLite database.
+
+    Jobs are identified by JobStore.job_key, not by job id: ids are
+    reused by a new job store, such as after a restart. Paths are stored
+    relative to directory, so the directory can be moved.
+    """
+
+    def __init__(self, directory, filename='index.sqlite', timeout=30):
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(
+            os.path.join(directory, filename), timeout=timeout,
+            check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        with self._lock:
+            self._db.execute('''
+                CREATE TABLE IF NOT EXISTS job_paths (
+                    -- a JobStore.job_key, not a job id
+                    job_id TEXT PRIMARY KEY,
+                    path TEXT NOT NULL
+                )''')
+
+    def add(self, key, path):
+        """Remember path for the job with key (from JobStore.job_key), or
+        raise ValueError if another path already has been"""
+        try:
+            with self._lock:
+                self._db.execute(
+                    'INSERT INTO job_paths (job_id, path) VALUES (?, ?)',
+                    ('%s' % (key,), os.path.relpath(path, self.directory)))
+        except sqlite3.IntegrityError:
+            raise ValueError('Job %s has already been saved' % (key,))
+
+    def lookup(self, key):
+        """Return the path saved for the job with key, or raise KeyError"""
+        with self._lock:
+            row = self._db.execute(
+                'SELECT path FROM job_paths WHERE job_id = ?',
+                ('%s' % (key,),)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return os.path.join(self.directory, row[0])
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,215 @@
+from __future__ import division
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from bisect import bisect_left
+import threading
+
+
+# Seconds, from a fast Get-Printer-Attributes to a large document
+DEFAULT_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+    10.0, 30.0, 60.0)
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        if value == float('inf'):
+            return '+Inf'
+        return repr(value)
+    return '%d' % (value,)
+
+
+def _format_labels(labelnames, labels, extra=()):
+    pairs = list(zip(labelnames, labels)) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % (','.join(
+        '%s="%s"' % (name, _escape('%s' % (value,))) for name, value in pairs),)
+
+
+class Metric(object):
+    """A named value, or one value for each combination of labels.
+
+    labels are passed as a tuple in the same order as labelnames.
+    """
+    type_name = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def render(self):
+        lines = [
+            '# HELP %s %s' % (self.name, self.help),
+            '# TYPE %s %s' % (self.name, self.type_name),
+        ]
+        with self._lock:
+            values = sorted(self._values.items())
+        if not values and not self.labelnames:
+            values = [((), self._initial_value())]
+        for labels, value in values:
+            lines.extend(self._render_value(labels, value))
+        return lines
+
+    def _initial_value(self):
+        return 0
+
+    def _render_value(self, labels, value):
+        return ['%s%s %s' % (
+            self.name, _format_labels(self.labelnames, labels),
+            _format_value(value))]
+
+
+class Counter(Metric):
+    type_name = 'counter'
+
+    def inc(self, amount=1, labels=()):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, labels=()):
+        return self._values.get(labels, 0)
+
+
+class Gauge(Metric):
+    """A value which goes up and down, or is read from function() when
+    the metrics are rendered"""
+    type_name = 'gauge'
+
+    def __init__(self, name, help, labelnames=(), function=None):
+        super(Gauge, self).__init__(name, help, labelnames)
+        self.function = function
+
+    def set(self, value, labels=()):
+        with self._lock:
+            self._values[labels] = value
+
+    def inc(self, amount=1, labels=()):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, amount=1, labels=()):
+        self.inc(-amount, labels)
+
+    def value(self, labels=()):
+        if self.function is not None:
+            return self.function()
+        return self._values.get(labels, 0)
+
+    def render(self):
+        if self.function is not None:
+            self.set(self.function())
+        return super(Gauge, self).render()
+
+
+class Histogram(Metric):
+    type_name = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _initial_value(self):
+        # [count in each bucket (not cumulative)..., sum]
+        return [0] * (len(self.buckets) + 2)
+
+    def observe(self, value, labels=()):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(labels)
+            if counts is None:
+                counts = self._values[labels] = self._initial_value()
+            counts[index] += 1
+            counts[-1] += value
+
+    def count(self, labels=()):
+        counts = self._values.get(labels)
+        return 0 if counts is None else sum(counts[:-1])
+
+    def _render_value(self, labels, counts):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            lines.append('%s_bucket%s %d' % (
+                self.name,
+                _format_labels(self.labelnames, labels, [('le', _format_value(float(bound)))]),
+                cumulative))
+        label_text = _format_labels(self.labelnames, labels)
+        lines.append('%s_sum%s %s' % (self.name, label_text, _format_value(float(counts[-1]))))
+        lines.append('%s_count%s %d' % (self.name, label_text, cumulative))
+        return lines
+
+
+class Registry(object):
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, *args, **kwargs):
+        return self.register(Counter(*args, **kwargs))
+
+    def gauge(self, *args, **kwargs):
+        return self.register(Gauge(*args, **kwargs))
+
+    def histogram(self, *args, **kwargs):
+        return self.register(Histogram(*args, **kwargs))
+
+    def render(self):
+        """The metrics in the Prometheus text exposition format"""
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+REGISTRY = Registry()
+
+IPP_REQUESTS = REGISTRY.counter(
+    'ipp_requests_total', 'IPP requests handled, by operation and status',
+    ('operation', 'status'))
+IPP_REQUEST_DURATION = REGISTRY.histogram(
+    'ipp_request_duration_seconds',
+    'Time taken by Behaviour.handle_ipp, including reading any document',
+    ('operation',))
+BYTES_RECEIVED = REGISTRY.counter(
+    'ipp_received_bytes_total', 'Bytes of HTTP request bodies received')
+ACTIVE_CONNECTIONS = REGISTRY.gauge(
+    'ipp_active_connections', 'Connections currently open')
+SPOOL_QUEUE_DEPTH = REGISTRY.gauge(
+    'ipp_spool_queue_depth', 'Spooled jobs waiting for a background thread')
+COMMAND_QUEUE_DEPTH = REGISTRY.gauge(
+    'ipp_command_queue_depth', 'Jobs waiting for a turn to run a command')
+COMMAND_DURATION = REGISTRY.histogram(
+    'ipp_command_duration_seconds',
+    'Time taken by commands run for print jobs, by result', ('result',))
+
+
+_enum_names = {}
+
+
+def enum_label(enum, value):
+    """The name of an IntEnum member, or its number in hex if it has none"""
+    try:
+        return _enum_names[enum, value]
+    except KeyError:
+        try:
+            name = enum(value).name
+        except ValueError:
+            name = '0x%04x' % (value,)
+        _enum_names[enum, value] = name
+        return name
@@ -6,6 +6,13 @@ from __future__ import unicode_literals
 import struct
 
 
+# Precompiled formats for the fixed-size parts of an IPP message
+header_struct = struct.Struct(b'>bbhi')  # version major, minor, opid/status, request id
+tag_struct = struct.Struct(b'>B')
+length_struct = struct.Struct(b'>h')
+tag_length_struct = struct.Struct(b'>Bh')  # value tag, name length
+
+
 def read_struct(f, fmt):
     sz = struct.calcsize(fmt)
     string = f.read(sz)
@@ -5,12 +5,30 @@ from __future__ import unicode_literals
 
 import json
 import logging
+import threading
 import requests
-from collections import namedtuple
 
 
-class Pc2Paper(namedtuple('Pc2Paper',
-        ('username', 'password', 'name', 'address1', 'address2', 'address3', 'address4', 'postcode', 'country', 'postage', 'paper', 'envelope', 'extras'))):
+DEFAULT_BASE_URL = 'https://www.pc2paper.co.uk/lettercustomerapi.svc/json/'
+
+# The JSON text of each byte value, for encoding documents as arrays of ints
+_BYTE_JSON = [str(i).encode('ascii') for i in range(256)]
+
+
+def json_int_array(data):
+    """Encode bytes as a JSON array of ints, like json.dumps(list(data))"""
+    return b'[' + b','.join(map(_BYTE_JSON.__getitem__, bytearray(data))) + b']'
+
+
+class Pc2Paper(object):
+    """Posts letters with the pc2paper API.
+
+    Uploads from several jobs at once share a pool of HTTP connections,
+    and at most max_parallel_uploads run at a time.
+    """
+    # Uploads to run at once, and HTTP connections to keep open
+    max_parallel_uploads = 4
+
     # From https://www.pc2paper.co.uk/downloads/country.csv
     NUMERIC_COUNTRY_CODES = {
         'UK': 1,
@@ -36,6 +54,31 @@ class Pc2Paper(namedtuple('Pc2Paper',
         'A4': 11,
     }
 
+    def __init__(self, username, password, name, address1, address2,
+                 address3, address4, postcode, country, postage, paper,
+                 envelope, extras, base_url=DEFAULT_BASE_URL):
+        self.username = username
+        self.password = password
+        self.name = name
+        self.address1 = address1
+        self.address2 = address2
+        self.address3 = address3
+        self.address4 = address4
+        self.postcode = postcode
+        self.country = country
+        self.postage = postage
+        self.paper = paper
+        self.envelope = envelope
+        self.extras = extras
+        self.base_url = base_url
+
+        self._session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_maxsize=self.max_parallel_uploads)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+        self._upload_slots = threading.BoundedSemaphore(self.max_parallel_uploads)
+
     @classmethod
     def from_config_file(cls, filename):
         with open(filename) as f:
@@ -53,6 +96,12 @@ class Pc2Paper(namedtuple('Pc2Paper',
 
         return cls(**data)
 
+    def _post(self, method, body):
+        return self._session.post(
+            self.base_url + method,
+            headers={'Content-type': 'application/json'},
+            data=body).json()
+
     def post_pdf_letter(self, filename, pdffile):
         pdf_guid = self._upload_pdf(filename, pdffile)
         self._post_letter(pdf_guid)
@@ -62,13 +111,19 @@ class Pc2Paper(namedtuple('Pc2Paper',
             'username': self.username,
             'password': self.password,
             'filename': filename,
-            'fileContent': [ord(byte) for byte in pdffile],
         }
-        response = requests.post(
-            'https://www.pc2paper.co.uk/lettercustomerapi.svc/json/UploadDocument',
-            headers={'Content-type': 'application/json'},
-            data=json.dumps(post_data))
-        response_data = response.json()
+        # The API is a WCF service, and fileContent a byte[], which WCF's
+        # JSON serializer only reads as an array of numbers: there is no
+        # base64 or other compact form. json.dumps is slow to build the
+        # array from a large document, so it is joined from a table.
+        body = b''.join([
+            json.dumps(post_data)[:-1].encode('utf-8'),
+            b', "fileContent": ',
+            json_int_array(pdffile),
+            b'}',
+        ])
+        with self._upload_slots:
+            response_data = self._post('UploadDocument', body)
         logging.debug('Response to uploading %r is %r', filename, response_data)
         error_messages = response_data['d']['ErrorMessages']
         if error_messages:
@@ -98,11 +153,8 @@ class Pc2Paper(namedtuple('Pc2Paper',
                 'FileAttachementGUIDs': [pdf_guid],
             },
         }
-        response = requests.post(
-            'https://www.pc2paper.co.uk/lettercustomerapi.svc/json/SendSubmitLetterForPosting',
-            headers={'Content-type': 'application/json'},
-            data=json.dumps(post_data))
-        response_data = response.json()
+        response_data = self._post(
+            'SendSubmitLetterForPosting', json.dumps(post_data))
 
         logging.debug('Response to posting %r is %r', pdf_guid, response_data)
         error_messages = response_data['d']['ErrorMessages']
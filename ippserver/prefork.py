@@ -0,0 +1,175 @@
+from __future__ import division
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import logging
+import os
+import signal
+import socket
+import threading
+import time
+
+
+_STOP_SIGNALS = (signal.SIGINT, signal.SIGTERM)
+
+
+def reuse_port_supported():
+    return hasattr(socket, 'SO_REUSEPORT')
+
+
+def bind_socket(address, reuse_port=False, backlog=128):
+    """A TCP socket bound to address, for workers to share.
+
+    Without reuse_port it is listening, and workers accept connections
+    from it. With reuse_port it only holds the port: each worker listens on
+    its own socket bound with SO_REUSEPORT, and the kernel spreads
+    connections between them.
+    """
+    # asyncio only sets TCP_NODELAY on accepted sockets whose proto says TCP
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_TCP)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind(address)
+        if not reuse_port:
+            sock.listen(backlog)
+    except Exception:
+        sock.close()
+        raise
+    return sock
+
+
+def describe_status(status):
+    if os.WIFSIGNALED(status):
+        return 'was killed by signal %d' % (os.WTERMSIG(status),)
+    return 'exited with status %d' % (os.WEXITSTATUS(status),)
+
+
+def _interrupt(_signum, _frame):
+    raise KeyboardInterrupt()
+
+
+class Supervisor(object):
+    """Forks `workers` processes, each of which calls serve(index), and
+    restarts any which exit, until stop() is called.
+
+    Workers ignore SIGINT (so Ctrl-C is handled by the supervisor alone),
+    and SIGTERM raises KeyboardInterrupt in them, which run_server and
+    run_asyncio_server take as the signal to shut down.
+    """
+    # Seconds to wait before restarting a worker which exited within
+    # this long of starting, so a worker which cannot start does not spin
+    restart_delay = 1.0
+    # Seconds to wait for workers to exit after stop() before killing them
+    stop_timeout = 10.0
+
+    def __init__(self, serve, workers, restart_delay=None, stop_timeout=None):
+        self.serve = serve
+        self.workers = workers
+        if restart_delay is not None:
+            self.restart_delay = restart_delay
+        if stop_timeout is not None:
+            self.stop_timeout = stop_timeout
+        # {pid: (index, time started)}
+        self._workers = {}
+        self._stopping = False
+        self._killer = None
+        self.restarts = 0
+
+    def pids(self):
+        return sorted(self._workers)
+
+    def run(self):
+        """Start the workers, and supervise them until they have all
+        exited after stop()"""
+        for index in range(self.workers):
+            self._spawn(index)
+        while self._workers:
+            try:
+                pid, status = os.wait()
+            except OSError:
+                # no children left
+                break
+            index, started = self._workers.pop(pid, (None, None))
+            if index is None or self._stopping:
+                continue
+            logging.warning(
+                'Worker %d (pid %d) %s, restarting it',
+                index, pid, describe_status(status))
+            if time.time() - started < self.restart_delay:
+                time.sleep(self.restart_delay)
+            self.restarts += 1
+            self._spawn(index)
+        if self._killer is not None:
+            self._killer.cancel()
+
+    def _spawn(self, index):
+        # Block the stop signals until the child has replaced the
+        # supervisor's handlers
+        signal.pthread_sigmask(signal.SIG_BLOCK, _STOP_SIGNALS)
+        try:
+            pid = os.fork()
+            if pid == 0:
+                self._run_worker(index)
+            self._workers[pid] = (index, time.time())
+        finally:
+            signal.pthread_sigmask(signal.SIG_UNBLOCK, _STOP_SIGNALS)
+        if self._stopping:
+            self._kill(pid, signal.SIGTERM)
+
+    def _run_worker(self, index):
+        """Run in the forked child: never returns"""
+        status = 1
+        try:
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGTERM, _interrupt)
+            signal.pthread_sigmask(signal.SIG_UNBLOCK, _STOP_SIGNALS)
+            self.serve(index)
+            status = 0
+        except KeyboardInterrupt:
+            status = 0
+        except BaseException:
+            logging.exception('Worker %d failed', index)
+        finally:
+            os._exit(status)
+
+    def stop(self):
+        """Ask the workers to exit, killing any still running after
+        stop_timeout. run() returns once they have all exited."""
+        if self._stopping:
+            return
+        self._stopping = True
+        for pid in list(self._workers):
+            self._kill(pid, signal.SIGTERM)
+        self._killer = threading.Timer(self.stop_timeout, self._kill_remaining)
+        self._killer.daemon = True
+        self._killer.start()
+
+    def _kill_remaining(self):
+        for pid in list(self._workers):
+            logging.warning('Killing worker (pid %d), which did not stop', pid)
+            self._kill(pid, signal.SIGKILL)
+
+    @staticmethod
+    def _kill(pid, signum):
+        try:
+            os.kill(pid, signum)
+        except OSError:
+            # It has already exited
+            pass
+
+
+def run_supervisor(supervisor):
+    """Run supervisor until SIGINT (Ctrl-C) or SIGTERM"""
+    def stop(_signum, _frame):
+        logging.info('Ready to shut down')
+        supervisor.stop()
+
+    previous = [(signum, signal.signal(signum, stop)) for signum in _STOP_SIGNALS]
+    try:
+        supervisor.run()
+    finally:
+        for signum, handler in previous:
+            signal.signal(signum, handler)
@@ -0,0 +1,52 @@
+from __future__ import division
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from collections import OrderedDict
+import re
+
+
+_QUEUE_NAME = re.compile(r'^[A-Za-z0-9_-]+$')
+
+
+def check_queue_name(name):
+    """Raise ValueError unless name can be used in a printer URI as it is"""
+    if not _QUEUE_NAME.match(name):
+        raise ValueError(
+            'Queue names may only use letters, digits, - and _: %r' % (name,))
+
+
+class PrinterQueues(object):
+    """Several printers served together, each at /printers/<name>.
+
+    Each is a Behaviour with its own PPD, attributes, job store and
+    job_spooler, so a queue with slow jobs does not hold up the others.
+    This is passed to IPPServer or AsyncIPPServer in place of a Behaviour:
+    they ask behaviour_for_path() which printer should handle each request.
+    """
+    path_prefix = '/printers/'
+
+    def __init__(self, base_uri=b'ipp://localhost:1234/'):
+        self.base_uri = base_uri
+        self.queues = OrderedDict()
+
+    def add(self, name, behaviour):
+        """Serve behaviour as the printer called name"""
+        check_queue_name(name)
+        if name in self.queues:
+            raise ValueError('There is already a queue called %r' % (name,))
+        printer_uri = self.base_uri + (self.path_prefix[1:] + name).encode('ascii')
+        behaviour.printer_uri = printer_uri
+        # so job URIs are routed to the same queue
+        behaviour.base_uri = printer_uri + b'/'
+        behaviour.printer_name = name.encode('ascii')
+        behaviour.invalidate_caches()
+        self.queues[name] = behaviour
+
+    def behaviour_for_path(self, path):
+        """The Behaviour for the queue named in path, or None"""
+        if not path.startswith(self.path_prefix):
+            return None
+        name = path[len(self.path_prefix):].split('?', 1)[0].split('/', 1)[0]
+        return self.queues.get(name)
@@ -3,20 +3,66 @@ from __future__ import absolute_import
 from __future__ import print_function
 from __future__ import unicode_literals
 
-from io import BytesIO
-import operator
-import itertools
+import struct
 
-from .parsers import read_struct, write_struct
+from .parsers import (
+    read_struct, header_struct, tag_struct, length_struct, tag_length_struct
+)
 from .constants import SectionEnum, TagEnum
 
+_SECTION_END = int(SectionEnum.END)
+_SECTIONS_MASK = int(SectionEnum.SECTIONS_MASK)
+_SECTIONS = int(SectionEnum.SECTIONS)
+_INTEGER = int(TagEnum.integer)
+_END_BYTES = tag_struct.pack(SectionEnum.END)
+
+
+class IppParseError(ValueError):
+    """The message is not valid IPP"""
+
+
+def read_exactly(f, size):
+    data = f.read(size)
+    if len(data) != size:
+        raise struct.error('Expected %d bytes, got %d' % (size, len(data)))
+    return data
+
+
+def encode_attributes(parts, attributes, keys):
+    """Append the wire format of attributes[key] for each key to parts.
+
+    The keys must all be in the same section, and the section delimiter
+    is not included.
+    """
+    append = parts.append
+    pack_tag_length = tag_length_struct.pack
+    pack_length = length_struct.pack
+    for key in keys:
+        _section, name, tag = key
+        name_len = len(name)
+        for value in attributes[key]:
+            # Integer must be 4 bytes, as the parsers insist
+            assert (tag != _INTEGER or len(value) == 4)
+            append(pack_tag_length(tag, name_len))
+            if name_len:
+                append(name)
+                # additional values have an empty name
+                name_len = 0
+            append(pack_length(len(value)))
+            append(value)
+
 
 class IppRequest(object):
-    def __init__(self, version, opid_or_status, request_id, attributes):
+    def __init__(self, version, opid_or_status, request_id, attributes,
+                 encoded_groups=()):
         self.version = version  # (major, minor)
         self.opid_or_status = opid_or_status
         self.request_id = request_id
         self._attributes = attributes
+        # [(section, bytes), ...] attribute groups which are already in
+        # wire format (see encode_attributes). Each is sent as a separate
+        # group, after the groups made from the attributes dict.
+        self.encoded_groups = encoded_groups
 
     def __cmp__(self, other):
         return self.__eq__(other)
@@ -33,10 +79,98 @@ class IppRequest(object):
 
     @classmethod
     def from_string(cls, string):
-        return cls.from_file(BytesIO(string))
+        return cls.from_buffer(string)
+
+    @classmethod
+    def from_buffer(cls, buffer):
+        """Parse a message held in bytes, a bytearray or a memoryview.
+
+        Raises IppParseError if it is malformed or truncated.
+        """
+        try:
+            return cls.from_buffer_at(buffer, 0)[0]
+        except struct.error:
+            raise IppParseError('The IPP message is truncated')
+
+    @classmethod
+    def from_buffer_at(cls, buffer, offset):
+        """Parse a message starting at offset in buffer.
+
+        Returns the message and the offset of the first byte after it.
+        Raises struct.error if the buffer ends before the message does, or
+        IppParseError if the message is malformed.
+        """
+        view = memoryview(buffer)
+        end = len(view)
+        unpack_tag = tag_struct.unpack_from
+        unpack_length = length_struct.unpack_from
+
+        version_major, version_minor, operation_id_or_status_code, request_id = \
+            header_struct.unpack_from(view, offset)
+        offset += header_struct.size
+
+        attributes = {}
+        current_section = None
+        current_name = None
+        while True:
+            tag, = unpack_tag(view, offset)
+            offset += 1
+
+            if tag == _SECTION_END:
+                break
+            elif tag & _SECTIONS_MASK == _SECTIONS:
+                current_section = tag
+                current_name = None
+            else:
+                if current_section is None:
+                    raise IppParseError('No section delimiter')
+
+                name_len, = unpack_length(view, offset)
+                offset += 2
+                if name_len == 0:
+                    if current_name is None:
+                        raise IppParseError('Additional attribute needs a name to follow')
+                    else:
+                        # additional attribute, under the same name
+                        pass
+                else:
+                    if name_len < 0:
+                        raise IppParseError('Negative attribute name length')
+                    if offset + name_len > end:
+                        raise struct.error('Attribute name runs past the end of the buffer')
+                    current_name = view[offset:offset + name_len].tobytes()
+                    offset += name_len
+
+                value_len, = unpack_length(view, offset)
+                offset += 2
+                if value_len < 0:
+                    raise IppParseError('Negative attribute value length')
+                if tag == _INTEGER and value_len != 4:
+                    raise IppParseError('Integer values must be 4 bytes')
+                if offset + value_len > end:
+                    raise struct.error('Attribute value runs past the end of the buffer')
+                value_str = view[offset:offset + value_len].tobytes()
+                offset += value_len
+                attributes.setdefault((current_section, current_name, tag), []).append(value_str)
+
+        return cls(
+            (version_major, version_minor), operation_id_or_status_code,
+            request_id, attributes), offset
 
     @classmethod
     def from_file(cls, f):
+        """Parse a message read from the file-like object f, which is left
+        at the first byte after it.
+
+        Raises IppParseError if it is malformed or truncated.
+        """
+        try:
+            return cls._from_file(f)
+        except struct.error:
+            raise IppParseError('The IPP message is truncated')
+
+    @classmethod
+    def _from_file(cls, f):
         version = read_struct(f, b'>bb')  # (major, minor)
         operation_id_or_status_code, request_id = read_struct(f, b'>hi')
 
@@ -53,52 +187,53 @@ class IppRequest(object):
                 current_name = None
             else:
                 if current_section is None:
-                    raise Exception('No section delimiter')
+                    raise IppParseError('No section delimiter')
 
                 name_len, = read_struct(f, b'>h')
                 if name_len == 0:
                     if current_name is None:
-                        raise Exception('Additional attribute needs a name to follow')
+                        raise IppParseError('Additional attribute needs a name to follow')
                     else:
                         # additional attribute, under the same name
                         pass
                 else:
-                    current_name = f.read(name_len)
+                    if name_len < 0:
+                        # f.read() would read to the end of the document
+                        raise IppParseError('Negative attribute name length')
+                    current_name = read_exactly(f, name_len)
 
                 value_len, = read_struct(f, b'>h')
-                value_str = f.read(value_len)
+                if value_len < 0:
+                    raise IppParseError('Negative attribute value length')
+                if tag == TagEnum.integer and value_len != 4:
+                    raise IppParseError('Integer values must be 4 bytes')
+                value_str = read_exactly(f, value_len)
                 attributes.setdefault((current_section, current_name, tag), []).append(value_str)
 
         return cls(version, operation_id_or_status_code, request_id, attributes)
 
     def to_string(self):
-        sio = BytesIO()
-        self.to_file(sio)
-        return sio.getvalue()
+        version_major, version_minor = 1, 1
+        parts = [header_struct.pack(
+            version_major, version_minor, self.opid_or_status, self.request_id)]
+
+        # Group the keys by section in one pass: within a section,
+        # attributes are sent in the order they were added
+        sections = {}
+        for key in self._attributes:
+            sections.setdefault(key[0], []).append(key)
+        for section in sorted(sections):
+            parts.append(tag_struct.pack(section))
+            encode_attributes(parts, self._attributes, sections[section])
+        for section, encoded in self.encoded_groups:
+            parts.append(tag_struct.pack(section))
+            parts.append(encoded)
+
+        parts.append(_END_BYTES)
+        return b''.join(parts)
 
     def to_file(self, f):
-        version_major, version_minor = 1, 1
-        write_struct(f, b'>bb', version_major, version_minor)
-        write_struct(f, b'>hi', self.opid_or_status, self.request_id)
-
-        for section, attrs_in_section in itertools.groupby(
-            sorted(self._attributes.keys()), operator.itemgetter(0)
-        ):
-            write_struct(f, b'>B', section)
-            for key in attrs_in_section:
-                _section, name, tag = key
-                for i, value in enumerate(self._attributes[key]):
-                    write_struct(f, b'>B', tag)
-                    if i == 0:
-                        write_struct(f, b'>h', len(name))
-                        f.write(name)
-                    else:
-                        write_struct(f, b'>h', 0)
-                    # Integer must be 4 bytes
-                    assert (tag != TagEnum.integer or len(value) == 4)
-                    write_struct(f, b'>h', len(value))
-                    f.write(value)
-        write_struct(f, b'>B', SectionEnum.END)
+        f.write(self.to_string())
 
     def attributes_to_multilevel(self, section=None):
         ret = {}
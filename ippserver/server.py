@@ -2,8 +2,11 @@ from __future__ import division
 from __future__ import absolute_import
 from __future__ import print_function
 
-from io import BytesIO
 import threading
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 try:
     import socketserver
 except ImportError:
@@ -14,16 +17,63 @@ except ImportError:
     from BaseHTTPServer import BaseHTTPRequestHandler
 import time
 import logging
-import os.path
+import re
+import socket
+import struct
 
+from . import metrics
 from . import request
+from . import tracing
+from .constants import StatusCodeEnum
+from .static import static_file
+from .streams import CountingReader, PrefixedReader
+
+
+CHUNK_READ_SIZE = 64 * 1024
+
+
+def not_found_response():
+    page = static_file('404.txt')
+    return 404, page.content_type, page.body
+
+
+def www_response(behaviour, path, request_headers=None):
+    """Return (status, content_type, body, headers) for a plain http GET
+    of path, or a 304 with no body if request_headers show the client
+    already has the page"""
+    if path == '/':
+        page = static_file('homepage.txt')
+    elif path.endswith('.ppd'):
+        printer = behaviour.behaviour_for_path(path[:-len('.ppd')])
+        if printer is None:
+            return not_found_response() + ((),)
+        page = printer.ppd_page()
+    elif path == '/metrics':
+        return 200, metrics.CONTENT_TYPE, metrics.REGISTRY.render(), ()
+    else:
+        return not_found_response() + ((),)
+    if page.not_modified(request_headers):
+        return 304, page.content_type, b'', page.headers
+    return 200, page.content_type, page.body, page.headers
+
+
+class ChunkedEncodingError(ValueError):
+    """A chunked request body is malformed, so where it ends is unknown"""
+
 
+_CHUNK_SIZE = re.compile(br'^[0-9A-Fa-f]+$')
 
-def local_file_location(filename):
-    return os.path.join(os.path.dirname(__file__), 'data', filename)
 
+def parse_chunk_size(line):
+    """The size from a chunk-size line, ignoring any chunk extensions.
+    int() alone would accept a sign, so a negative size."""
+    chunk_size_s = line.split(b';', 1)[0].strip()
+    if not _CHUNK_SIZE.match(chunk_size_s):
+        raise ChunkedEncodingError('Bad chunk size %r' % (chunk_size_s,))
+    return int(chunk_size_s, 16)
 
-def _get_next_chunk(rfile):
+
+def _read_chunk_size(rfile):
     while True:
         chunk_size_s = rfile.readline()
         logging.debug('chunksz=%r', chunk_size_s)
@@ -34,35 +84,236 @@ def _get_next_chunk(rfile):
         if chunk_size_s.strip() != b'':
             break
 
-    chunk_size = int(chunk_size_s, 16)
-    if chunk_size == 0:
-        return b''
-    chunk = rfile.read(chunk_size)
-    logging.debug('chunk=0x%x', len(chunk))
-    return chunk
+    return parse_chunk_size(chunk_size_s)
 
 
-def read_chunked(rfile):
+def _readinto1(rfile, view):
+    """Read what is available (at least one byte) into view"""
+    readinto1 = getattr(rfile, 'readinto1', None)
+    if readinto1 is not None:
+        return readinto1(view)
+    block = rfile.read(len(view))
+    view[:len(block)] = block
+    return len(block)
+
+
+class ChunkedReader(object):
+    """A file-like object which decodes a chunked request body as it is read.
+
+    Only the current chunk is ever buffered (by the underlying rfile), so
+    the memory used does not depend on the size of the document.
+    """
+
+    def __init__(self, rfile):
+        self.rfile = rfile
+        self._chunk_remaining = 0
+        self._eof = False
+
+    def _next_chunk(self):
+        chunk_size = _read_chunk_size(self.rfile)
+        logging.debug('chunk=0x%x', chunk_size)
+        if chunk_size == 0:
+            self._eof = True
+            self._skip_trailers()
+        self._chunk_remaining = chunk_size
+
+    def _skip_trailers(self):
+        while True:
+            line = self.rfile.readline()
+            if line.strip() == b'':
+                break
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            return b''.join(iter(lambda: self.read(CHUNK_READ_SIZE), b''))
+
+        blocks = []
+        while size > 0 and not self._eof:
+            if self._chunk_remaining == 0:
+                self._next_chunk()
+                continue
+            block = self.rfile.read(min(size, self._chunk_remaining))
+            if not block:
+                raise RuntimeError(
+                    'Socket closed in the middle of a chunked request'
+                )
+            self._chunk_remaining -= len(block)
+            size -= len(block)
+            blocks.append(block)
+
+        if len(blocks) == 1:
+            return blocks[0]
+        return b''.join(blocks)
+
+    def readinto(self, b):
+        """Read up to len(b) bytes (but no further than the current chunk)"""
+        if self._chunk_remaining == 0 and not self._eof:
+            self._next_chunk()
+        if self._eof:
+            return 0
+        count = _readinto1(
+            self.rfile, memoryview(b)[:min(len(b), self._chunk_remaining)])
+        if not count:
+            raise RuntimeError(
+                'Socket closed in the middle of a chunked request'
+            )
+        self._chunk_remaining -= count
+        return count
+
+    def close(self):
+        pass
+
+
+_CONTENT_LENGTH = re.compile(r'^[0-9]+$')
+
+
+def parse_content_length(value):
+    """The length of the body from a Content-Length header, or raise
+    ValueError. int() alone would accept a sign, so a negative length."""
+    value = value.strip()
+    if not _CONTENT_LENGTH.match(value):
+        raise ValueError('Bad Content-Length %r' % (value,))
+    return int(value)
+
+
+class LengthLimitedReader(object):
+    """A file-like object which reads at most Content-Length bytes.
+
+    This stops a handler reading past the end of the body and into the
+    next request on a persistent connection.
+    """
+
+    def __init__(self, rfile, length):
+        if length < 0:
+            raise ValueError('Negative length %d' % (length,))
+        self.rfile = rfile
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        if size == 0:
+            return b''
+        block = self.rfile.read(size)
+        if not block:
+            raise RuntimeError(
+                'Socket closed with %d bytes of the request body unread' % (
+                    self.remaining,))
+        self.remaining -= len(block)
+        return block
+
+    def readinto(self, b):
+        if self.remaining == 0:
+            return 0
+        count = _readinto1(
+            self.rfile, memoryview(b)[:min(len(b), self.remaining)])
+        if not count:
+            raise RuntimeError(
+                'Socket closed with %d bytes of the request body unread' % (
+                    self.remaining,))
+        self.remaining -= count
+        return count
+
+    def remaining_length(self):
+        return self.remaining
+
+    def close(self):
+        pass
+
+
+def drain(body):
+    for _block in iter(lambda: body.read(CHUNK_READ_SIZE), b''):
+        pass
+
+
+def read_ipp_request(body, max_size):
+    """Read an IPP message header from body into a buffer, and parse it.
+
+    Returns the IppRequest and a file-like object for the document data
+    which follows it. Raises request.IppParseError if the header is
+    malformed.
+    """
+    data = bytearray()
+    block = bytearray(CHUNK_READ_SIZE)
     while True:
-        chunk = _get_next_chunk(rfile)
-        if chunk == b'':
-            rfile.close()
-            break
+        # body.readinto returns what has arrived, rather than waiting
+        # for the document, which the client may only send after a 100
+        count = body.readinto(block)
+        data += memoryview(block)[:count]
+        try:
+            ipp_request, end = request.IppRequest.from_buffer_at(data, 0)
+        except struct.error:
+            # we have not recieved all of the ipp message yet
+            if not count:
+                raise request.IppParseError('Request body ended in the IPP header')
+            if len(data) > max_size:
+                raise request.IppParseError('IPP header is larger than %d bytes' % (max_size,))
         else:
-            yield chunk
+            return ipp_request, PrefixedReader(bytes(data[end:]), body)
+
+
+def read_chunked(rfile):
+    reader = ChunkedReader(rfile)
+    return iter(lambda: reader.read(CHUNK_READ_SIZE), b'')
 
 
 class IPPRequestHandler(BaseHTTPRequestHandler):
     default_request_version = "HTTP/1.1"
     protocol_version = "HTTP/1.1"
+    # The headers and body of a response are separate writes: with Nagle's
+    # algorithm the body waits for the client's (delayed) ACK of the headers
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        self.timeout = self.server.keepalive_timeout
+        BaseHTTPRequestHandler.setup(self)
+        self.requests_handled = 0
+        metrics.ACTIVE_CONNECTIONS.inc()
+
+    def finish(self):
+        metrics.ACTIVE_CONNECTIONS.dec()
+        BaseHTTPRequestHandler.finish(self)
 
     def parse_request(self):
         ret = BaseHTTPRequestHandler.parse_request(self)
+        if not ret:
+            return ret
+
+        self.requests_handled += 1
+        if self.requests_handled >= self.server.max_keepalive_requests:
+            self.close_connection = True
+
+        content_length = self.headers.get('content-length')
         if 'chunked' in self.headers.get('transfer-encoding', ''):
-            self.rfile = BytesIO(b"".join(read_chunked(self.rfile)))
-        self.close_connection = True
+            self.body = ChunkedReader(self.rfile)
+        elif content_length is not None:
+            try:
+                self.body = LengthLimitedReader(
+                    self.rfile, parse_content_length(content_length))
+            except ValueError:
+                self.close_connection = True
+                self.send_error(400, 'Bad Content-Length %r' % (content_length,))
+                return False
+        elif self.command == 'POST':
+            # The body is delimited by the client closing the connection
+            self.body = self.rfile
+            self.close_connection = True
+        else:
+            self.body = LengthLimitedReader(self.rfile, 0)
+        self.body = CountingReader(self.body)
         return ret
 
+    def finish_body(self):
+        """Discard whatever the handler did not read from the request body,
+        so the next request on this connection starts at the right place."""
+        if not self.close_connection:
+            try:
+                drain(self.body)
+            except ChunkedEncodingError:
+                # The response has been sent, but the next request can't be found
+                self.close_connection = True
+        metrics.BYTES_RECEIVED.inc(self.body.bytes_read)
+
     if not hasattr(BaseHTTPRequestHandler, "send_response_only"):
         def send_response_only(self, code, message=None):
             """Send the response header only."""
@@ -80,79 +331,246 @@ class IPPRequestHandler(BaseHTTPRequestHandler):
             )
 
     def log_error(self, format, *args):
-        logging.error(format, *args)
+        if format.startswith('Request timed out'):
+            # an idle persistent connection reached keepalive_timeout
+            logging.debug(format, *args)
+        else:
+            logging.error(format, *args)
 
     def log_message(self, format, *args):
         logging.debug(format, *args)
 
     def send_headers(self, status=200, content_type='text/plain',
-                     content_length=None):
+                     content_length=None, headers=()):
         self.log_request(status)
         self.send_response_only(status, None)
         self.send_header('Server', 'ipp-server')
         self.send_header('Date', self.date_time_string())
         self.send_header('Content-Type', content_type)
-        if content_length:
-            self.send_header('Content-Length', '%u' % content_length)
-        self.send_header('Connection', 'close')
+        for name, value in headers:
+            self.send_header(name, value)
+        if status >= 200:
+            if status == 304:
+                # Not Modified has no body, so no Content-Length either
+                pass
+            elif content_length is None:
+                # without a length, the end of the body is the end of the connection
+                self.close_connection = True
+            else:
+                self.send_header('Content-Length', '%u' % content_length)
+            self.send_header(
+                'Connection', 'close' if self.close_connection else 'keep-alive')
         self.end_headers()
 
+    def start_trace(self):
+        trace = tracing.start_trace('%s %s' % (self.command, self.path))
+        if trace is not None:
+            self.body = tracing.TimedReader(self.body, trace)
+
     def do_POST(self):
-        self.handle_ipp()
+        self.start_trace()
+        try:
+            try:
+                self.handle_ipp()
+            except ChunkedEncodingError as e:
+                # Where this request ends is unknown, so close the connection
+                self.close_connection = True
+                self.send_body(400, 'text/plain', str(e).encode('latin-1'))
+            self.finish_body()
+        finally:
+            tracing.finish_trace()
 
     def do_GET(self):
-        self.handle_www()
+        self.start_trace()
+        try:
+            self.handle_www()
+            self.finish_body()
+        finally:
+            tracing.finish_trace()
+
+    def send_body(self, status, content_type, body, headers=()):
+        self.send_headers(
+            status=status, content_type=content_type,
+            content_length=len(body), headers=headers
+        )
+        self.wfile.write(body)
 
     def handle_www(self):
-        if self.path == '/':
-            self.send_headers(
-                status=200, content_type='text/plain'
-            )
-            with open(local_file_location('homepage.txt'), 'rb') as wwwfile:
-                self.wfile.write(wwwfile.read())
-        elif self.path.endswith('.ppd'):
-            self.send_headers(
-                status=200, content_type='text/plain'
-            )
-            self.wfile.write(self.server.behaviour.ppd.text())
-        else:
-            self.send_headers(
-                status=404, content_type='text/plain'
-            )
-            with open(local_file_location('404.txt'), 'rb') as wwwfile:
-                self.wfile.write(wwwfile.read())
+        self.send_body(*www_response(
+            self.server.behaviour, self.path, self.headers))
 
     def handle_expect_100(self):
         """ Disable """
         return True
 
     def handle_ipp(self):
-        self.ipp_request = request.IppRequest.from_file(self.rfile)
+        behaviour = self.server.behaviour.behaviour_for_path(self.path)
+        if behaviour is None:
+            self.send_body(*not_found_response())
+            return
+
+        try:
+            with tracing.span('parse'):
+                self.ipp_request, document = read_ipp_request(
+                    self.body, self.server.max_ipp_header_size)
+        except request.IppParseError as e:
+            self.send_body(400, 'text/plain', str(e).encode('utf-8'))
+            return
 
-        if self.server.behaviour.expect_page_data_follows(self.ipp_request):
+        slots = self.server.queue_slots(behaviour)
+        if slots is not None and not slots.acquire(False):
+            # This queue's share of the threads are all busy
+            ipp_response = behaviour.busy_response(self.ipp_request)
+        else:
+            try:
+                ipp_response = self.handle_ipp_request(behaviour, document)
+            finally:
+                if slots is not None:
+                    slots.release()
+        if ipp_response.opid_or_status == StatusCodeEnum.server_error_busy:
+            # Close the connection rather than read a document which
+            # will not be processed
+            self.close_connection = True
+
+        with tracing.span('encode'):
+            ipp_response = ipp_response.to_string()
+        with tracing.span('write'):
+            self.send_body(200, 'application/ipp', ipp_response)
+
+    def handle_ipp_request(self, behaviour, document):
+        if behaviour.expect_page_data_follows(self.ipp_request):
             self.send_headers(
                 status=100, content_type='application/ipp'
             )
-            postscript_file = self.rfile
+            postscript_file = document
         else:
             postscript_file = None
 
-        ipp_response = self.server.behaviour.handle_ipp(
+        return behaviour.handle_ipp(
             self.ipp_request, postscript_file
-        ).to_string()
-        self.send_headers(
-            status=200, content_type='application/ipp',
-            content_length=len(ipp_response)
         )
-        self.wfile.write(ipp_response)
 
 
 class IPPServer(socketserver.ThreadingTCPServer):
+    """Serve IPP over http.
+
+    By default each connection gets its own thread. With workers set, a
+    fixed pool of threads handles connections: once accept_queue_size
+    connections are waiting for a thread, the server stops accepting and
+    new connections wait in the kernel's listen backlog. Note a persistent
+    connection holds its thread until it is closed or keepalive_timeout
+    expires.
+
+    Serving PrinterQueues with workers set, requests for one queue use at
+    most threads_per_queue of the threads at once, so a queue with slow
+    jobs can't take every thread. Requests beyond that get
+    server-error-busy. Idle persistent connections are not counted
+    against any queue.
+    """
     allow_reuse_address = True
+    # idle persistent connections should not hold up shutdown
+    daemon_threads = True
+    # Seconds to wait for the next request on a persistent connection
+    keepalive_timeout = 30
+    # Requests served on one connection before it is closed
+    max_keepalive_requests = 100
+    max_ipp_header_size = 1024 * 1024
+    # Number of handler threads, or None for a thread per connection
+    workers = None
+    # With workers, the threads one of several PrinterQueues may use at
+    # once, or None to share the threads out equally between the queues
+    threads_per_queue = None
+    # Accepted connections which may wait for a free handler thread
+    accept_queue_size = 64
+    # The listen backlog (the socketserver default of 5 drops SYNs under load)
+    request_queue_size = 128
+    # Set SO_REUSEPORT, so several processes can listen on the same port
+    reuse_port = False
 
-    def __init__(self, address, request_handler, behaviour):
+    def __init__(self, address, request_handler, behaviour,
+                 keepalive_timeout=None, max_keepalive_requests=None,
+                 workers=None, accept_queue_size=None, listen_backlog=None,
+                 listen_socket=None, reuse_port=None, threads_per_queue=None):
         self.behaviour = behaviour
-        socketserver.ThreadingTCPServer.__init__(self, address, request_handler)  # old style class!
+        if keepalive_timeout is not None:
+            self.keepalive_timeout = keepalive_timeout
+        if max_keepalive_requests is not None:
+            self.max_keepalive_requests = max_keepalive_requests
+        if workers is not None:
+            self.workers = workers
+        if accept_queue_size is not None:
+            self.accept_queue_size = accept_queue_size
+        if listen_backlog is not None:
+            self.request_queue_size = listen_backlog
+        if reuse_port is not None:
+            self.reuse_port = reuse_port
+        if threads_per_queue is not None:
+            self.threads_per_queue = threads_per_queue
+        # {behaviour: BoundedSemaphore} for each of PrinterQueues
+        self._queue_slots = {}
+        self._queue_slots_lock = threading.Lock()
+        if listen_socket is None:
+            socketserver.ThreadingTCPServer.__init__(self, address, request_handler)  # old style class!
+        else:
+            socketserver.ThreadingTCPServer.__init__(
+                self, address, request_handler, bind_and_activate=False)
+            self.socket.close()
+            # A listening socket shared with other processes (see
+            # ippserver.prefork), any of which may accept a connection
+            # first: non-blocking, so losing the race does not block
+            listen_socket.setblocking(False)
+            self.socket = listen_socket
+            self.server_address = listen_socket.getsockname()
+
+        self._worker_threads = []
+        if self.workers is not None:
+            self._accepted = queue.Queue(self.accept_queue_size)
+            for _ in range(self.workers):
+                thread = threading.Thread(target=self._worker)
+                thread.daemon = True
+                thread.start()
+                self._worker_threads.append(thread)
+
+    def queue_slots(self, behaviour):
+        """The semaphore limiting the threads handling requests for
+        behaviour, if it is one of several PrinterQueues, or None"""
+        if self.workers is None or behaviour is self.behaviour:
+            return None
+        with self._queue_slots_lock:
+            slots = self._queue_slots.get(behaviour)
+            if slots is None:
+                size = self.threads_per_queue or max(
+                    1, self.workers // len(self.behaviour.queues))
+                slots = self._queue_slots[behaviour] = threading.BoundedSemaphore(size)
+            return slots
+
+    def server_bind(self):
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        socketserver.ThreadingTCPServer.server_bind(self)
+
+    def process_request(self, request, client_address):
+        if self.workers is None:
+            socketserver.ThreadingTCPServer.process_request(
+                self, request, client_address)
+        else:
+            # blocks (so stops accepting) while the queue is full
+            self._accepted.put((request, client_address))
+
+    def _worker(self):
+        while True:
+            item = self._accepted.get()
+            if item is None:
+                return
+            request, client_address = item
+            self.process_request_thread(request, client_address)
+
+    def server_close(self):
+        socketserver.ThreadingTCPServer.server_close(self)
+        for _ in self._worker_threads:
+            self._accepted.put(None)
+        for thread in self._worker_threads:
+            thread.join()
 
 
 def wait_until_ctrl_c():
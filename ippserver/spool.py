@@ -0,0 +1,171 @@
+from __future__ import division
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import logging
+import os
+import tempfile
+import threading
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from . import metrics
+from .durability import NoSync
+from .streams import copy_to_fd, write_all
+
+SPOOL_PREFIX = 'ipp-server-spool-'
+# Spool files are renamed from .partial to .job once they are complete
+PARTIAL_SUFFIX = '.partial'
+SPOOLED_SUFFIX = '.job'
+
+
+def try_lock(fd):
+    """Take an exclusive lock on an open file, unless another process
+    has it. Locks go when the process holding them dies."""
+    if fcntl is None:
+        return True
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except (IOError, OSError):
+        return False
+    return True
+
+
+class JobSpooler(object):
+    """Saves documents to disk, and processes them on background threads.
+
+    This lets a printer reply to Print-Job as soon as the document has
+    been received, instead of waiting for it to be processed.
+
+    Each spool file is locked by the process which spooled it until
+    done() is called, so if that process dies, recover() in another (or
+    after a restart) can pick up the jobs it had not got to. Files are
+    synced as durability says before the client is told the job was
+    received.
+    """
+
+    def __init__(self, directory=None, workers=1, durability=None):
+        self.directory = directory
+        self.durability = NoSync() if durability is None else durability
+        # {filename: fd holding our lock on it}
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._threads = []
+        for _ in range(workers):
+            thread = threading.Thread(target=self._worker)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def spool(self, document, header=b''):
+        """Copy header, then document, to a new file in the spool directory.
+
+        Returns the filename: whoever processes it should call done().
+        """
+        directory = self.directory or tempfile.gettempdir()
+        fd, partial = tempfile.mkstemp(
+            prefix=SPOOL_PREFIX, suffix=PARTIAL_SUFFIX, dir=directory)
+        try:
+            try_lock(fd)
+            write_all(fd, header)
+            copy_to_fd(document, fd)
+            self.durability.sync(fd, partial)
+            filename = partial[:-len(PARTIAL_SUFFIX)] + SPOOLED_SUFFIX
+            os.rename(partial, filename)
+            self.durability.sync_directory(directory)
+        except Exception:
+            os.close(fd)
+            os.unlink(partial)
+            raise
+        with self._locks_lock:
+            self._locks[filename] = fd
+        return filename
+
+    def done(self, filename):
+        """Delete a spool file, once its job has been processed"""
+        os.unlink(filename)
+        self.release(filename)
+
+    def release(self, filename):
+        """Unlock a spool file, leaving it for another process to recover"""
+        with self._locks_lock:
+            fd = self._locks.pop(filename, None)
+        if fd is not None:
+            os.close(fd)
+
+    def recover(self):
+        """Lock the spool files left by processes which stopped before
+        processing them, and return [(filename, complete), ...], oldest
+        first. Incomplete files were still being received.
+
+        This only looks in an explicit directory, not the temporary
+        directory other programs share.
+        """
+        if self.directory is None:
+            return []
+        found = []
+        for name in os.listdir(self.directory):
+            if not name.startswith(SPOOL_PREFIX):
+                continue
+            if not name.endswith((SPOOLED_SUFFIX, PARTIAL_SUFFIX)):
+                continue
+            filename = os.path.join(self.directory, name)
+            with self._locks_lock:
+                if filename in self._locks:
+                    continue
+            try:
+                fd = os.open(filename, os.O_RDONLY)
+            except OSError:
+                # Processed and deleted meanwhile
+                continue
+            if not try_lock(fd) or os.fstat(fd).st_nlink == 0:
+                # Another process has it, or finished with it meanwhile
+                os.close(fd)
+                continue
+            with self._locks_lock:
+                self._locks[filename] = fd
+            found.append((
+                os.fstat(fd).st_mtime, filename, name.endswith(SPOOLED_SUFFIX)))
+        return [(filename, complete) for _, filename, complete in sorted(found)]
+
+    def submit(self, function, *args):
+        """Call function(*args) on one of the worker threads"""
+        self._queue.put((function, args))
+        metrics.SPOOL_QUEUE_DEPTH.inc()
+
+    def queue_depth(self):
+        """The number of submitted jobs which have not started"""
+        return self._queue.qsize()
+
+    def join(self):
+        """Wait until every submitted job has finished"""
+        self._queue.join()
+
+    def close(self):
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def _worker(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                function, args = item
+                metrics.SPOOL_QUEUE_DEPTH.dec()
+                try:
+                    function(*args)
+                except Exception:
+                    logging.exception('Error processing a spooled job')
+            finally:
+                self._queue.task_done()
@@ -0,0 +1,70 @@
+from __future__ import division
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from email.utils import formatdate, mktime_tz, parsedate_tz
+import hashlib
+import os.path
+import threading
+import time
+
+
+class StaticPage(object):
+    """A response body kept in memory, with the validators clients use
+    to ask for it again only if it has changed.
+
+    Printer drivers fetch the PPD each time they are set up, so many
+    clients setting up at once would otherwise generate it over and over.
+    """
+
+    def __init__(self, body, content_type='text/plain', last_modified=None):
+        self.body = body
+        self.content_type = content_type
+        self.etag = '"%s"' % (hashlib.sha1(body).hexdigest(),)
+        if last_modified is None:
+            last_modified = time.time()
+        # HTTP dates are in whole seconds
+        self.last_modified = int(last_modified)
+        self.headers = [
+            ('ETag', self.etag),
+            ('Last-Modified', formatdate(self.last_modified, usegmt=True)),
+        ]
+
+    def not_modified(self, request_headers):
+        """Whether the client already has this page, going by the
+        If-None-Match or If-Modified-Since in request_headers"""
+        if request_headers is None:
+            return False
+        if_none_match = request_headers.get('If-None-Match')
+        if if_none_match is not None:
+            # If-Modified-Since is ignored when If-None-Match is given
+            tags = [tag.strip() for tag in if_none_match.split(',')]
+            return '*' in tags or any(
+                (tag[2:] if tag.startswith('W/') else tag) == self.etag
+                for tag in tags)
+        if_modified_since = request_headers.get('If-Modified-Since')
+        if if_modified_since is not None:
+            since = parsedate_tz(if_modified_since)
+            return since is not None and self.last_modified <= mktime_tz(since)
+        return False
+
+
+def local_file_location(filename):
+    return os.path.join(os.path.dirname(__file__), 'data', filename)
+
+
+_files = {}
+_files_lock = threading.Lock()
+
+
+def static_file(filename):
+    """The StaticPage for a file in ippserver/data, read only once"""
+    with _files_lock:
+        page = _files.get(filename)
+        if page is None:
+            path = local_file_location(filename)
+            with open(path, 'rb') as wwwfile:
+                page = _files[filename] = StaticPage(
+                    wwwfile.read(), last_modified=os.path.getmtime(path))
+        return page
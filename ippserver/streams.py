@@ -0,0 +1,218 @@
+from __future__ import division
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import errno
+import io
+import os
+import stat
+
+
+COPY_BUFFER_SIZE = 1024 * 1024
+
+# errors meaning a zero-copy system call can't be used for these files
+_ZERO_COPY_UNSUPPORTED = (errno.EINVAL, errno.ENOSYS, errno.EBADF, errno.EXDEV, errno.ENOTSUP)
+
+
+class CountingReader(object):
+    """Wraps a file-like object, counting the bytes read from it"""
+
+    def __init__(self, f):
+        self.f = f
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        block = self.f.read(size)
+        self.bytes_read += len(block)
+        return block
+
+    def readinto(self, b):
+        readinto = getattr(self.f, 'readinto', None)
+        if readinto is None:
+            block = self.f.read(len(b))
+            b[:len(block)] = block
+            count = len(block)
+        else:
+            count = readinto(b)
+        self.bytes_read += count
+        return count
+
+    def copy_to_fd(self, fd):
+        count = copy_to_fd(self.f, fd)
+        self.bytes_read += count
+        return count
+
+    def remaining_length(self):
+        return remaining_length(self.f)
+
+    def close(self):
+        pass
+
+
+class PrefixedReader(object):
+    """Returns data we have already read from f before reading more"""
+
+    def __init__(self, prefix, f):
+        self.prefix = prefix
+        self.f = f
+
+    def read(self, size=-1):
+        if not self.prefix:
+            return self.f.read(size)
+        if size is None or size < 0:
+            block, self.prefix = self.prefix, b''
+            return block + self.f.read()
+        block, self.prefix = self.prefix[:size], self.prefix[size:]
+        return block
+
+    def readinto(self, b):
+        if not self.prefix:
+            readinto = getattr(self.f, 'readinto', None)
+            if readinto is not None:
+                return readinto(b)
+        block = self.read(len(b))
+        b[:len(block)] = block
+        return len(block)
+
+    def copy_to_fd(self, fd):
+        prefix, self.prefix = self.prefix, b''
+        write_all(fd, prefix)
+        return len(prefix) + copy_to_fd(self.f, fd)
+
+    def remaining_length(self):
+        length = remaining_length(self.f)
+        if length is None:
+            return None
+        return len(self.prefix) + length
+
+    def close(self):
+        pass
+
+
+def regular_file_fileno(f):
+    """The file descriptor behind f, if it is a regular file (or None)"""
+    if not isinstance(f, (io.BufferedReader, io.FileIO)):
+        return None
+    try:
+        fd = f.fileno()
+    except (AttributeError, io.UnsupportedOperation):
+        return None
+    if not stat.S_ISREG(os.fstat(fd).st_mode):
+        return None
+    return fd
+
+
+def remaining_length(f):
+    """How many more bytes can be read from f, or None if that isn't known"""
+    get_length = getattr(f, 'remaining_length', None)
+    if get_length is not None:
+        return get_length()
+    fd = regular_file_fileno(f)
+    if fd is not None:
+        return os.fstat(fd).st_size - f.tell()
+    return None
+
+
+def preallocate(fd, length):
+    """Reserve disk space for a file we are about to write, if we can.
+
+    This lets the filesystem allocate the file in one contiguous piece.
+    """
+    if not length or not hasattr(os, 'posix_fallocate'):
+        return
+    try:
+        os.posix_fallocate(fd, 0, length)
+    except OSError as e:
+        if e.errno not in (errno.EINVAL, errno.ENOTSUP, errno.EOPNOTSUPP, errno.ENOSYS):
+            raise
+
+
+def write_all(fd, data):
+    view = memoryview(data)
+    while view:
+        written = os.write(fd, view)
+        view = view[written:]
+
+
+def _zero_copy_functions(out_fd):
+    """System calls which copy (in_fd, offset, count) to out_fd in the kernel"""
+    out_mode = os.fstat(out_fd).st_mode
+    if stat.S_ISFIFO(out_mode) and hasattr(os, 'splice'):
+        yield lambda in_fd, offset, count: os.splice(
+            in_fd, out_fd, count, offset_src=offset)
+    if stat.S_ISREG(out_mode) and hasattr(os, 'copy_file_range'):
+        yield lambda in_fd, offset, count: os.copy_file_range(
+            in_fd, out_fd, count, offset_src=offset)
+    if hasattr(os, 'sendfile'):
+        yield lambda in_fd, offset, count: os.sendfile(
+            out_fd, in_fd, offset, count)
+
+
+def _zero_copy(f, in_fd, out_fd):
+    """Copy the rest of the regular file f to out_fd without reading it
+    into python. Returns None if the operating system can't do that."""
+    offset = start = f.tell()
+    for copy in _zero_copy_functions(out_fd):
+        try:
+            while True:
+                count = copy(in_fd, offset, COPY_BUFFER_SIZE)
+                if count == 0:
+                    break
+                offset += count
+        except OSError as e:
+            if offset == start and e.errno in _ZERO_COPY_UNSUPPORTED:
+                continue
+            raise
+        f.seek(offset)
+        return offset - start
+    return None
+
+
+def copy_to_fd(f, fd):
+    """Copy everything left in the file-like object f to a file descriptor.
+
+    The data is copied by the kernel if f is a regular file and the
+    platform allows (splice, copy_file_range or sendfile). Otherwise it is
+    read into a single reusable buffer. Returns the number of bytes copied.
+    """
+    copy = getattr(f, 'copy_to_fd', None)
+    if copy is not None:
+        return copy(fd)
+
+    in_fd = regular_file_fileno(f)
+    if in_fd is not None:
+        count = _zero_copy(f, in_fd, fd)
+        if count is not None:
+            return count
+
+    return _copy_blocks(f, fd)
+
+
+def hash_to_fd(f, fd, digest):
+    """Copy the rest of f to fd, passing the data to digest.update().
+
+    Returns the number of bytes copied.
+    """
+    return _copy_blocks(f, fd, digest.update)
+
+
+def _copy_blocks(f, fd, update=None):
+    buf = bytearray(COPY_BUFFER_SIZE)
+    view = memoryview(buf)
+    readinto = getattr(f, 'readinto', None)
+    total = 0
+    while True:
+        if readinto is None:
+            data = f.read(COPY_BUFFER_SIZE)
+            count = len(data)
+        else:
+            count = readinto(buf)
+            data = view[:count]
+        if not count:
+            break
+        if update is not None:
+            update(data)
+        write_all(fd, data)
+        total += count
+    return total
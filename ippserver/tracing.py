@@ -0,0 +1,274 @@
+from __future__ import division
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import cProfile
+import heapq
+import io
+import itertools
+import json
+import os
+import os.path
+import pstats
+import random
+import threading
+import time
+import tracemalloc
+
+from .streams import copy_to_fd, remaining_length
+
+
+# The Tracer for start_trace(), or None to trace nothing
+_tracer = None
+_local = threading.local()
+_trace_ids = itertools.count(1)
+
+
+def set_tracer(tracer):
+    global _tracer
+    _tracer = tracer
+
+
+def current_trace():
+    return getattr(_local, 'trace', None)
+
+
+class Trace(object):
+    """The timings of one request.
+
+    spans are (name, start, duration, depth), in seconds from the start
+    of the trace. totals are time spent in phases which happen bit by bit,
+    like reading the request body.
+    """
+
+    def __init__(self, name, tracer):
+        self.trace_id = next(_trace_ids)
+        # Trace ids are only unique within a process (see ippserver.prefork)
+        self.pid = os.getpid()
+        self.name = name
+        self.tracer = tracer
+        self.time = time.time()
+        self.started = time.perf_counter()
+        self.duration = None
+        self.spans = []
+        self.totals = {}
+        self.attributes = {}
+        self.depth = 0
+        # Set by tracers which profile the request
+        self.profile = None
+        self.memory_before = None
+
+    def add_time(self, name, seconds):
+        self.totals[name] = self.totals.get(name, 0) + seconds
+
+    def as_dict(self):
+        return {
+            'trace_id': self.trace_id,
+            'pid': self.pid,
+            'name': self.name,
+            'time': self.time,
+            'duration': self.duration,
+            'spans': [
+                {'name': name, 'start': start, 'duration': duration, 'depth': depth}
+                for name, start, duration, depth in self.spans],
+            'totals': self.totals,
+            'attributes': self.attributes,
+        }
+
+
+class _Span(object):
+    def __init__(self, trace, name):
+        self.trace = trace
+        self.name = name
+
+    def __enter__(self):
+        self.depth = self.trace.depth
+        self.trace.depth += 1
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        finished = time.perf_counter()
+        self.trace.depth -= 1
+        self.trace.spans.append((
+            self.name, self.started - self.trace.started,
+            finished - self.started, self.depth))
+        return False
+
+
+class _NoSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NO_SPAN = _NoSpan()
+
+
+def span(name):
+    """A context manager timing a phase of the current trace, if any"""
+    trace = getattr(_local, 'trace', None)
+    if trace is None:
+        return _NO_SPAN
+    return _Span(trace, name)
+
+
+def start_trace(name):
+    """Start tracing this thread's request, if the tracer samples it"""
+    tracer = _tracer
+    if tracer is None or not tracer.sample():
+        _local.trace = None
+        return None
+    trace = _local.trace = Trace(name, tracer)
+    tracer.started(trace)
+    return trace
+
+
+def finish_trace():
+    trace = getattr(_local, 'trace', None)
+    if trace is None:
+        return
+    _local.trace = None
+    trace.duration = time.perf_counter() - trace.started
+    trace.tracer.finished(trace)
+
+
+class TimedReader(object):
+    """Wraps a file-like object, adding the time spent reading it to the
+    trace's totals"""
+
+    def __init__(self, f, trace, name='read'):
+        self.f = f
+        self.trace = trace
+        self.name = name
+
+    def _timed(self, function, *args):
+        started = time.perf_counter()
+        try:
+            return function(*args)
+        finally:
+            self.trace.add_time(self.name, time.perf_counter() - started)
+
+    def read(self, size=-1):
+        return self._timed(self.f.read, size)
+
+    def readinto(self, b):
+        readinto = getattr(self.f, 'readinto', None)
+        if readinto is None:
+            block = self.read(len(b))
+            b[:len(block)] = block
+            return len(block)
+        return self._timed(readinto, b)
+
+    def copy_to_fd(self, fd):
+        return self._timed(copy_to_fd, self.f, fd)
+
+    def remaining_length(self):
+        return remaining_length(self.f)
+
+    def close(self):
+        pass
+
+    def __getattr__(self, name):
+        # eg: CountingReader.bytes_read
+        return getattr(self.f, name)
+
+
+class Tracer(object):
+    """Decides which requests to trace, and what to do with the traces.
+
+    A sample_rate fraction of requests are traced. Each finished trace is
+    written as a line of JSON to output (a filename), if given.
+
+    With profile_slowest set, traced requests are also run under cProfile
+    (one at a time, as profilers are per-process), and the profiles of the
+    slowest profile_slowest of them are kept in profile_directory as
+    ipp-server-trace-<pid>-<trace id>.prof, which pstats can read. With
+    trace_memory, a .txt file beside each lists where the request
+    allocated memory.
+    """
+
+    def __init__(self, sample_rate=1.0, output=None, profile_slowest=0,
+                 profile_directory=None, trace_memory=False):
+        self.sample_rate = sample_rate
+        self.output = output
+        self.profile_slowest = profile_slowest
+        self.profile_directory = profile_directory or '.'
+        self.trace_memory = trace_memory
+        self._lock = threading.Lock()
+        self._profiling = threading.Lock()
+        # (duration, trace_id) of the slowest profiled requests
+        self._slowest = []
+        self._output_file = None
+        if output is not None:
+            self._output_file = io.open(output, 'ab')
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def sample(self):
+        return self.sample_rate >= 1 or random.random() < self.sample_rate
+
+    def started(self, trace):
+        if self.profile_slowest and self._profiling.acquire(False):
+            trace.profile = cProfile.Profile()
+            if self.trace_memory:
+                trace.memory_before = tracemalloc.take_snapshot()
+            trace.profile.enable()
+
+    def finished(self, trace):
+        if trace.profile is not None:
+            trace.profile.disable()
+            try:
+                self._keep_if_slow(trace)
+            finally:
+                self._profiling.release()
+        if self._output_file is not None:
+            line = json.dumps(trace.as_dict(), sort_keys=True).encode('utf-8') + b'\n'
+            with self._lock:
+                self._output_file.write(line)
+                self._output_file.flush()
+
+    def _keep_if_slow(self, trace):
+        entry = (trace.duration, trace.trace_id)
+        with self._lock:
+            if len(self._slowest) < self.profile_slowest:
+                heapq.heappush(self._slowest, entry)
+                evicted = None
+            elif entry > self._slowest[0]:
+                evicted = heapq.heapreplace(self._slowest, entry)
+            else:
+                return
+        trace.attributes['profile'] = self._profile_path(trace.trace_id, 'prof')
+        trace.profile.dump_stats(trace.attributes['profile'])
+        if self.trace_memory:
+            statistics = tracemalloc.take_snapshot().compare_to(
+                trace.memory_before, 'lineno')
+            with io.open(self._profile_path(trace.trace_id, 'txt'), 'w') as f:
+                for statistic in statistics[:25]:
+                    f.write('%s\n' % (statistic,))
+        if evicted is not None:
+            for extension in ('prof', 'txt'):
+                try:
+                    os.unlink(self._profile_path(evicted[1], extension))
+                except OSError:
+                    pass
+
+    def _profile_path(self, trace_id, extension):
+        return os.path.join(
+            self.profile_directory,
+            'ipp-server-trace-%d-%d.%s' % (os.getpid(), trace_id, extension))
+
+    def slowest_profiles(self):
+        """pstats.Stats for each kept profile, slowest first"""
+        with self._lock:
+            slowest = sorted(self._slowest, reverse=True)
+        return [
+            pstats.Stats(self._profile_path(trace_id, 'prof'))
+            for _, trace_id in slowest]
+
+    def close(self):
+        if self._output_file is not None:
+            self._output_file.close()
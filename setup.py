@@ -15,8 +15,8 @@ setup(
       long_description='A module which implements enough of IPP to fool CUPS into thinking it is a real printer.',
       version='0.2',
       url='http://github.com/h2g2bob/ipp-server',
-      packages=find_packages(exclude=["tests"]),
-      test_suite="tests.test_request",
+      packages=find_packages(exclude=["tests", "benchmarks"]),
+      test_suite="tests",
       package_data={
         'ippserver': ['data/*'],
       },
@@ -0,0 +1,173 @@
+#! /usr/bin/python
+from __future__ import division
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import sys, os.path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ippserver.aioserver import AsyncIPPServer
+from ippserver.behaviour import RunCommandPrinter, StatelessPrinter
+from ippserver.constants import StatusCodeEnum
+from ippserver.executor import CommandExecutor
+from ippserver.request import IppRequest
+
+import asyncio
+import logging
+import unittest
+
+from tests import test_request
+from tests.test_server import BAD_IPP_HEADERS
+
+
+class RecordingPrinter(StatelessPrinter):
+    def __init__(self):
+        super(RecordingPrinter, self).__init__()
+        self.documents = []
+
+    def handle_postscript(self, _ipp_request, postscript_file):
+        self.documents.append(postscript_file.read())
+
+
+class AsyncRecordingPrinter(RecordingPrinter):
+    async def handle_ipp(self, ipp_request, document):
+        if document is not None:
+            data = b''
+            while True:
+                block = await document.read(7)
+                if not block:
+                    break
+                data += block
+            self.documents.append(data)
+        return self.operation_printer_list_response(ipp_request, None)
+
+
+async def read_response(reader):
+    head = await reader.readuntil(b'\r\n\r\n')
+    while head.startswith(b'HTTP/1.1 100 '):
+        head = await reader.readuntil(b'\r\n\r\n')
+    if b'Content-Length: ' not in head:
+        # 304 Not Modified
+        return head, b''
+    length = int(head.split(b'Content-Length: ')[1].split(b'\r\n')[0])
+    return head, await reader.readexactly(length)
+
+
+def print_job(document):
+    ipp = test_request.TestIppRequest.printer_discovery
+    ipp = ipp[:2] + b'\x00\x02' + ipp[4:]
+    body = ipp + document
+    return b'POST / HTTP/1.1\r\nContent-Length: %d\r\n\r\n%s' % (len(body), body)
+
+
+def run_conversation(behaviour, data, responses):
+    async def conversation():
+        server = AsyncIPPServer(('127.0.0.1', 0), behaviour)
+        await server.start()
+        reader, writer = await asyncio.open_connection(*server.server_address)
+        writer.write(data)
+        received = [await read_response(reader) for _ in range(responses)]
+        writer.close()
+        await server.close()
+        return received
+    return asyncio.run(conversation())
+
+
+class TestAsyncIPPServer(unittest.TestCase):
+    def test_keep_alive(self):
+        get_printer_attributes = test_request.TestIppRequest.printer_discovery
+        post = b'POST / HTTP/1.1\r\nContent-Length: %d\r\n\r\n%s' % (
+            len(get_printer_attributes), get_printer_attributes)
+        responses = run_conversation(
+            RecordingPrinter(),
+            b'GET / HTTP/1.1\r\n\r\n' + post + post, 3)
+        self.assertTrue(responses[0][0].startswith(b'HTTP/1.1 200 '))
+        for head, body in responses[1:]:
+            self.assertIn(b'Connection: keep-alive', head)
+            self.assertEqual(
+                IppRequest.from_string(body).opid_or_status, 0)
+
+    def test_bad_content_length(self):
+        for content_length in (b'-5', b'five'):
+            responses = run_conversation(
+                RecordingPrinter(),
+                b'POST / HTTP/1.1\r\nContent-Length: ' + content_length + b'\r\n\r\nGET / HTTP/1.1\r\n\r\n', 1)
+            head, _body = responses[0]
+            self.assertTrue(head.startswith(b'HTTP/1.1 400 '))
+            self.assertIn(b'Connection: close', head)
+
+    def test_bad_ipp_header(self):
+        post = b'POST / HTTP/1.1\r\nContent-Length: 3\r\n\r\nabc'
+        responses = run_conversation(
+            RecordingPrinter(), post + b'GET / HTTP/1.1\r\n\r\n', 2)
+        self.assertTrue(responses[0][0].startswith(b'HTTP/1.1 400 '))
+        self.assertIn(b'IPP header', responses[0][1])
+        self.assertTrue(responses[1][0].startswith(b'HTTP/1.1 200 '))
+
+    def test_malformed_ipp_header(self):
+        for ipp in BAD_IPP_HEADERS:
+            post = b'POST / HTTP/1.1\r\nContent-Length: %d\r\n\r\n%s' % (len(ipp), ipp)
+            responses = run_conversation(
+                RecordingPrinter(), post + b'GET / HTTP/1.1\r\n\r\n', 2)
+            self.assertTrue(responses[0][0].startswith(b'HTTP/1.1 400 '))
+            self.assertTrue(responses[1][0].startswith(b'HTTP/1.1 200 '))
+
+    def test_not_modified(self):
+        behaviour = RecordingPrinter()
+        etag = behaviour.ppd_page().etag.encode('ascii')
+        responses = run_conversation(
+            behaviour,
+            b'GET /printer.ppd HTTP/1.1\r\nIf-None-Match: ' + etag + b'\r\n\r\n' +
+            b'GET /printer.ppd HTTP/1.1\r\n\r\n', 2)
+        self.assertTrue(responses[0][0].startswith(b'HTTP/1.1 304 '))
+        self.assertIn(b'Connection: keep-alive', responses[0][0])
+        self.assertTrue(responses[1][0].startswith(b'HTTP/1.1 200 '))
+        self.assertIn(b'ETag: ' + etag, responses[1][0])
+        self.assertEqual(responses[1][1], behaviour.ppd.text())
+
+    def test_print_job_in_executor(self):
+        behaviour = RecordingPrinter()
+        chunked = print_job(b'').replace(
+            b'Content-Length: %d' % (len(test_request.TestIppRequest.printer_discovery),),
+            b'Transfer-Encoding: chunked')
+        ipp = chunked.split(b'\r\n\r\n', 1)[1]
+        chunked = chunked.split(b'\r\n\r\n', 1)[0] + b'\r\n\r\n' + (
+            b'%x\r\n%s\r\n' % (len(ipp), ipp) +
+            b'5\r\nhello\r\n6\r\n world\r\n0\r\n\r\n')
+        run_conversation(behaviour, chunked, 1)
+        self.assertEqual(behaviour.documents, [b'hello world'])
+
+    def test_bad_chunk_size(self):
+        ipp = print_job(b'').split(b'\r\n\r\n', 1)[1]
+        head = b'POST / HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n'
+        for size in (b'-5', b'+5'):
+            bad_chunk = size + b'\r\nhello\r\n0\r\n\r\n'
+            for body in (bad_chunk, b'%x\r\n%s\r\n' % (len(ipp), ipp) + bad_chunk):
+                behaviour = RecordingPrinter()
+                head_received, _body = run_conversation(
+                    behaviour, head + body + b'GET / HTTP/1.1\r\n\r\n', 1)[0]
+                self.assertTrue(head_received.startswith(b'HTTP/1.1 400 '))
+                self.assertIn(b'Connection: close', head_received)
+                self.assertEqual(behaviour.documents, [])
+
+    def test_busy_closes_connection(self):
+        commands = CommandExecutor(['true'], max_concurrency=1, max_queued=0)
+        behaviour = RunCommandPrinter(['true'], False, 'ps', executor=commands)
+        with commands._slots.slot():
+            responses = run_conversation(
+                behaviour, print_job(b'%!PS' * 1000) + b'GET / HTTP/1.1\r\n\r\n', 1)
+        head, body = responses[0]
+        self.assertIn(b'Connection: close', head)
+        self.assertEqual(
+            IppRequest.from_buffer(body).opid_or_status, StatusCodeEnum.server_error_busy)
+
+    def test_native_async_behaviour(self):
+        behaviour = AsyncRecordingPrinter()
+        run_conversation(behaviour, print_job(b'x' * 100), 1)
+        self.assertEqual(behaviour.documents, [b'x' * 100])
+
+
+if __name__ == '__main__':
+    logging.getLogger().setLevel(logging.DEBUG)
+    unittest.main()
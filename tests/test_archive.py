@@ -0,0 +1,110 @@
+#! /usr/bin/python
+from __future__ import division
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import sys, os.path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ippserver.archive import DocumentArchive
+from ippserver.behaviour import SaveFilePrinter
+from ippserver.constants import JobStateEnum
+from ippserver.jobs import SqliteJobStore
+
+from io import BytesIO
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+
+class TestDocumentArchive(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.archive = DocumentArchive(self.directory, 'ps')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def blobs(self):
+        return [
+            name
+            for _, _, names in os.walk(os.path.join(self.directory, 'blobs'))
+            for name in names]
+
+    def test_stores_each_document_once(self):
+        first = self.archive.store(1, BytesIO(b'%!PS one'))
+        second = self.archive.store(2, BytesIO(b'%!PS two'))
+        again = self.archive.store(3, BytesIO(b'%!PS one'))
+
+        self.assertEqual(first.digest, hashlib.sha256(b'%!PS one').hexdigest())
+        self.assertEqual((first.duplicate, second.duplicate, again.duplicate), (False, False, True))
+        self.assertEqual(again.path, first.path)
+        self.assertEqual(sorted(self.blobs()), sorted([
+            first.digest + '.ps', second.digest + '.ps']))
+        with open(first.path, 'rb') as f:
+            self.assertEqual(f.read(), b'%!PS one')
+        self.assertEqual(os.listdir(os.path.join(self.directory, 'incoming')), [])
+
+    def test_lookup(self):
+        stored = self.archive.store(7, BytesIO(b'%!PS'))
+        self.assertEqual(self.archive.lookup(7), stored)
+        self.assertTrue(self.archive.has_document(stored.digest))
+        with self.assertRaises(KeyError):
+            self.archive.lookup(8)
+
+    def test_save_file_printer(self):
+        behaviour = SaveFilePrinter(self.directory, 'ps', deduplicate=True)
+        for _ in range(2):
+            job = behaviour.job_store.create_job(b'alice', b'report')
+            behaviour.process_job(job.job_id, None, BytesIO(b'%!PS' * 1000))
+            self.assertEqual(
+                behaviour.job_store.get_job(job.job_id).state, JobStateEnum.completed)
+        self.assertEqual(len(self.blobs()), 1)
+        with open(self.archive.record_path(behaviour.job_store.job_key(job.job_id)), 'rb') as f:
+            record = json.loads(f.read().decode('utf-8'))
+        self.assertEqual(record['user'], 'alice')
+        self.assertEqual(record['name'], 'report')
+        self.assertEqual(record['size'], 4000)
+        self.assertTrue(record['duplicate'])
+
+    def test_job_ids_reused_after_restart(self):
+        records = []
+        for _ in range(2):
+            # Each MemoryJobStore starts again at job 1
+            behaviour = SaveFilePrinter(self.directory, 'ps', deduplicate=True)
+            job = behaviour.job_store.create_job(None, None)
+            self.assertEqual(job.job_id, 1)
+            behaviour.process_job(job.job_id, None, BytesIO(b'%!PS'))
+            records.append(behaviour.archive.record_path(behaviour.job_store.job_key(1)))
+            self.assertEqual(behaviour.document_path(1), self.archive.lookup(
+                behaviour.job_store.job_key(1)).path)
+        self.assertNotEqual(records[0], records[1])
+        self.assertEqual(
+            sorted(os.listdir(os.path.join(self.directory, 'jobs'))),
+            sorted(os.path.basename(record) for record in records))
+
+    def test_job_ids_reused_by_a_new_database(self):
+        # As with --workers, which creates a temporary database each run
+        for run in range(2):
+            behaviour = SaveFilePrinter(
+                self.directory, 'ps', deduplicate=True, job_store=SqliteJobStore(
+                    os.path.join(self.directory, 'jobs-%d.sqlite' % (run,))))
+            job = behaviour.job_store.create_job(None, None)
+            self.assertEqual(job.job_id, 1)
+            behaviour.process_job(job.job_id, None, BytesIO(b'%!PS'))
+            self.assertEqual(
+                behaviour.job_store.get_job(job.job_id).state, JobStateEnum.completed)
+        self.assertEqual(len(os.listdir(os.path.join(self.directory, 'jobs'))), 2)
+
+    def test_never_replaces_a_record(self):
+        self.archive.store(1, BytesIO(b'%!PS one'))
+        self.assertRaises(OSError, self.archive.store, 1, BytesIO(b'%!PS two'))
+        self.assertEqual(self.archive.lookup(1).digest, hashlib.sha256(b'%!PS one').hexdigest())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,417 @@
+#! /usr/bin/python
+from __future__ import division
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import sys, os.path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ippserver.behaviour import RunCommandPrinter, SaveAndRunPrinter, StatelessPrinter
+from ippserver.constants import (
+    JobStateEnum, OperationEnum, PrinterStateEnum, SectionEnum, StatusCodeEnum,
+    TagEnum
+)
+from ippserver.executor import CommandExecutor
+from ippserver.jobs import MemoryJobStore, SqliteJobStore
+from ippserver.parsers import Boolean, Enum, Integer
+from ippserver.request import IppRequest
+from ippserver.spool import JobSpooler
+
+from io import BytesIO
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from tests import test_request
+
+
+def respond(behaviour, opid, requested=None, attributes=None,
+            document=None):
+    req = IppRequest.from_string(test_request.TestIppRequest.printer_discovery)
+    req.opid_or_status = opid
+    requested_key = (SectionEnum.operation, b'requested-attributes', TagEnum.keyword)
+    del req._attributes[requested_key]
+    if requested is not None:
+        req._attributes[requested_key] = requested
+    if attributes is not None:
+        req._attributes.update(attributes)
+    response = behaviour.handle_ipp(req, document)
+    return IppRequest.from_string(response.to_string())
+
+
+class TestStatelessPrinter(unittest.TestCase):
+    def test_charset_is_first(self):
+        response = respond(
+            StatelessPrinter(), OperationEnum.get_printer_attributes)
+        self.assertEqual(list(response._attributes)[:2], [
+            (SectionEnum.operation, b'attributes-charset', TagEnum.charset),
+            (SectionEnum.operation, b'attributes-natural-language', TagEnum.natural_language),
+        ])
+
+
+    def test_printer_attributes_response(self):
+        behaviour = StatelessPrinter()
+        response = respond(behaviour, OperationEnum.get_printer_attributes)
+        expected = behaviour.printer_list_attributes()
+        self.assertEqual(set(response._attributes), set(expected))
+        uptime = (SectionEnum.printer, b'printer-up-time', TagEnum.integer)
+        del response._attributes[uptime], expected[uptime]
+        self.assertEqual(response._attributes, expected)
+
+    def test_printer_attributes_template_is_cached(self):
+        behaviour = StatelessPrinter()
+        template = behaviour.printer_attributes_template()
+        respond(behaviour, OperationEnum.cups_get_default)
+        self.assertIs(behaviour.printer_attributes_template(), template)
+
+        behaviour.printer_uri = b'ipp://example.com/printer'
+        behaviour.invalidate_caches()
+        self.assertIsNot(behaviour.printer_attributes_template(), template)
+        response = respond(behaviour, OperationEnum.get_printer_attributes)
+        self.assertEqual(
+            response.only(SectionEnum.printer, b'printer-uri-supported', TagEnum.uri),
+            b'ipp://example.com/printer')
+
+    def test_subclass_state_keeps_caches(self):
+        class CountingPrinter(StatelessPrinter):
+            def __init__(self):
+                # Does not call StatelessPrinter.__init__
+                self.job_store = MemoryJobStore()
+                self.requests = 0
+
+            def handle_ipp(self, ipp_request, postscript_file):
+                self.requests += 1
+                return super(CountingPrinter, self).handle_ipp(ipp_request, postscript_file)
+
+        behaviour = CountingPrinter()
+        respond(behaviour, OperationEnum.get_printer_attributes)
+        template = behaviour.printer_attributes_template()
+        respond(behaviour, OperationEnum.get_printer_attributes)
+        self.assertEqual(behaviour.requests, 2)
+        self.assertIs(behaviour.printer_attributes_template(), template)
+
+    def test_uncached_printer_attributes(self):
+        class ChangingPrinter(StatelessPrinter):
+            cache_printer_attributes = False
+            printer_info = b'first'
+
+            def printer_list_attributes(self):
+                attributes = super(ChangingPrinter, self).printer_list_attributes()
+                attributes[SectionEnum.printer, b'printer-info', TagEnum.text_without_language] = [
+                    self.printer_info]
+                return attributes
+
+        behaviour = ChangingPrinter()
+        info = (SectionEnum.printer, b'printer-info', TagEnum.text_without_language)
+        for printer_info in (b'first', b'second'):
+            behaviour.printer_info = printer_info
+            response = respond(behaviour, OperationEnum.get_printer_attributes)
+            self.assertEqual(response.only(*info), printer_info)
+
+    def test_overridden_printer_attributes(self):
+        class StoppedPrinter(StatelessPrinter):
+            queued = 3
+
+            def printer_list_attributes(self):
+                attributes = super(StoppedPrinter, self).printer_list_attributes()
+                attributes[state] = [Enum(PrinterStateEnum.stopped).bytes()]
+                attributes[queued] = [Integer(self.queued).bytes()]
+                return attributes
+
+        state = (SectionEnum.printer, b'printer-state', TagEnum.enum)
+        queued = (SectionEnum.printer, b'queued-job-count', TagEnum.integer)
+        behaviour = StoppedPrinter()
+        self.assertFalse(behaviour.caches_printer_attributes())
+        for count in (3, 4):
+            behaviour.queued = count
+            response = respond(behaviour, OperationEnum.get_printer_attributes)
+            self.assertEqual(response.only(*state), Enum(PrinterStateEnum.stopped).bytes())
+            self.assertEqual(response.only(*queued), Integer(count).bytes())
+
+        StoppedPrinter.cache_printer_attributes = True
+        self.assertIs(behaviour.printer_attributes_template(), behaviour.printer_attributes_template())
+
+
+    def test_requested_printer_attributes(self):
+        response = respond(
+            StatelessPrinter(), OperationEnum.get_printer_attributes,
+            [b'printer-state', b'printer-name', b'no-such-attribute'])
+        self.assertEqual(sorted(key[1] for key in response._attributes), [
+            b'attributes-charset', b'attributes-natural-language',
+            b'printer-name', b'printer-state'])
+
+    def test_requested_printer_description(self):
+        behaviour = StatelessPrinter()
+        response = respond(
+            behaviour, OperationEnum.get_printer_attributes,
+            [b'printer-description'])
+        self.assertEqual(
+            set(response._attributes), set(behaviour.printer_list_attributes()))
+
+    def test_requested_job_attributes(self):
+        behaviour = StatelessPrinter()
+        job = behaviour.job_store.create_job(b'user', b'job name')
+        job_id = (SectionEnum.operation, b'job-id', TagEnum.integer)
+        response = respond(
+            behaviour, OperationEnum.get_job_attributes,
+            [b'job-state'], {job_id: [Integer(job.job_id).bytes()]})
+        self.assertEqual(sorted(key[1] for key in response._attributes), [
+            b'attributes-charset', b'attributes-natural-language',
+            b'job-state'])
+
+
+class RecordingPrinter(StatelessPrinter):
+    def handle_postscript(self, _ipp_request, postscript_file):
+        self.document = postscript_file.read()
+
+
+class TestJobs(unittest.TestCase):
+    def print_job(self, behaviour, document):
+        return respond(
+            behaviour, OperationEnum.print_job, document=BytesIO(document))
+
+    def job_ids(self, response):
+        return [
+            Integer.from_bytes(value).integer
+            for value in response.lookup(SectionEnum.job, b'job-id', TagEnum.integer)]
+
+    def test_print_job_is_recorded(self):
+        behaviour = RecordingPrinter()
+        response = self.print_job(behaviour, b'%!PS')
+        job_id, = response.lookup(SectionEnum.operation, b'job-id', TagEnum.integer)
+        job = behaviour.job_store.get_job(Integer.from_bytes(job_id).integer)
+        self.assertEqual(job.state, JobStateEnum.completed)
+        self.assertEqual(job.user, b'user')
+        self.assertEqual(job.size, 4)
+
+        response = respond(
+            behaviour, OperationEnum.get_job_attributes,
+            attributes={(SectionEnum.operation, b'job-id', TagEnum.integer): [job_id]})
+        self.assertEqual(
+            response.only(SectionEnum.operation, b'job-state', TagEnum.enum),
+            Enum(JobStateEnum.completed).bytes())
+
+    def test_get_job_attributes_not_found(self):
+        response = respond(
+            StatelessPrinter(), OperationEnum.get_job_attributes,
+            attributes={(SectionEnum.operation, b'job-id', TagEnum.integer): [Integer(7).bytes()]})
+        self.assertEqual(response.opid_or_status, StatusCodeEnum.client_error_not_found)
+
+    def test_get_jobs(self):
+        behaviour = RecordingPrinter()
+        for _ in range(3):
+            self.print_job(behaviour, b'')
+        pending = behaviour.job_store.create_job(b'someone-else', None)
+
+        response = respond(behaviour, OperationEnum.get_jobs)
+        self.assertEqual(self.job_ids(response), [pending.job_id])
+        self.assertEqual(
+            set(key[1] for key in response._attributes if key[0] == SectionEnum.job),
+            set([b'job-id', b'job-uri']))
+
+        response = respond(behaviour, OperationEnum.get_jobs, attributes={
+            (SectionEnum.operation, b'which-jobs', TagEnum.keyword): [b'completed'],
+            (SectionEnum.operation, b'limit', TagEnum.integer): [Integer(2).bytes()],
+        })
+        self.assertEqual(self.job_ids(response), [3, 2])
+
+        response = respond(behaviour, OperationEnum.get_jobs, attributes={
+            (SectionEnum.operation, b'which-jobs', TagEnum.keyword): [b'all'],
+            (SectionEnum.operation, b'my-jobs', TagEnum.boolean): [Boolean(True).bytes()],
+        })
+        self.assertEqual(self.job_ids(response), [3, 2, 1])
+
+    def test_get_jobs_bad_request(self):
+        behaviour = RecordingPrinter()
+        self.print_job(behaviour, b'')
+        for limit in (0, -1):
+            response = respond(behaviour, OperationEnum.get_jobs, attributes={
+                (SectionEnum.operation, b'limit', TagEnum.integer): [Integer(limit).bytes()],
+            })
+            self.assertEqual(response.opid_or_status, StatusCodeEnum.client_error_bad_request)
+
+        request = IppRequest.from_string(test_request.TestIppRequest.printer_discovery)
+        request.opid_or_status = OperationEnum.get_jobs
+        del request._attributes[
+            SectionEnum.operation, b'requesting-user-name', TagEnum.name_without_language]
+        request._attributes[SectionEnum.operation, b'my-jobs', TagEnum.boolean] = [
+            Boolean(True).bytes()]
+        response = behaviour.handle_ipp(request, None)
+        self.assertEqual(response.opid_or_status, StatusCodeEnum.client_error_bad_request)
+
+    def test_print_job_when_commands_are_busy(self):
+        commands = CommandExecutor(['true'], max_concurrency=1, max_queued=0)
+        behaviour = RunCommandPrinter(['true'], False, 'ps', executor=commands)
+        document = BytesIO(b'%!PS')
+        with commands._slots.slot():
+            response = respond(behaviour, OperationEnum.print_job, document=document)
+        self.assertEqual(response.opid_or_status, StatusCodeEnum.server_error_busy)
+        self.assertEqual(document.tell(), 0)
+        job_id, = response.lookup(SectionEnum.operation, b'job-id', TagEnum.integer)
+        job = behaviour.job_store.get_job(Integer.from_bytes(job_id).integer)
+        self.assertEqual(job.state, JobStateEnum.aborted)
+
+        response = self.print_job(behaviour, b'%!PS')
+        self.assertEqual(response.opid_or_status, StatusCodeEnum.ok)
+
+    def test_save_and_run_when_commands_are_busy(self):
+        for deduplicate in (False, True):
+            directory = tempfile.mkdtemp()
+            self.addCleanup(shutil.rmtree, directory)
+            commands = CommandExecutor(['true'], max_concurrency=1, max_queued=0)
+            behaviour = SaveAndRunPrinter(
+                directory, False, 'ps', ['true'], executor=commands,
+                deduplicate=deduplicate)
+            document = BytesIO(b'%!PS')
+            with commands._slots.slot():
+                response = respond(behaviour, OperationEnum.print_job, document=document)
+            self.assertEqual(response.opid_or_status, StatusCodeEnum.server_error_busy)
+            self.assertEqual(document.tell(), 0)
+            self.assertEqual(
+                [filenames for _, _, filenames in os.walk(directory) if filenames], [])
+
+            response = self.print_job(behaviour, b'%!PS')
+            self.assertEqual(response.opid_or_status, StatusCodeEnum.ok)
+
+
+class BlockingPrinter(StatelessPrinter):
+    def __init__(self):
+        super(BlockingPrinter, self).__init__()
+        self.job_spooler = JobSpooler(workers=1)
+        self.release = threading.Event()
+        self.documents = []
+
+    def handle_postscript(self, _ipp_request, postscript_file):
+        self.release.wait()
+        document = postscript_file.read()
+        if document == b'fail':
+            raise RuntimeError(document)
+        self.documents.append(document)
+
+
+class TestSpooledJobs(unittest.TestCase):
+    def job_state(self, behaviour, response):
+        job_id, = response.lookup(SectionEnum.operation, b'job-id', TagEnum.integer)
+        return behaviour.job_store.get_job(Integer.from_bytes(job_id).integer).state
+
+    def test_reply_before_processing(self):
+        behaviour = BlockingPrinter()
+        response = respond(behaviour, OperationEnum.print_job, document=BytesIO(b'%!PS'))
+        self.assertEqual(
+            response.only(SectionEnum.operation, b'job-state', TagEnum.enum),
+            Enum(JobStateEnum.pending).bytes())
+        self.assertIn(self.job_state(behaviour, response), (
+            JobStateEnum.pending, JobStateEnum.processing))
+
+        behaviour.release.set()
+        behaviour.job_spooler.join()
+        self.assertEqual(self.job_state(behaviour, response), JobStateEnum.completed)
+        self.assertEqual(behaviour.documents, [b'%!PS'])
+        behaviour.job_spooler.close()
+
+    def test_failed_job_is_aborted(self):
+        behaviour = BlockingPrinter()
+        behaviour.release.set()
+        response = respond(behaviour, OperationEnum.print_job, document=BytesIO(b'fail'))
+        behaviour.job_spooler.join()
+        self.assertEqual(self.job_state(behaviour, response), JobStateEnum.aborted)
+        behaviour.job_spooler.close()
+
+
+class TestRecoveredJobs(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.job_store_path = os.path.join(self.directory, 'jobs.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def printer(self, job_store=None, workers=1, durability=None):
+        behaviour = RecordingPrinter(job_store=job_store)
+        behaviour.job_spooler = JobSpooler(
+            directory=self.directory, workers=workers, durability=durability)
+        self.addCleanup(behaviour.job_spooler.close)
+        return behaviour
+
+    def crash(self, behaviour):
+        """Spool a job which is never processed, then release the spool
+        file's lock, as the process dying would"""
+        response = respond(behaviour, OperationEnum.print_job, document=BytesIO(b'%!PS lost'))
+        job_id, = response.lookup(SectionEnum.operation, b'job-id', TagEnum.integer)
+        filename, = behaviour.job_spooler._locks
+        behaviour.job_spooler.release(filename)
+        return Integer.from_bytes(job_id).integer, filename
+
+    def spool_files(self):
+        return [name for name in os.listdir(self.directory) if name.startswith('ipp-server-spool-')]
+
+    def test_recovers_job_under_its_own_id(self):
+        job_id, filename = self.crash(self.printer(SqliteJobStore(self.job_store_path), workers=0))
+        behaviour = self.printer(SqliteJobStore(self.job_store_path))
+        behaviour.recover_spooled_jobs()
+        behaviour.job_spooler.join()
+        self.assertEqual(behaviour.document, b'%!PS lost')
+        self.assertEqual(behaviour.job_store.get_job(job_id).state, JobStateEnum.completed)
+        self.assertEqual(self.spool_files(), [])
+
+    def test_recovers_forgotten_job_as_a_new_job(self):
+        self.crash(self.printer(workers=0))
+        behaviour = self.printer()
+        behaviour.job_store.create_job(None, None)
+        behaviour.recover_spooled_jobs()
+        behaviour.job_spooler.join()
+        self.assertEqual(behaviour.document, b'%!PS lost')
+        job = behaviour.job_store.get_job(2)
+        self.assertEqual((job.state, job.user), (JobStateEnum.completed, b'user'))
+
+    def test_recovers_job_from_another_database_as_a_new_job(self):
+        self.crash(self.printer(SqliteJobStore(self.job_store_path), workers=0))
+        # Another database has an unrelated job 1, which has completed
+        behaviour = self.printer(SqliteJobStore(os.path.join(self.directory, 'new.sqlite')))
+        other = behaviour.job_store.create_job(b'other', None)
+        self.assertEqual(other.job_id, 1)
+        behaviour.job_store.set_state(other.job_id, JobStateEnum.completed)
+        behaviour.recover_spooled_jobs()
+        behaviour.job_spooler.join()
+        self.assertEqual(behaviour.document, b'%!PS lost')
+        job = behaviour.job_store.get_job(2)
+        self.assertEqual((job.state, job.user), (JobStateEnum.completed, b'user'))
+        self.assertEqual(self.spool_files(), [])
+
+    def test_leaves_files_another_process_has(self):
+        first = self.printer(workers=0)
+        respond(first, OperationEnum.print_job, document=BytesIO(b'%!PS'))
+        self.assertEqual(self.printer().job_spooler.recover(), [])
+
+    def test_aborts_partly_received_job(self):
+        job_id, filename = self.crash(self.printer(SqliteJobStore(self.job_store_path), workers=0))
+        os.rename(filename, filename[:-len('.job')] + '.partial')
+        behaviour = self.printer(SqliteJobStore(self.job_store_path))
+        behaviour.recover_spooled_jobs()
+        self.assertEqual(behaviour.job_store.get_job(job_id).state, JobStateEnum.aborted)
+        self.assertEqual(self.spool_files(), [])
+
+    def test_synced(self):
+        synced = []
+
+        class RecordingDurability(object):
+            def sync(self, fd, filename):
+                synced.append(filename)
+
+            def sync_directory(self, directory):
+                synced.append(directory)
+
+        behaviour = self.printer(durability=RecordingDurability())
+        respond(behaviour, OperationEnum.print_job, document=BytesIO(b'%!PS'))
+        behaviour.job_spooler.join()
+        self.assertTrue(synced[0].endswith('.partial'))
+        self.assertEqual(synced[1], self.directory)
+
+
+if __name__ == '__main__':
+    logging.getLogger().setLevel(logging.DEBUG)
+    unittest.main()
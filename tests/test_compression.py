@@ -0,0 +1,146 @@
+#! /usr/bin/python
+from __future__ import division
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import sys, os.path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ippserver.behaviour import SaveFilePrinter
+from ippserver.compression import DecompressingReader
+from ippserver.constants import (
+    JobStateEnum, OperationEnum, SectionEnum, StatusCodeEnum, TagEnum
+)
+from ippserver.streams import COPY_BUFFER_SIZE
+
+from io import BytesIO
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+import zlib
+
+from tests.test_behaviour import respond
+
+
+DOCUMENT = b''.join(b'%%Page: %d\n' % (i,) for i in range(100000))
+
+
+def deflate(data):
+    compressor = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def compression(keyword):
+    return {(SectionEnum.operation, b'compression', TagEnum.keyword): [keyword]}
+
+
+def read_all(reader):
+    return b''.join(iter(reader.read, b''))
+
+
+class TestDecompressingReader(unittest.TestCase):
+    def test_gzip(self):
+        reader = DecompressingReader(BytesIO(gzip.compress(DOCUMENT)), b'gzip')
+        self.assertEqual(read_all(reader), DOCUMENT)
+
+    def test_deflate_in_small_reads(self):
+        reader = DecompressingReader(BytesIO(deflate(DOCUMENT)), b'deflate')
+        blocks = list(iter(lambda: reader.read(1000), b''))
+        self.assertLessEqual(max(len(block) for block in blocks), 1000)
+        self.assertEqual(b''.join(blocks), DOCUMENT)
+
+    def test_truncated(self):
+        for compressed, compression in [
+                (gzip.compress(DOCUMENT), b'gzip'),
+                (deflate(DOCUMENT), b'deflate'),
+                (b'', b'gzip')]:
+            reader = DecompressingReader(BytesIO(compressed[:len(compressed) // 2]), compression)
+            self.assertRaises(zlib.error, read_all, reader)
+
+    def test_concatenated_gzip_members(self):
+        reader = DecompressingReader(
+            BytesIO(gzip.compress(b'a' * 10) + gzip.compress(DOCUMENT)), b'gzip')
+        self.assertEqual(read_all(reader), b'a' * 10 + DOCUMENT)
+
+    def test_data_after_deflate(self):
+        reader = DecompressingReader(BytesIO(deflate(b'a' * 10) + b'junk'), b'deflate')
+        self.assertRaises(zlib.error, read_all, reader)
+
+    def test_output_is_limited(self):
+        bomb = gzip.compress(b'\0' * (COPY_BUFFER_SIZE * 20))
+        for size in (-1, None, COPY_BUFFER_SIZE * 10):
+            reader = DecompressingReader(BytesIO(bomb), b'gzip')
+            self.assertEqual(len(reader.read(size)), COPY_BUFFER_SIZE)
+        self.assertEqual(DecompressingReader(BytesIO(bomb), b'gzip').read(0), b'')
+
+    def test_readinto(self):
+        reader = DecompressingReader(BytesIO(gzip.compress(b'%!PS')), b'gzip')
+        buf = bytearray(100)
+        self.assertEqual(reader.readinto(buf), 4)
+        self.assertEqual(buf[:4], b'%!PS')
+        self.assertEqual(reader.readinto(buf), 0)
+
+
+class TestCompressedPrintJobs(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def saved(self):
+        filename, = os.listdir(self.directory)
+        with open(os.path.join(self.directory, filename), 'rb') as f:
+            return filename, f.read()
+
+    def test_advertised(self):
+        response = respond(SaveFilePrinter(self.directory, 'ps'), OperationEnum.get_printer_attributes)
+        self.assertEqual(
+            response.lookup(SectionEnum.printer, b'compression-supported', TagEnum.keyword),
+            [b'none', b'gzip', b'deflate'])
+
+    def test_decompressed(self):
+        response = respond(
+            SaveFilePrinter(self.directory, 'ps'), OperationEnum.print_job,
+            attributes=compression(b'gzip'), document=BytesIO(gzip.compress(DOCUMENT)))
+        self.assertEqual(response.opid_or_status, StatusCodeEnum.ok)
+        filename, data = self.saved()
+        self.assertTrue(filename.endswith('.ps'))
+        self.assertEqual(data, DOCUMENT)
+
+    def test_truncated_print_job(self):
+        behaviour = SaveFilePrinter(self.directory, 'ps')
+        compressed = gzip.compress(DOCUMENT)
+        response = respond(
+            behaviour, OperationEnum.print_job, attributes=compression(b'gzip'),
+            document=BytesIO(compressed[:len(compressed) // 2]))
+        self.assertEqual(response.opid_or_status, StatusCodeEnum.client_error_compression_error)
+        self.assertEqual(behaviour.job_store.get_job(1).state, JobStateEnum.aborted)
+
+    def test_keep_compressed(self):
+        compressed = deflate(DOCUMENT)
+        respond(
+            SaveFilePrinter(self.directory, 'ps', keep_compressed=True), OperationEnum.print_job,
+            attributes=compression(b'deflate'), document=BytesIO(compressed))
+        filename, data = self.saved()
+        self.assertTrue(filename.endswith('.ps.deflate'))
+        self.assertEqual(data, compressed)
+
+    def test_unsupported(self):
+        for opid in (OperationEnum.print_job, OperationEnum.validate_job):
+            response = respond(
+                SaveFilePrinter(self.directory, 'ps'), opid,
+                attributes=compression(b'compress'), document=BytesIO(b'\x1f\x9d'))
+            self.assertEqual(
+                response.opid_or_status, StatusCodeEnum.client_error_compression_not_supported)
+            self.assertEqual(
+                response.lookup(SectionEnum.unsupported, b'compression', TagEnum.keyword),
+                [b'compress'])
+        self.assertEqual(os.listdir(self.directory), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
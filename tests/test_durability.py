@@ -0,0 +1,106 @@
+#! /usr/bin/python
+from __future__ import division
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import sys, os.path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ippserver import durability
+from ippserver.behaviour import SaveFilePrinter
+
+from io import BytesIO
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+
+class TestDurability(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def save(self, committer, name, synced=None):
+        filename = os.path.join(self.directory, name)
+        with open(filename, 'wb') as f:
+            f.write(b'%!PS')
+            committer.sync(f.fileno(), filename)
+            if synced is not None:
+                synced.append(f.fileno())
+
+    def test_fsync(self):
+        with mock.patch('os.fsync') as fsync, \
+                mock.patch.object(durability, 'fsync_directory') as fsync_directory:
+            synced = []
+            self.save(durability.FsyncEachFile(), 'a', synced)
+        fsync.assert_called_once_with(synced[0])
+        fsync_directory.assert_called_once_with(self.directory)
+
+    def test_group_commit_syncs_and_wakes_every_caller(self):
+        committer = durability.GroupCommit(window=0.2)
+        synced = []
+        with mock.patch('os.fsync') as fsync, \
+                mock.patch.object(durability, 'fsync_directory') as fsync_directory:
+            threads = [
+                threading.Thread(target=self.save, args=(committer, str(i), synced))
+                for i in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join(5)
+                self.assertFalse(thread.is_alive())
+        self.assertEqual(len(synced), 4)
+        self.assertEqual(
+            sorted(call[0][0] for call in fsync.call_args_list), sorted(synced))
+        # Each batch fsyncs the shared directory once, not once per file
+        self.assertEqual(fsync_directory.call_count, committer.batches_committed)
+        fsync_directory.assert_called_with(self.directory)
+
+    def test_group_commit_batches_concurrent_jobs(self):
+        committer = durability.GroupCommit(window=0.2)
+        threads = [
+            threading.Thread(target=self.save, args=(committer, str(i)))
+            for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(os.listdir(self.directory)), 8)
+        self.assertLess(committer.batches_committed, 8)
+
+    def test_group_commit_reports_errors(self):
+        committer = durability.GroupCommit(window=0)
+        fd, filename = tempfile.mkstemp(dir=self.directory)
+        os.close(fd)
+        with self.assertRaises(OSError):
+            committer.sync(fd, filename)
+
+    def test_group_commit_survives_unexpected_errors(self):
+        committer = durability.GroupCommit(window=0)
+        fd, filename = tempfile.mkstemp(dir=self.directory)
+        self.addCleanup(os.close, fd)
+        # A filename which is not a path makes _commit raise TypeError
+        with self.assertRaises(TypeError):
+            committer.sync(fd, None)
+        committer.sync(fd, filename)
+        self.assertEqual(committer.batches_committed, 1)
+
+    def test_save_file_printer(self):
+        committer = durability.GroupCommit(window=0)
+        behaviour = SaveFilePrinter(self.directory, 'ps', durability=committer)
+        behaviour.handle_postscript(None, BytesIO(b'%!PS'))
+        self.assertEqual(committer.batches_committed, 1)
+
+    def test_from_name(self):
+        self.assertIsInstance(durability.durability_from_name('none'), durability.NoSync)
+        self.assertEqual(durability.durability_from_name('group', 0.5).window, 0.5)
+
+
+if __name__ == '__main__':
+    unittest.main()
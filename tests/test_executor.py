@@ -0,0 +1,100 @@
+#! /usr/bin/python
+from __future__ import division
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import sys, os.path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ippserver import executor
+
+from io import BytesIO
+import threading
+import time
+import unittest
+
+
+# Reads each document, and fails jobs with the argument "fail"
+WORKER = '''
+import json, sys
+stdin = sys.stdin.buffer
+while True:
+    header = stdin.readline()
+    if not header:
+        break
+    job = json.loads(header)
+    while True:
+        length = int(stdin.readline(), 16)
+        if not length:
+            break
+        stdin.read(length)
+    if job["args"] == ["sleep"]:
+        import time; time.sleep(10)
+    sys.stdout.write(json.dumps({
+        "status": 1 if job["args"] == ["fail"] else 0,
+    }) + "\\n")
+    sys.stdout.flush()
+'''
+
+
+class TestCommandExecutor(unittest.TestCase):
+    def test_runs_command(self):
+        executor.CommandExecutor(['sh', '-c', 'test "$(cat)" = "%!PS"']).run(
+            document=BytesIO(b'%!PS'))
+
+    def test_exit_code(self):
+        with self.assertRaises(executor.CommandFailed):
+            executor.CommandExecutor(['sh', '-c', 'exit "$0"']).run(['3'])
+
+    def test_timeout_kills_children(self):
+        started = time.time()
+        with self.assertRaises(executor.CommandTimedOut):
+            executor.CommandExecutor(['sh', '-c', 'sleep 10; true'], timeout=0.2).run()
+        self.assertLess(time.time() - started, 5)
+
+    def test_concurrency_limit(self):
+        commands = executor.CommandExecutor(
+            ['sleep', '0.5'], max_concurrency=1, max_queued=1)
+        threads = [threading.Thread(target=commands.run) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        while commands.queue_depth() == 0:
+            time.sleep(0.01)
+        self.assertEqual(commands.running(), 1)
+        with self.assertRaises(executor.ExecutorBusy):
+            commands.run()
+        for thread in threads:
+            thread.join()
+
+
+class TestWorkerProcessExecutor(unittest.TestCase):
+    def setUp(self):
+        self.workers = executor.WorkerProcessExecutor(
+            [sys.executable, '-c', WORKER], max_concurrency=2, timeout=2)
+
+    def tearDown(self):
+        self.workers.close()
+
+    def test_reuses_worker(self):
+        self.workers.run(document=BytesIO(b'%!PS' * 1000000))
+        worker, = self.workers._idle
+        self.workers.run(['a'], env={'IPP_JOB_ATTRIBUTES': '{}'})
+        self.assertEqual(self.workers._idle, [worker])
+
+    def test_failed_job_keeps_worker(self):
+        with self.assertRaises(executor.CommandFailed):
+            self.workers.run(['fail'])
+        self.assertEqual(len(self.workers._idle), 1)
+
+    def test_timeout_replaces_worker(self):
+        self.workers.timeout = 0.2
+        with self.assertRaises(executor.CommandTimedOut):
+            self.workers.run(['sleep'])
+        self.assertEqual(self.workers._idle, [])
+        self.workers.timeout = 2
+        self.workers.run()
+
+
+if __name__ == '__main__':
+    unittest.main()
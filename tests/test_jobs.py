@@ -0,0 +1,99 @@
+#! /usr/bin/python
+from __future__ import division
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import sys, os.path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ippserver.constants import JobStateEnum
+from ippserver.jobs import MemoryJobStore, SqliteJobStore
+
+import logging
+import shutil
+import tempfile
+import unittest
+
+
+class JobStoreTests(object):
+    def test_job_ids_are_unique(self):
+        store = self.make_store()
+        ids = [store.create_job(b'user', b'name').job_id for _ in range(5)]
+        self.assertEqual(ids, sorted(set(ids)))
+
+    def test_get_job(self):
+        store = self.make_store()
+        job = store.create_job(b'user', b'name')
+        store.set_state(job.job_id, JobStateEnum.processing)
+        store.set_size(job.job_id, 1234)
+        store.set_state(job.job_id, JobStateEnum.completed)
+        job = store.get_job(job.job_id)
+        self.assertEqual(job.state, JobStateEnum.completed)
+        self.assertEqual((job.user, job.name, job.size), (b'user', b'name', 1234))
+        self.assertTrue(job.time_created <= job.time_processing <= job.time_completed)
+        self.assertRaises(KeyError, store.get_job, job.job_id + 1)
+
+    def test_list_jobs(self):
+        store = self.make_store()
+        jobs = [store.create_job(user, None).job_id for user in (b'a', b'b', b'a', b'b')]
+        store.set_state(jobs[2], JobStateEnum.aborted)
+        store.set_state(jobs[0], JobStateEnum.completed)
+
+        def ids(*args, **kwargs):
+            return [job.job_id for job in store.list_jobs(*args, **kwargs)]
+
+        self.assertEqual(ids(), [jobs[1], jobs[3]])
+        self.assertEqual(ids('completed'), [jobs[0], jobs[2]])
+        self.assertEqual(ids('completed', limit=1), [jobs[0]])
+        self.assertEqual(ids('all', user=b'a'), [jobs[0], jobs[2]])
+        self.assertEqual(ids('all', limit=3), [jobs[1], jobs[3], jobs[0]])
+        self.assertEqual(ids('all', limit=0), [])
+        self.assertRaises(ValueError, store.list_jobs, 'all', limit=-1)
+        self.assertEqual(store.count_jobs(), 2)
+        self.assertEqual(store.count_jobs('completed', user=b'b'), 0)
+        self.assertEqual(store.count_jobs('all'), 4)
+
+
+class TestMemoryJobStore(JobStoreTests, unittest.TestCase):
+    def make_store(self):
+        return MemoryJobStore()
+
+    def test_forgets_old_jobs(self):
+        store = MemoryJobStore(max_completed_jobs=2)
+        jobs = [store.create_job(b'user', None).job_id for _ in range(3)]
+        for job_id in jobs:
+            store.set_state(job_id, JobStateEnum.completed)
+        self.assertRaises(KeyError, store.get_job, jobs[0])
+        self.assertEqual(store.count_jobs('completed', user=b'user'), 2)
+
+
+class TestSqliteJobStore(JobStoreTests, unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def make_store(self):
+        return SqliteJobStore(os.path.join(self.directory, 'jobs.sqlite'))
+
+    def test_shared_database(self):
+        first = self.make_store()
+        second = self.make_store()
+        job = first.create_job(b'user', None)
+        self.assertEqual(second.get_job(job.job_id).user, b'user')
+        self.assertEqual(second.create_job(None, None).job_id, job.job_id + 1)
+        self.assertEqual(first.job_key(job.job_id), second.job_key(job.job_id))
+
+    def test_job_keys_differ_between_databases(self):
+        first = self.make_store()
+        other = SqliteJobStore(os.path.join(self.directory, 'other.sqlite'))
+        self.assertEqual(first.create_job(None, None).job_id, other.create_job(None, None).job_id)
+        self.assertNotEqual(first.job_key(1), other.job_key(1))
+        self.assertEqual(self.make_store().job_key(1), first.job_key(1))
+
+
+if __name__ == '__main__':
+    logging.getLogger().setLevel(logging.DEBUG)
+    unittest.main()
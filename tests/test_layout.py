@@ -0,0 +1,139 @@
+#! /usr/bin/python
+from __future__ import division
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import sys, os.path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ippserver import layout
+from ippserver.behaviour import SaveFilePrinter
+from ippserver.constants import JobStateEnum
+from ippserver.jobs import SqliteJobStore
+
+from io import BytesIO
+import calendar
+import os
+import shutil
+import tempfile
+import unittest
+
+
+class TestLayouts(unittest.TestCase):
+    when = calendar.timegm((2024, 2, 29, 12, 0, 0))
+
+    def test_flat(self):
+        self.assertEqual(layout.layout_from_name('flat').subdirectory('a.ps', self.when), '')
+
+    def test_date(self):
+        self.assertEqual(
+            layout.layout_from_name('date').subdirectory('a.ps', self.when), '2024/02/29')
+
+    def test_hash(self):
+        sharded = layout.ShardedLayout(by_date=True, hash_levels=2)
+        date, first, second = sharded.subdirectory('a.ps', self.when).rsplit('/', 2)
+        self.assertEqual(date, '2024/02/29')
+        self.assertRegex(first + second, '^[0-9a-f]{4}$')
+        self.assertEqual(sharded.subdirectory('a.ps', self.when), sharded.subdirectory('a.ps', self.when))
+
+
+class TestShardedSaveFilePrinter(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def save(self, behaviour, data):
+        job = behaviour.job_store.create_job(None, None)
+        behaviour.process_job(job.job_id, None, BytesIO(data))
+        return job.job_id
+
+    def test_saves_in_subdirectories(self):
+        behaviour = SaveFilePrinter(
+            self.directory, 'ps', layout=layout.layout_from_name('date+hash'))
+        job_ids = [self.save(behaviour, b'%!PS' + str(i).encode('ascii')) for i in range(3)]
+        for i, job_id in enumerate(job_ids):
+            path = behaviour.document_path(job_id)
+            self.assertEqual(len(os.path.relpath(path, self.directory).split(os.sep)), 5)
+            with open(path, 'rb') as f:
+                self.assertEqual(f.read(), b'%!PS' + str(i).encode('ascii'))
+
+        reopened = layout.JobPathIndex(self.directory)
+        self.assertEqual(
+            reopened.lookup(behaviour.job_store.job_key(job_ids[0])),
+            behaviour.document_path(job_ids[0]))
+        with self.assertRaises(KeyError):
+            reopened.lookup(behaviour.job_store.job_key(1000))
+
+    def test_job_ids_reused_after_restart(self):
+        paths = []
+        for data in (b'%!PS first run', b'%!PS second run'):
+            # Each MemoryJobStore starts again at job 1
+            behaviour = SaveFilePrinter(
+                self.directory, 'ps', layout=layout.layout_from_name('hash'))
+            self.assertEqual(self.save(behaviour, data), 1)
+            paths.append(behaviour.document_path(1))
+            behaviour.index.close()
+        self.assertNotEqual(paths[0], paths[1])
+        with open(paths[0], 'rb') as f:
+            self.assertEqual(f.read(), b'%!PS first run')
+
+    def test_job_ids_reused_by_a_new_database(self):
+        # As with --workers, which creates a temporary database each run
+        paths = []
+        for run in range(2):
+            behaviour = SaveFilePrinter(
+                self.directory, 'ps', layout=layout.layout_from_name('hash'),
+                job_store=SqliteJobStore(
+                    os.path.join(self.directory, 'jobs-%d.sqlite' % (run,))))
+            self.assertEqual(self.save(behaviour, b'%!PS'), 1)
+            self.assertEqual(
+                behaviour.job_store.get_job(1).state, JobStateEnum.completed)
+            paths.append(behaviour.document_path(1))
+            behaviour.index.close()
+        self.assertNotEqual(paths[0], paths[1])
+
+    def test_index_never_replaces_a_path(self):
+        index = layout.JobPathIndex(self.directory)
+        self.addCleanup(index.close)
+        index.add('1', os.path.join(self.directory, 'a.ps'))
+        self.assertRaises(ValueError, index.add, '1', os.path.join(self.directory, 'b.ps'))
+        self.assertEqual(index.lookup('1'), os.path.join(self.directory, 'a.ps'))
+
+    def test_syncs_new_directories(self):
+        class RecordingDurability(object):
+            def __init__(self):
+                self.directories = []
+
+            def sync_directory(self, directory):
+                self.directories.append(directory)
+
+        durability = RecordingDurability()
+        sharded = layout.ShardedLayout(by_date=True, hash_levels=0)
+        path = layout.make_path(
+            self.directory, sharded, 'a.ps', TestLayouts.when, durability)
+        self.assertEqual(path, os.path.join(self.directory, '2024', '02', '29', 'a.ps'))
+        self.assertEqual(durability.directories, [
+            self.directory,
+            os.path.join(self.directory, '2024'),
+            os.path.join(self.directory, '2024', '02')])
+        layout.make_path(self.directory, sharded, 'b.ps', TestLayouts.when, durability)
+        self.assertEqual(len(durability.directories), 3)
+
+    def test_deduplicated(self):
+        behaviour = SaveFilePrinter(
+            self.directory, 'ps', deduplicate=True,
+            layout=layout.layout_from_name('date'))
+        first, second = self.save(behaviour, b'%!PS'), self.save(behaviour, b'%!PS')
+        self.assertEqual(behaviour.document_path(first), behaviour.document_path(second))
+        key = behaviour.job_store.job_key
+        self.assertTrue(behaviour.archive.lookup(key(second)).duplicate)
+        self.assertNotEqual(
+            os.path.dirname(behaviour.archive.record_path(key(first))),
+            os.path.join(self.directory, 'jobs'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+#! /usr/bin/python
+from __future__ import division
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import sys, os.path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ippserver import metrics
+from ippserver.behaviour import StatelessPrinter
+from ippserver.constants import OperationEnum
+from ippserver.server import www_response
+
+import unittest
+
+from tests.test_behaviour import respond
+
+
+class TestMetrics(unittest.TestCase):
+    def test_counter(self):
+        counter = metrics.Counter('jobs_total', 'Jobs', ('queue',))
+        counter.inc(labels=('a"b',))
+        counter.inc(2, labels=('a"b',))
+        self.assertEqual(counter.render(), [
+            '# HELP jobs_total Jobs',
+            '# TYPE jobs_total counter',
+            'jobs_total{queue="a\\"b"} 3',
+        ])
+
+    def test_unlabelled_starts_at_zero(self):
+        self.assertEqual(metrics.Counter('bytes_total', 'Bytes').render()[-1], 'bytes_total 0')
+        self.assertEqual(metrics.Histogram('seconds', 'Time').render()[-1], 'seconds_count 0')
+
+    def test_gauge_function(self):
+        gauge = metrics.Gauge('depth', 'Depth', function=lambda: 7)
+        self.assertEqual(gauge.render()[-1], 'depth 7')
+
+    def test_histogram(self):
+        histogram = metrics.Histogram('latency_seconds', 'Latency', buckets=(0.1, 1))
+        for value in (0.05, 0.1, 0.5, 5):
+            histogram.observe(value)
+        self.assertEqual(histogram.render()[2:], [
+            'latency_seconds_bucket{le="0.1"} 2',
+            'latency_seconds_bucket{le="1.0"} 3',
+            'latency_seconds_bucket{le="+Inf"} 4',
+            'latency_seconds_sum 5.65',
+            'latency_seconds_count 4',
+        ])
+
+    def test_enum_label(self):
+        self.assertEqual(metrics.enum_label(OperationEnum, 0x000b), 'get_printer_attributes')
+        self.assertEqual(metrics.enum_label(OperationEnum, 0x7fff), '0x7fff')
+
+
+class TestMetricsEndpoint(unittest.TestCase):
+    def test_records_ipp_requests(self):
+        labels = ('get_printer_attributes', 'ok')
+        before = metrics.IPP_REQUESTS.value(labels)
+        count_before = metrics.IPP_REQUEST_DURATION.count(labels[:1])
+        respond(StatelessPrinter(), OperationEnum.get_printer_attributes)
+        self.assertEqual(metrics.IPP_REQUESTS.value(labels), before + 1)
+        self.assertEqual(metrics.IPP_REQUEST_DURATION.count(labels[:1]), count_before + 1)
+
+        status, content_type, body, _headers = www_response(StatelessPrinter(), '/metrics')
+        self.assertEqual(status, 200)
+        self.assertTrue(content_type.startswith('text/plain; version=0.0.4'))
+        self.assertIn(
+            b'ipp_requests_total{operation="get_printer_attributes",status="ok"} ', body)
+        self.assertIn(b'ipp_active_connections ', body)
+
+
+if __name__ == '__main__':
+    unittest.main()
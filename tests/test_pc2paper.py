@@ -0,0 +1,95 @@
+#! /usr/bin/python
+from __future__ import division
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import sys, os.path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+try:
+    from ippserver import pc2paper
+except ImportError:  # requests is not installed
+    pc2paper = None
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import threading
+import unittest
+
+
+class FakePc2PaperHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        method = self.path.rsplit('/', 1)[1]
+        with self.server.lock:
+            self.server.requests.append((method, body))
+        if method == 'UploadDocument':
+            result = {'ErrorMessages': [], 'FileCreatedGUID': 'guid-%d' % (len(body['fileContent']),)}
+        else:
+            result = {'ErrorMessages': []}
+        response = json.dumps({'d': result}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, *args):
+        pass
+
+
+@unittest.skipIf(pc2paper is None, 'requests is not installed')
+class TestPc2Paper(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), FakePc2PaperHandler)
+        self.server.daemon_threads = True
+        self.server.requests = []
+        self.server.lock = threading.Lock()
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.api = pc2paper.Pc2Paper(
+            username='user', password='pass', name='Name',
+            address1='1 Street', address2='', address3='Town', address4='',
+            postcode='AB1 2CD', country=1, postage=3, paper=4, envelope=1,
+            extras=0, base_url='http://127.0.0.1:%d/json/' % (self.server.server_address[1],))
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_json_int_array(self):
+        data = bytes(bytearray(range(256))) * 3
+        self.assertEqual(json.loads(pc2paper.json_int_array(data)), list(bytearray(data)))
+        self.assertEqual(pc2paper.json_int_array(b''), b'[]')
+
+    def test_post_pdf_letter(self):
+        self.api.post_pdf_letter('job.pdf', b'%PDF-1.4\xff')
+        (upload, upload_body), (post, post_body) = self.server.requests
+        self.assertEqual(upload, 'UploadDocument')
+        self.assertEqual(upload_body['filename'], 'job.pdf')
+        self.assertEqual(upload_body['fileContent'], list(bytearray(b'%PDF-1.4\xff')))
+        self.assertEqual(post, 'SendSubmitLetterForPosting')
+        self.assertEqual(post_body['letterForPosting']['FileAttachementGUIDs'], ['guid-9'])
+
+    def test_concurrent_uploads(self):
+        threads = [
+            threading.Thread(
+                target=self.api.post_pdf_letter, args=('%d.pdf' % (i,), b'%PDF' * i))
+            for i in range(1, 9)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        uploads = [body for method, body in self.server.requests if method == 'UploadDocument']
+        self.assertEqual(sorted(body['filename'] for body in uploads), sorted('%d.pdf' % (i,) for i in range(1, 9)))
+        posted = [
+            body['letterForPosting']['FileAttachementGUIDs'][0]
+            for method, body in self.server.requests if method != 'UploadDocument']
+        self.assertEqual(sorted(posted), sorted('guid-%d' % (4 * i,) for i in range(1, 9)))
+
+if __name__ == '__main__':
+    unittest.main()
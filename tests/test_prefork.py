@@ -0,0 +1,137 @@
+#! /usr/bin/python
+from __future__ import division
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import sys, os.path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ippserver import prefork
+from ippserver.behaviour import SaveFilePrinter
+from ippserver.constants import SectionEnum, TagEnum
+from ippserver.jobs import SqliteJobStore
+from ippserver.parsers import Integer
+from ippserver.request import IppRequest
+from ippserver.server import IPPServer, IPPRequestHandler, run_server
+
+from benchmarks.parse import cups_print_job
+
+try:
+    from http.client import HTTPConnection
+except ImportError:
+    from httplib import HTTPConnection
+import logging
+import os
+import shutil
+import signal
+import socket
+import tempfile
+import threading
+import time
+import unittest
+
+
+def wait_for(condition, timeout=10):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            raise AssertionError('Timed out')
+        time.sleep(0.01)
+
+
+class TestSupervisor(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.job_store_path = os.path.join(self.directory, 'jobs.sqlite')
+        SqliteJobStore(self.job_store_path).close()
+        self.supervisor = None
+
+    def tearDown(self):
+        if self.supervisor is not None:
+            self.supervisor.stop()
+            self.thread.join()
+        shutil.rmtree(self.directory)
+
+    def start(self, workers, reuse_port):
+        sock = prefork.bind_socket(('127.0.0.1', 0), reuse_port=reuse_port)
+        self.address = sock.getsockname()
+
+        def serve(_index):
+            server = IPPServer(
+                self.address, IPPRequestHandler,
+                SaveFilePrinter(
+                    self.directory, 'ps',
+                    job_store=SqliteJobStore(self.job_store_path)),
+                listen_socket=None if reuse_port else sock,
+                reuse_port=reuse_port)
+            run_server(server)
+
+        self.supervisor = prefork.Supervisor(serve, workers, restart_delay=0.1)
+        self.thread = threading.Thread(target=self.supervisor.run)
+        self.thread.start()
+        self.addCleanup(sock.close)
+        wait_for(lambda: len(self.supervisor.pids()) == workers)
+
+    def print_job(self):
+        """Send a Print-Job on a new connection, returning the job id"""
+        body = cups_print_job() + b'%!PS\n'
+        deadline = time.time() + 10
+        while True:
+            connection = HTTPConnection(*self.address)
+            try:
+                connection.request('POST', '/printer', body, {
+                    'Content-Type': 'application/ipp',
+                    'Connection': 'close'})
+                response = connection.getresponse()
+                break
+            except socket.error:
+                # With SO_REUSEPORT, until a worker is listening
+                if time.time() > deadline:
+                    raise
+                time.sleep(0.05)
+            finally:
+                connection.close()
+        self.assertEqual(response.status, 200)
+        reply = IppRequest.from_buffer(response.read())
+        return Integer.from_bytes(
+            reply.only(SectionEnum.operation, b'job-id', TagEnum.integer)).integer
+
+    def check_job_ids_are_unique(self, reuse_port):
+        self.start(3, reuse_port)
+        job_ids = [self.print_job() for _ in range(12)]
+        self.assertEqual(sorted(job_ids), list(range(1, 13)))
+        job_store = SqliteJobStore(self.job_store_path)
+        self.addCleanup(job_store.close)
+        self.assertEqual(job_store.count_jobs('all'), 12)
+
+    def test_shared_socket(self):
+        self.check_job_ids_are_unique(reuse_port=False)
+
+    @unittest.skipUnless(prefork.reuse_port_supported(), 'No SO_REUSEPORT')
+    def test_reuse_port(self):
+        self.check_job_ids_are_unique(reuse_port=True)
+
+    def test_restarts_workers(self):
+        self.start(2, reuse_port=False)
+        killed = self.supervisor.pids()[0]
+        os.kill(killed, signal.SIGKILL)
+        wait_for(lambda: self.supervisor.restarts == 1 and len(self.supervisor.pids()) == 2)
+        self.assertNotIn(killed, self.supervisor.pids())
+        self.assertEqual(self.print_job(), 1)
+
+    def test_stop(self):
+        self.start(2, reuse_port=False)
+        pids = self.supervisor.pids()
+        self.supervisor.stop()
+        self.thread.join(10)
+        self.assertFalse(self.thread.is_alive())
+        self.assertEqual(self.supervisor.pids(), [])
+        self.assertEqual(self.supervisor.restarts, 0)
+        for pid in pids:
+            self.assertRaises(OSError, os.kill, pid, 0)
+
+
+if __name__ == '__main__':
+    logging.getLogger().setLevel(logging.DEBUG)
+    unittest.main()
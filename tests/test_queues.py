@@ -0,0 +1,114 @@
+#! /usr/bin/python
+from __future__ import division
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import sys, os.path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ippserver.behaviour import StatelessPrinter
+from ippserver.constants import OperationEnum, SectionEnum, StatusCodeEnum, TagEnum
+from ippserver.ppd import BasicPdfPPD, BasicPostscriptPPD
+from ippserver.queues import PrinterQueues
+from ippserver.request import IppRequest
+from ippserver.server import IPPRequestHandler, IPPServer
+
+import logging
+import unittest
+
+from tests import test_request
+from tests.test_behaviour import respond
+from tests.test_server import MockConnection, MockServer
+
+
+class TestPrinterQueues(unittest.TestCase):
+    def setUp(self):
+        self.office = StatelessPrinter(ppd=BasicPdfPPD())
+        self.labels = StatelessPrinter(ppd=BasicPostscriptPPD())
+        self.queues = PrinterQueues(base_uri=b'ipp://example.com:631/')
+        self.queues.add('office', self.office)
+        self.queues.add('labels', self.labels)
+
+    def test_routing(self):
+        self.assertIs(self.queues.behaviour_for_path('/printers/office'), self.office)
+        self.assertIs(self.queues.behaviour_for_path('/printers/labels/'), self.labels)
+        self.assertIs(self.queues.behaviour_for_path('/printers/labels?x=1'), self.labels)
+        self.assertIs(self.queues.behaviour_for_path('/printers/office/job/3'), self.office)
+        self.assertIsNone(self.queues.behaviour_for_path('/printers/other'))
+        self.assertIsNone(self.queues.behaviour_for_path('/printers/'))
+        self.assertIsNone(self.queues.behaviour_for_path('/office'))
+
+    def test_names(self):
+        self.assertRaises(ValueError, self.queues.add, 'office', StatelessPrinter())
+        self.assertRaises(ValueError, self.queues.add, 'has space', StatelessPrinter())
+        self.assertRaises(ValueError, self.queues.add, '../etc', StatelessPrinter())
+        self.assertEqual(list(self.queues.queues), ['office', 'labels'])
+
+    def test_printer_attributes(self):
+        response = respond(
+            self.labels, OperationEnum.get_printer_attributes,
+            requested=[b'printer-uri-supported', b'printer-name'])
+        self.assertEqual(
+            response.only(SectionEnum.printer, b'printer-uri-supported', TagEnum.uri),
+            b'ipp://example.com:631/printers/labels')
+        self.assertEqual(
+            response.only(SectionEnum.printer, b'printer-name', TagEnum.name_without_language),
+            b'labels')
+
+
+class TestQueueRequests(unittest.TestCase):
+    def handle(self, data):
+        queues = PrinterQueues()
+        queues.add('office', StatelessPrinter(ppd=BasicPdfPPD()))
+        queues.add('labels', StatelessPrinter(ppd=BasicPostscriptPPD()))
+        connection = MockConnection(data)
+        IPPRequestHandler(connection, "127.0.0.1", MockServer(queues))
+        return connection.sent.getvalue()
+
+    def test_ppd_for_each_queue(self):
+        office = self.handle(b'GET /printers/office.ppd HTTP/1.1\r\nConnection: close\r\n\r\n')
+        labels = self.handle(b'GET /printers/labels.ppd HTTP/1.1\r\nConnection: close\r\n\r\n')
+        self.assertTrue(office.startswith(b'HTTP/1.1 200 '))
+        self.assertTrue(labels.startswith(b'HTTP/1.1 200 '))
+        self.assertIn(BasicPdfPPD().text(), office)
+        self.assertIn(BasicPostscriptPPD().text(), labels)
+
+    def test_unknown_queue(self):
+        sent = self.handle(
+            b'GET /printers/other.ppd HTTP/1.1\r\n\r\n'
+            b'POST /printers/other HTTP/1.1\r\nContent-Type: application/ipp\r\n'
+            b'Content-Length: 0\r\nConnection: close\r\n\r\n')
+        self.assertEqual(sent.count(b'HTTP/1.1 404 '), 2)
+
+
+class TestThreadsPerQueue(unittest.TestCase):
+    def test_busy_queue_does_not_hold_up_others(self):
+        queues = PrinterQueues()
+        queues.add('office', StatelessPrinter(ppd=BasicPdfPPD()))
+        queues.add('labels', StatelessPrinter(ppd=BasicPostscriptPPD()))
+        server = IPPServer(
+            ('127.0.0.1', 0), IPPRequestHandler, queues, workers=4)
+        self.addCleanup(server.server_close)
+        labels = server.queue_slots(queues.queues['labels'])
+        # Both of the labels queue's threads are busy
+        for _ in range(2):
+            self.assertTrue(labels.acquire(False))
+
+        ipp = test_request.TestIppRequest.printer_discovery
+        for name, status in (
+                ('labels', StatusCodeEnum.server_error_busy),
+                ('office', StatusCodeEnum.ok)):
+            connection = MockConnection(
+                b'POST /printers/%s HTTP/1.1\r\nContent-Length: %d\r\n\r\n%s' % (
+                    name.encode('ascii'), len(ipp), ipp))
+            IPPRequestHandler(connection, "127.0.0.1", server)
+            head, body = connection.sent.getvalue().split(b'\r\n\r\n', 1)
+            self.assertTrue(head.startswith(b'HTTP/1.1 200 '))
+            self.assertEqual(IppRequest.from_buffer(body).opid_or_status, status)
+        self.assertIsNone(server.queue_slots(queues))
+
+
+if __name__ == '__main__':
+    logging.getLogger().setLevel(logging.DEBUG)
+    unittest.main()
@@ -9,11 +9,13 @@ sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from ippserver.server import IPPRequestHandler
 from ippserver.constants import OperationEnum, TagEnum, SectionEnum
-from ippserver.request import IppRequest
+from ippserver.request import IppParseError, IppRequest
 from ippserver.behaviour import RejectAllPrinter
+from benchmarks import corpus, fuzz
 
 from io import BytesIO
 import logging
+import struct
 import unittest
 
 class TestIppRequest(unittest.TestCase):
@@ -39,6 +41,58 @@ class TestIppRequest(unittest.TestCase):
         msg = IppRequest.from_string(self.printer_discovery)
         self.assertRaises(KeyError, msg.lookup, SectionEnum.operation, b'no-exist', TagEnum.charset)
 
+    def test_from_buffer_matches_from_file(self):
+        from_file = IppRequest.from_file(BytesIO(self.printer_discovery))
+        from_buffer = IppRequest.from_buffer(bytearray(self.printer_discovery))
+        self.assertEqual(from_buffer.version, from_file.version)
+        self.assertEqual(from_buffer.opid_or_status, from_file.opid_or_status)
+        self.assertEqual(from_buffer.request_id, from_file.request_id)
+        self.assertEqual(from_buffer._attributes, from_file._attributes)
+
+    def test_from_buffer_at(self):
+        data = b'xx' + self.printer_discovery + b'document'
+        msg, end = IppRequest.from_buffer_at(memoryview(data), 2)
+        self.assertEqual(data[end:], b'document')
+        self.assertEqual(msg.only(SectionEnum.operation, b'requesting-user-name', TagEnum.name_without_language), b'user')
+
+    def test_from_buffer_truncated(self):
+        for length in (3, 20, 30, len(self.printer_discovery) - 1):
+            self.assertRaises(
+                IppParseError, IppRequest.from_buffer, self.printer_discovery[:length])
+            self.assertRaises(
+                struct.error, IppRequest.from_buffer_at, self.printer_discovery[:length], 0)
+
+    def test_negative_lengths(self):
+        header = b'\x01\x01\x00\x0b\x00\x00\x00\x01\x01'
+        for attribute in (b'D\xff\xff', b'D\x00\x01a\xff\xff'):
+            data = header + attribute + b'the document'
+            self.assertRaises(IppParseError, IppRequest.from_buffer, data)
+            self.assertRaises(IppParseError, IppRequest.from_file, BytesIO(data))
+
+    def test_from_file_truncated(self):
+        for length in (3, 20, 30, len(self.printer_discovery) - 1):
+            self.assertRaises(
+                IppParseError, IppRequest.from_file, BytesIO(self.printer_discovery[:length]))
+
+    def test_to_string_keeps_attribute_order(self):
+        msg = IppRequest.from_string(self.printer_discovery)
+        reparsed = IppRequest.from_string(msg.to_string())
+        self.assertEqual(list(reparsed._attributes), list(msg._attributes))
+        self.assertEqual(reparsed._attributes, msg._attributes)
+
+    def test_to_string_groups_sections(self):
+        msg = IppRequest((1, 1), 0, 1, {
+            (SectionEnum.printer, b'b', TagEnum.keyword): [b'1'],
+            (SectionEnum.operation, b'a', TagEnum.keyword): [b'2', b'3'],
+            (SectionEnum.printer, b'c', TagEnum.keyword): [b''],
+        })
+        self.assertEqual(
+            msg.to_string(),
+            b'\x01\x01\x00\x00\x00\x00\x00\x01'
+            b'\x01D\x00\x01a\x00\x012D\x00\x00\x00\x013'
+            b'\x04D\x00\x01b\x00\x011D\x00\x01c\x00\x00'
+            b'\x03')
+
     def test_parse(self):
         msg = IppRequest.from_string(self.printer_discovery)
         self.assertEqual(msg._attributes, {
@@ -75,6 +129,32 @@ class TestIppRequest(unittest.TestCase):
                 b'user']})
 
 
+class TestCorpus(unittest.TestCase):
+    def test_corpus_parses_consistently(self):
+        for name, data in corpus.corpus():
+            fuzz.check(data)
+
+    def test_collection_members(self):
+        msg = IppRequest.from_buffer(corpus.macos_print_job())
+        self.assertEqual(
+            msg.lookup(SectionEnum.job, b'media-col', fuzz.BEGIN_COLLECTION), [b'', b''])
+        self.assertIn(b'media-size-name', msg.lookup(
+            SectionEnum.job, b'media-col', fuzz.MEMBER_NAME))
+
+    def test_mutations(self):
+        self.assertEqual(fuzz.fuzz(50, seed=1), [])
+
+    def test_integers_must_be_4_bytes(self):
+        for value in (b'', b'\x00\x01', b'\x00\x00\x00\x00\x01'):
+            data = corpus.encode((2, 0), OperationEnum.get_jobs, 1, [
+                (SectionEnum.operation, [(TagEnum.integer, b'limit', value)])])
+            for parse in (IppRequest.from_buffer, lambda data: IppRequest.from_file(BytesIO(data))):
+                with self.assertRaises(IppParseError) as raised:
+                    parse(data)
+                self.assertEqual(str(raised.exception), 'Integer values must be 4 bytes')
+            fuzz.check(data)
+
+
 class MockRequest(object):
     rfile = None
     wfile = None
@@ -103,9 +183,15 @@ class MockRequest(object):
 
 class MockServer(object):
     behaviour = None
+    keepalive_timeout = None
+    max_keepalive_requests = 100
+    max_ipp_header_size = 1024 * 1024
     def __init__(self, behaviour):
         self.behaviour = behaviour
 
+    def queue_slots(self, _behaviour):
+        return None
+
 
 class TestPrintTestPage(unittest.TestCase):
     def test_strange_request(self):
@@ -118,6 +204,28 @@ class TestPrintTestPage(unittest.TestCase):
         self.assertEqual(request.ipp_request.opid_or_status, OperationEnum.print_job)
 
 
+class RecordingPrinter(RejectAllPrinter):
+    def operation_print_job_response(self, req, psfile):
+        self.document = psfile.read()
+        return super(RecordingPrinter, self).operation_print_job_response(req, psfile)
+
+
+class TestIPPRequestHandler(unittest.TestCase):
+    def test_document_follows_header(self):
+        ipp = TestIppRequest.printer_discovery
+        ipp = ipp[:2] + b'\x00\x02' + ipp[4:]
+        for body, headers in (
+                (ipp + b'%!PS', b'Content-Length: %d' % (len(ipp) + 4,)),
+                (b'%x\r\n%s\r\n2\r\n%%!\r\n2\r\nPS\r\n0\r\n\r\n' % (len(ipp), ipp),
+                 b'Transfer-Encoding: chunked')):
+            behaviour = RecordingPrinter()
+            handler = IPPRequestHandler(
+                MockRequest(b'POST / HTTP/1.1\r\n' + headers + b'\r\n\r\n' + body),
+                "127.0.0.1", MockServer(behaviour))
+            self.assertEqual(handler.ipp_request.opid_or_status, OperationEnum.print_job)
+            self.assertEqual(behaviour.document, b'%!PS')
+
+
 if __name__ == '__main__':
     logging.getLogger().setLevel(logging.DEBUG)
     unittest.main()
@@ -0,0 +1,255 @@
+#! /usr/bin/python
+from __future__ import division
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import sys, os.path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ippserver.server import (
+    ChunkedEncodingError, ChunkedReader, IPPRequestHandler, IPPServer)
+from ippserver.behaviour import RejectAllPrinter, RunCommandPrinter
+from ippserver.constants import StatusCodeEnum
+from ippserver.executor import CommandExecutor
+from ippserver.ppd import BasicPdfPPD
+from ippserver.request import IppRequest
+
+from io import BytesIO
+try:
+    from http.client import HTTPConnection
+except ImportError:
+    from httplib import HTTPConnection
+import logging
+import threading
+import unittest
+
+from tests import test_request
+
+
+class TestChunkedReader(unittest.TestCase):
+    body = b'5\r\nhello\r\n1;ext=1\r\n \r\n6\r\nworld!\r\n0\r\nX-Trailer: 1\r\n\r\nNEXT'
+
+    def test_read_all(self):
+        reader = ChunkedReader(BytesIO(self.body))
+        self.assertEqual(reader.read(), b'hello world!')
+
+    def test_read_across_chunks(self):
+        reader = ChunkedReader(BytesIO(self.body))
+        self.assertEqual(reader.read(3), b'hel')
+        self.assertEqual(reader.read(5), b'lo wo')
+        self.assertEqual(reader.read(100), b'rld!')
+        self.assertEqual(reader.read(100), b'')
+
+    def test_stops_after_trailers(self):
+        rfile = BytesIO(self.body)
+        reader = ChunkedReader(rfile)
+        reader.read()
+        self.assertEqual(rfile.read(), b'NEXT')
+
+    def test_truncated(self):
+        reader = ChunkedReader(BytesIO(b'10\r\nshort'))
+        self.assertRaises(RuntimeError, reader.read)
+
+    def test_bad_chunk_size(self):
+        for size in (b'-5', b'+5', b'0x5', b'five'):
+            reader = ChunkedReader(BytesIO(size + b'\r\nhello\r\n0\r\n\r\n'))
+            self.assertRaises(ChunkedEncodingError, reader.read)
+            reader = ChunkedReader(BytesIO(size + b'\r\nhello\r\n0\r\n\r\n'))
+            self.assertRaises(ChunkedEncodingError, reader.readinto, bytearray(10))
+
+
+class MockConnection(object):
+    def __init__(self, input):
+        self.rfile = BytesIO(input)
+        self.sent = BytesIO()
+
+    def settimeout(self, _timeout):
+        pass
+
+    def setsockopt(self, *_args, **_kwargs):
+        pass
+
+    def sendall(self, data):
+        self.sent.write(data)
+
+    def makefile(self, mode, _size):
+        if mode == "rb":
+            return self.rfile
+        raise ValueError()
+
+
+class MockServer(object):
+    keepalive_timeout = None
+    max_keepalive_requests = 100
+    max_ipp_header_size = 1024 * 1024
+
+    def __init__(self, behaviour):
+        self.behaviour = behaviour
+
+    def queue_slots(self, _behaviour):
+        return None
+
+
+# Complete request bodies whose IPP headers are malformed
+BAD_IPP_HEADERS = [
+    # an attribute before any section delimiter
+    b'\x01\x01\x00\x0b\x00\x00\x00\x01!\x00\x01a\x00\x04\x00\x00\x00\x01\x03',
+    # a 2 byte integer
+    b'\x01\x01\x00\x0b\x00\x00\x00\x01\x01!\x00\x01a\x00\x02\x00\x01\x03',
+    # no end-of-attributes tag
+    b'\x01\x01\x00\x0b\x00\x00\x00\x01\x01',
+]
+
+
+class TestPersistentConnection(unittest.TestCase):
+    get_homepage = b'GET / HTTP/1.1\r\nHost: localhost\r\n\r\n'
+
+    def handle(self, data, server=None):
+        connection = MockConnection(data)
+        IPPRequestHandler(
+            connection, "127.0.0.1", server or MockServer(RejectAllPrinter()))
+        return connection.sent.getvalue()
+
+    def test_many_requests_on_one_connection(self):
+        sent = self.handle(
+            self.get_homepage + b'GET /no-such-page HTTP/1.1\r\n\r\n')
+        self.assertEqual(sent.count(b'HTTP/1.1 200 '), 1)
+        self.assertEqual(sent.count(b'HTTP/1.1 404 '), 1)
+        self.assertEqual(sent.count(b'Connection: keep-alive'), 2)
+        self.assertIn(b'Content-Length: ', sent)
+
+    def test_unread_body_is_skipped(self):
+        sent = self.handle(
+            b'GET /x.ppd HTTP/1.1\r\nContent-Length: 3\r\n\r\nabc' +
+            self.get_homepage)
+        self.assertEqual(sent.count(b'HTTP/1.1 200 '), 2)
+
+    def test_connection_close(self):
+        sent = self.handle(
+            b'GET / HTTP/1.1\r\nConnection: close\r\n\r\n' +
+            self.get_homepage)
+        self.assertEqual(sent.count(b'HTTP/1.1 200 '), 1)
+        self.assertIn(b'Connection: close', sent)
+
+    def test_bad_content_length(self):
+        for content_length in (b'-5', b'+5', b'5_0', b'five'):
+            sent = self.handle(
+                b'POST / HTTP/1.1\r\nContent-Length: ' + content_length + b'\r\n\r\n' +
+                self.get_homepage)
+            self.assertTrue(sent.startswith(b'HTTP/1.1 400 '))
+            self.assertEqual(sent.count(b'HTTP/1.1 '), 1)
+
+    def test_bad_ipp_header(self):
+        for ipp in BAD_IPP_HEADERS:
+            sent = self.handle(
+                b'POST / HTTP/1.1\r\nContent-Length: %d\r\n\r\n%s' % (len(ipp), ipp) +
+                self.get_homepage)
+            self.assertTrue(sent.startswith(b'HTTP/1.1 400 '))
+            self.assertEqual(sent.count(b'HTTP/1.1 200 '), 1)
+
+    def test_bad_chunk_size(self):
+        for size in (b'-5', b'+5'):
+            sent = self.handle(
+                b'POST / HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n' +
+                size + b'\r\nhello\r\n0\r\n\r\n' + self.get_homepage)
+            self.assertTrue(sent.startswith(b'HTTP/1.1 400 '))
+            self.assertIn(b'Connection: close', sent)
+            self.assertEqual(sent.count(b'HTTP/1.1 '), 1)
+
+    def test_busy_closes_connection(self):
+        commands = CommandExecutor(['true'], max_concurrency=1, max_queued=0)
+        behaviour = RunCommandPrinter(['true'], False, 'ps', executor=commands)
+        ipp = test_request.TestIppRequest.printer_discovery
+        body = ipp[:2] + b'\x00\x02' + ipp[4:] + b'%!PS'
+        with commands._slots.slot():
+            sent = self.handle(
+                b'POST / HTTP/1.1\r\nContent-Length: %d\r\n\r\n%s' % (len(body), body) +
+                self.get_homepage, MockServer(behaviour))
+        self.assertEqual(sent.count(b'HTTP/1.1 200 '), 1)
+        self.assertIn(b'Connection: close', sent)
+        self.assertEqual(
+            IppRequest.from_buffer(sent.split(b'\r\n\r\n')[-1]).opid_or_status,
+            StatusCodeEnum.server_error_busy)
+
+    def test_max_requests(self):
+        server = MockServer(RejectAllPrinter())
+        server.max_keepalive_requests = 2
+        sent = self.handle(self.get_homepage * 3, server)
+        self.assertEqual(sent.count(b'HTTP/1.1 200 '), 2)
+        self.assertEqual(sent.count(b'Connection: close'), 1)
+
+
+class TestConditionalGet(unittest.TestCase):
+    def handle(self, data, behaviour):
+        connection = MockConnection(data)
+        IPPRequestHandler(connection, "127.0.0.1", MockServer(behaviour))
+        return connection.sent.getvalue()
+
+    def header(self, sent, name):
+        return sent.split(name + b': ', 1)[1].split(b'\r\n', 1)[0]
+
+    def test_ppd_not_modified(self):
+        behaviour = RejectAllPrinter()
+        sent = self.handle(b'GET /printer.ppd HTTP/1.1\r\n\r\n', behaviour)
+        self.assertTrue(sent.startswith(b'HTTP/1.1 200 '))
+        etag = self.header(sent, b'ETag')
+        last_modified = self.header(sent, b'Last-Modified')
+        self.assertTrue(sent.endswith(behaviour.ppd.text()))
+
+        sent = self.handle(
+            b'GET /printer.ppd HTTP/1.1\r\nIf-None-Match: "other", ' + etag + b'\r\n\r\n' +
+            b'GET /printer.ppd HTTP/1.1\r\nIf-Modified-Since: ' + last_modified + b'\r\n\r\n' +
+            b'GET /printer.ppd HTTP/1.1\r\nIf-None-Match: "other"\r\n'
+            b'If-Modified-Since: ' + last_modified + b'\r\n\r\n',
+            behaviour)
+        responses = sent.split(b'HTTP/1.1 ')[1:]
+        self.assertEqual(
+            [response[:4] for response in responses], [b'304 ', b'304 ', b'200 '])
+        for response in responses[:2]:
+            self.assertNotIn(b'Content-Length', response)
+            self.assertIn(b'Connection: keep-alive', response)
+            self.assertIn(b'ETag: ' + etag, response)
+            self.assertTrue(response.endswith(b'\r\n\r\n'))
+
+    def test_modified_since_earlier(self):
+        sent = self.handle(
+            b'GET / HTTP/1.1\r\nIf-Modified-Since: Thu, 01 Jan 1970 00:00:00 GMT\r\n\r\n',
+            RejectAllPrinter())
+        self.assertTrue(sent.startswith(b'HTTP/1.1 200 '))
+        self.assertIn(b'Last-Modified: ', sent)
+
+    def test_ppd_page_is_cached(self):
+        behaviour = RejectAllPrinter()
+        page = behaviour.ppd_page()
+        self.assertIs(behaviour.ppd_page(), page)
+        behaviour.ppd = BasicPdfPPD()
+        behaviour.invalidate_caches()
+        self.assertEqual(behaviour.ppd_page().body, BasicPdfPPD().text())
+        self.assertNotEqual(behaviour.ppd_page().etag, page.etag)
+
+
+class TestWorkerPool(unittest.TestCase):
+    def test_fixed_pool(self):
+        server = IPPServer(
+            ('127.0.0.1', 0), IPPRequestHandler, RejectAllPrinter(),
+            workers=2, accept_queue_size=1, listen_backlog=50)
+        self.assertEqual(server.request_queue_size, 50)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            for _ in range(5):
+                connection = HTTPConnection(*server.server_address)
+                connection.request('GET', '/', headers={'Connection': 'close'})
+                self.assertEqual(connection.getresponse().status, 200)
+                connection.close()
+            self.assertEqual(len(server._worker_threads), 2)
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+
+
+if __name__ == '__main__':
+    logging.getLogger().setLevel(logging.DEBUG)
+    unittest.main()
@@ -0,0 +1,124 @@
+#! /usr/bin/python
+from __future__ import division
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import sys, os.path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ippserver import streams
+from ippserver.behaviour import RunCommandPrinter, SaveFilePrinter
+from ippserver.server import ChunkedReader, LengthLimitedReader
+
+from io import BytesIO
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+
+class TestCopyToFd(unittest.TestCase):
+    data = bytes(bytearray(range(256))) * 5000
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def copy(self, source):
+        filename = os.path.join(self.directory, 'out')
+        with open(filename, 'wb') as out:
+            count = streams.copy_to_fd(source, out.fileno())
+        with open(filename, 'rb') as out:
+            return count, out.read()
+
+    def test_from_buffer(self):
+        self.assertEqual(self.copy(BytesIO(self.data)), (len(self.data), self.data))
+
+    def test_from_chunked_body(self):
+        body = b'%x\r\n%s\r\n0\r\n\r\n' % (len(self.data), self.data)
+        self.assertEqual(
+            self.copy(ChunkedReader(BytesIO(body))), (len(self.data), self.data))
+
+    def test_from_regular_file(self):
+        filename = os.path.join(self.directory, 'in')
+        with open(filename, 'wb') as f:
+            f.write(self.data)
+        with open(filename, 'rb') as f:
+            f.read(10)
+            counter = streams.CountingReader(f)
+            self.assertEqual(self.copy(counter), (len(self.data) - 10, self.data[10:]))
+            self.assertEqual(counter.bytes_read, len(self.data) - 10)
+            self.assertEqual(f.read(), b'')
+
+    def test_to_pipe(self):
+        read_fd, write_fd = os.pipe()
+        filename = os.path.join(self.directory, 'in')
+        with open(filename, 'wb') as f:
+            f.write(b'x' * 1000)
+        with open(filename, 'rb') as f:
+            self.assertEqual(streams.copy_to_fd(f, write_fd), 1000)
+        os.close(write_fd)
+        with os.fdopen(read_fd, 'rb') as pipe:
+            self.assertEqual(pipe.read(), b'x' * 1000)
+
+    def test_remaining_length(self):
+        self.assertEqual(streams.remaining_length(BytesIO(b'abc')), None)
+        body = LengthLimitedReader(BytesIO(b'abcdef'), 4)
+        body.read(1)
+        self.assertEqual(streams.remaining_length(streams.CountingReader(body)), 3)
+
+    def test_from_prefixed_reader(self):
+        body = LengthLimitedReader(BytesIO(self.data[100:] + b'next'), len(self.data) - 100)
+        prefixed = streams.PrefixedReader(self.data[:100], body)
+        self.assertEqual(streams.remaining_length(prefixed), len(self.data))
+        self.assertEqual(self.copy(prefixed), (len(self.data), self.data))
+
+    def test_prefixed_reader(self):
+        prefixed = streams.PrefixedReader(b'abc', BytesIO(b'def'))
+        self.assertEqual(prefixed.read(2), b'ab')
+        buf = bytearray(4)
+        self.assertEqual(prefixed.readinto(buf), 1)
+        self.assertEqual(prefixed.read(), b'def')
+
+
+class TestSaveFilePrinter(unittest.TestCase):
+    def test_saves_body(self):
+        directory = tempfile.mkdtemp()
+        try:
+            data = b'%!PS' * 300000
+            rfile = BytesIO(data + b'POST / HTTP/1.1')
+            behaviour = SaveFilePrinter(directory, 'ps')
+            behaviour.handle_postscript(None, LengthLimitedReader(rfile, len(data)))
+            filename, = os.listdir(directory)
+            with open(os.path.join(directory, filename), 'rb') as f:
+                self.assertEqual(f.read(), data)
+            self.assertEqual(rfile.read(), b'POST / HTTP/1.1')
+        finally:
+            shutil.rmtree(directory)
+
+
+class TestRunCommandPrinter(unittest.TestCase):
+    def test_document_is_piped_to_command(self):
+        directory = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(directory, 'out')
+            behaviour = RunCommandPrinter(
+                ['sh', '-c', 'cat > "$0"', filename], False, 'ps')
+            behaviour.handle_postscript(None, BytesIO(b'%!PS' * 100000))
+            with open(filename, 'rb') as f:
+                self.assertEqual(f.read(), b'%!PS' * 100000)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_command_exits_early(self):
+        behaviour = RunCommandPrinter(['true'], False, 'ps')
+        behaviour.handle_postscript(None, BytesIO(b'%!PS' * 1000000))
+
+
+if __name__ == '__main__':
+    logging.getLogger().setLevel(logging.DEBUG)
+    unittest.main()
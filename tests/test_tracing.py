@@ -0,0 +1,89 @@
+#! /usr/bin/python
+from __future__ import division
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import sys, os.path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ippserver import tracing
+from ippserver.behaviour import SaveFilePrinter
+from ippserver.constants import OperationEnum, SectionEnum, TagEnum
+from ippserver.request import IppRequest
+from ippserver.server import IPPRequestHandler
+
+import json
+import os
+import shutil
+import tempfile
+import tracemalloc
+import unittest
+
+from tests.test_server import MockConnection, MockServer
+
+
+def chunked_print_job(document):
+    body = IppRequest((1, 1), OperationEnum.print_job, 1, {
+        (SectionEnum.operation, b'attributes-charset', TagEnum.charset): [b'utf-8'],
+    }).to_string() + document
+    chunks = b''.join(
+        b'%x\r\n%s\r\n' % (len(body[i:i + 1000]), body[i:i + 1000])
+        for i in range(0, len(body), 1000))
+    return (
+        b'POST /printer HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n' +
+        chunks + b'0\r\n\r\n')
+
+
+class TestTracing(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.output = os.path.join(self.directory, 'traces.jsonl')
+        self.behaviour = SaveFilePrinter(os.path.join(self.directory, 'jobs'), 'ps')
+        os.mkdir(self.behaviour.directory)
+
+    def tearDown(self):
+        tracing.set_tracer(None)
+        tracemalloc.stop()
+        shutil.rmtree(self.directory)
+
+    def handle(self, data):
+        connection = MockConnection(data)
+        IPPRequestHandler(connection, "127.0.0.1", MockServer(self.behaviour))
+        return connection.sent.getvalue()
+
+    def traces(self):
+        with open(self.output, 'rb') as f:
+            return [json.loads(line.decode('utf-8')) for line in f]
+
+    def test_spans_for_each_phase(self):
+        tracing.set_tracer(tracing.Tracer(output=self.output))
+        self.handle(chunked_print_job(b'%!PS' * 10000))
+        trace, = self.traces()
+        self.assertEqual(trace['name'], 'POST /printer')
+        self.assertEqual(
+            [span['name'] for span in trace['spans']],
+            ['parse', 'handle_postscript', 'dispatch', 'encode', 'write'])
+        handle_postscript, dispatch = trace['spans'][1:3]
+        self.assertEqual((dispatch['depth'], handle_postscript['depth']), (0, 1))
+        self.assertGreater(trace['totals']['read'], 0)
+        self.assertGreaterEqual(trace['duration'], dispatch['duration'])
+
+    def test_sampling(self):
+        tracing.set_tracer(tracing.Tracer(sample_rate=0, output=self.output))
+        self.handle(b'GET / HTTP/1.1\r\n\r\n' * 5)
+        self.assertEqual(self.traces(), [])
+        self.assertIsNone(tracing.current_trace())
+
+    def test_keeps_slowest_profiles(self):
+        tracer = tracing.Tracer(
+            profile_slowest=2, profile_directory=self.directory, trace_memory=True)
+        tracing.set_tracer(tracer)
+        self.handle(b'GET / HTTP/1.1\r\n\r\n' * 3 + chunked_print_job(b'%!PS' * 100000))
+        profiles = [name for name in os.listdir(self.directory) if name.endswith('.prof')]
+        self.assertEqual(len(profiles), 2)
+        self.assertEqual(len(tracer.slowest_profiles()), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()